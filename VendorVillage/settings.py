@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import sys
 from pathlib import Path
 from datetime import timedelta
 
@@ -85,8 +86,6 @@ REST_FRAMEWORK = {
     ],
 }
 
-# TODO Добавить умный поиск elastick search
-
 ELASTICSEARCH_DSL = {
     'default': {
         'hosts': 'http://localhost:9200'  # Добавьте http:// в начало
@@ -198,4 +197,53 @@ STATICFILES_DIRS = [BASE_DIR / "static"]
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_ROOT = BASE_DIR / 'media'
-MEDIA_URL = '/media/'
\ No newline at end of file
+MEDIA_URL = '/media/'
+
+# Время жизни резерва товара по умолчанию (минуты); 0 — бессрочный резерв
+STOCK_RESERVATION_TTL_MINUTES = 30
+
+# Общий кеш всех процессов: через него передаются поколения индексов фасетов,
+# подсказок и сканов и версии кеша ответов каталога. Локальный кеш в памяти
+# (по умолчанию в Django) не виден другим воркерам — они отдают устаревшие данные
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    }
+}
+# Тесты идут в одном процессе: им хватает кеша в памяти, Redis не нужен
+if sys.argv[1:2] == ['test']:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    SILENCED_SYSTEM_CHECKS = ['marketplace.W001']
+
+# Индекс фасетов категорий в памяти процесса (marketplace.facet_index):
+# выключение возвращает подсчёт фасетов SQL-запросом
+FACET_INDEX_ENABLED = True
+# Сколько категорий держит индекс одного процесса (вытесняются давно не запрошенные)
+FACET_INDEX_MAX_CATEGORIES = 32
+# Максимальный возраст индекса, секунды: потом он строится заново,
+# даже если изменение не было опубликовано; 0 — без ограничения
+FACET_INDEX_MAX_AGE = 600
+# Больше стольких подходящих товаров фильтр по атрибутам идёт SQL-запросом,
+# а не списком id из индекса
+FACET_INDEX_MAX_IDS = 1000
+# То же для индекса подсказок поиска (marketplace.suggest)
+SUGGEST_INDEX_MAX_AGE = 600
+
+# Время жизни закешированного ответа каталога (marketplace.catalog_cache), секунды;
+# ответы устаревают раньше по версиям товаров и категорий, 0 — без кеша
+CATALOG_RESPONSE_CACHE_TIMEOUT = 600
+
+# Бэкенд полнотекстового поиска товаров (marketplace.search):
+# DatabaseSearchBackend — FULLTEXT/FTS5 в основной базе, LikeSearchBackend — поиск
+# подстроки, ElasticsearchSearchBackend — индекс в Elasticsearch (ELASTICSEARCH_DSL)
+MARKETPLACE_SEARCH_BACKEND = "marketplace.search.DatabaseSearchBackend"
+# Имя индекса Elasticsearch для ElasticsearchSearchBackend
+MARKETPLACE_SEARCH_INDEX = "products"
+# Индексировать товары транзакции сразу после её коммита (не больше
+# marketplace.search.ON_COMMIT_LIMIT); очередь разбирает drain_search_outbox по расписанию
+MARKETPLACE_SEARCH_INDEX_ON_COMMIT = True
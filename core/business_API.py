@@ -20,6 +20,7 @@ from core.models import Business
 from accounts.JWT_AUTH import CookieJWTAuthentication
 from .serializers import EnhancedProductListSerializer
 from marketplace.ProductsSet import ProductSet
+from marketplace.stock import resolve_product_availability
 from .ProductCreateService import ProductService
 from .product_detail_serializer import ProductDetailSerializer
 
@@ -33,25 +34,38 @@ def business_products_api(request, business_slug):
 
     # Получение списка товаров бизнеса
     products = Product.objects.filter(business=business).order_by("-created_at")
-    filtered_products, applied_filters = ProductSet.filter_products(
+    # Фасеты считаются по товарам до фильтра по атрибутам
+    selections = ProductSet.parse_attribute_filters(request)
+    base_products, applied_filters = ProductSet.filter_products(
         products,
         request,
         price=True,
         search=True,
         barcode=True,
-        attributes=True,
         in_stock=True,
         main=True,
-        sort=True,
     )
-    page_obj, pagination = ProductSet.pagination_for_products(
-        filtered_products, request
+    filtered_products = ProductSet.filter_by_attributes(base_products, selections)
+    # Сортировка и пагинация — по строкам каталога, товары загружаются только для страницы
+    listings = ProductSet.get_listings(
+        filtered_products, applied_filters["sort"], applied_filters["corrected_query"]
     )
-    filters = ProductSet.get_filters_by_products(filtered_products)
+    page_obj, pagination = ProductSet.pagination_for_products(listings, request)
+    page_ids = [listing.product_id for listing in page_obj]
+    products_by_id = Product.objects.in_bulk(page_ids)
+    page_products = ProductSet.prefetch_for_business_list(
+        products_by_id[pk] for pk in page_ids if pk in products_by_id
+    )
+    filters = ProductSet.get_filters_by_products(base_products, selections=selections)
     categories = Category.objects.filter(products__business=business).distinct()
 
     serializied_products = EnhancedProductListSerializer(
-        page_obj, many=True, context={"request": request}
+        page_products,
+        many=True,
+        context={
+            "request": request,
+            "availability": resolve_product_availability(page_products),
+        },
     )
     serializied_categories = CategorySerializer(categories, many=True)
     all_data = {
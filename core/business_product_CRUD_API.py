@@ -20,7 +20,13 @@ from marketplace.models import (
     Category,
     AttributeValue,
     CategoryAttribute,
-    ProductDefect
+    ProductDefect,
+    StockReservation,
+)
+from marketplace.stock import (
+    release_reservation,
+    release_reserved_quantity,
+    reserve_quantity,
 )
 from core.models import Business, BusinessLocation
 from .serializers import ProductCreateSerializer
@@ -382,9 +388,8 @@ def toggle_status_product(request, business_slug, product_id):
 
     # Проверка при активации: есть ли доступные варианты
     if is_active:
-        has_available_variant = any(
-            variant.available_quantity > 0 and variant.show_this
-            for variant in product.variants.all()
+        has_available_variant = (
+            product.variants.filter(show_this=True).in_stock().exists()
         )
         if not has_available_variant:
             return Response(
@@ -436,7 +441,10 @@ def create_stock_defect(request, business_slug, stock_id):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated, IsBusinessOwner])
 def reserve_stock(request, business_slug, stock_id):
-    """Резервирование товара по складу"""
+    """
+    Резервирование товара по складу.
+    ttl_minutes — срок резерва (по умолчанию STOCK_RESERVATION_TTL_MINUTES, 0 — бессрочно)
+    """
 
     try:
         quantity = int(request.data.get("quantity", 0))
@@ -448,6 +456,19 @@ def reserve_stock(request, business_slug, stock_id):
             {"detail": "Неверное количество"}, status=status.HTTP_400_BAD_REQUEST
         )
 
+    ttl_minutes = request.data.get("ttl_minutes")
+    if ttl_minutes not in (None, ""):
+        try:
+            ttl_minutes = int(ttl_minutes)
+        except (TypeError, ValueError):
+            ttl_minutes = -1
+        if ttl_minutes < 0:
+            return Response(
+                {"detail": "Неверный срок резерва"}, status=status.HTTP_400_BAD_REQUEST
+            )
+    else:
+        ttl_minutes = None
+
     business = ProductService.get_business(request.user, business_slug)
     stock = get_object_or_404(
         ProductStock,
@@ -455,16 +476,27 @@ def reserve_stock(request, business_slug, stock_id):
         variant__product__business=business,
     )
 
-    if quantity > stock.available_quantity:
+    try:
+        reservation = reserve_quantity(
+            stock.id,
+            quantity,
+            owner=request.user,
+            ttl_minutes=ttl_minutes,
+            comment=request.data.get("comment", ""),
+        )
+    except ValidationError as e:
         return Response(
-            {"detail": "Недостаточно товара"}, status=status.HTTP_400_BAD_REQUEST
+            {"detail": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST
         )
 
-    stock.reserved_quantity += quantity
-    stock.save()
-
+    stock.refresh_from_db(fields=["reserved_quantity"])
     return Response(
-        {"message": "Товар зарезервирован", "reserved_quantity": stock.reserved_quantity},
+        {
+            "message": "Товар зарезервирован",
+            "reserved_quantity": stock.reserved_quantity,
+            "reservation_id": reservation.id,
+            "expires_at": reservation.expires_at,
+        },
         status=status.HTTP_200_OK,
     )
 
@@ -491,18 +523,10 @@ def remove_stock_defect(request, business_slug, defect_id):
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated, IsBusinessOwner])
 def remove_stock_reserve(request, business_slug, stock_id):
-    """Снятие резервирования с товара"""
-
-    try:
-        quantity_to_remove = int(request.data.get("quantity", 0))
-    except (TypeError, ValueError):
-        quantity_to_remove = 0
-
-    if quantity_to_remove <= 0:
-        return Response(
-            {"detail": "Неверное количество"},
-            status=status.HTTP_400_BAD_REQUEST,
-        )
+    """
+    Снятие резервирования с товара.
+    reservation_id — снять конкретный резерв, иначе quantity единиц начиная со старых резервов
+    """
 
     business = ProductService.get_business(request.user, business_slug)
     stock = get_object_or_404(
@@ -511,19 +535,41 @@ def remove_stock_reserve(request, business_slug, stock_id):
         variant__product__business=business,
     )
 
-    if quantity_to_remove > stock.reserved_quantity:
-        return Response(
-            {"detail": "Нельзя снять больше, чем зарезервировано"},
-            status=status.HTTP_400_BAD_REQUEST,
+    reservation_id = request.data.get("reservation_id")
+    if reservation_id:
+        reservation = get_object_or_404(
+            StockReservation, id=reservation_id, stock=stock
         )
+        if not release_reservation(reservation, user=request.user):
+            return Response(
+                {"detail": "Резерв уже снят"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        quantity_to_remove = reservation.quantity
+    else:
+        try:
+            quantity_to_remove = int(request.data.get("quantity", 0))
+        except (TypeError, ValueError):
+            quantity_to_remove = 0
 
-    stock.reserved_quantity -= quantity_to_remove
-    stock.save()
+        if quantity_to_remove <= 0:
+            return Response(
+                {"detail": "Неверное количество"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
+        try:
+            release_reserved_quantity(stock.id, quantity_to_remove, user=request.user)
+        except ValidationError as e:
+            return Response(
+                {"detail": e.messages[0]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+    stock.refresh_from_db(fields=["reserved_quantity"])
     return Response(
         {
             "message": f"Снято с резерва: {quantity_to_remove}",
             "reserved_quantity": stock.reserved_quantity,
         },
         status=status.HTTP_200_OK,
-    )
+    )
\ No newline at end of file
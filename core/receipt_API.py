@@ -10,7 +10,8 @@ from rest_framework.decorators import (api_view, authentication_classes,
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from .analytics_serializators import ReceiptDetailSerializer, ReceiptListSerializer
-from django.db.models import Prefetch
+from marketplace.pagination import paginate_by_cursor
+from django.db.models import Exists, OuterRef, Prefetch
 from rest_framework import status
 from datetime import datetime
 from django.utils.dateparse import parse_datetime
@@ -24,6 +25,11 @@ def paginate_receipts(request, queryset=None, quantity=12):
         queryset = Receipt.objects.all()
 
     per_page = int(request.GET.get("per_page", quantity))
+    if "cursor" in request.GET:
+        # keyset-пагинация: без OFFSET и COUNT, курсор — next_cursor прошлой страницы
+        receipts, pagination = paginate_by_cursor(queryset, request, per_page)
+        return ReceiptListSerializer(receipts, many=True).data, pagination
+
     paginator = Paginator(queryset, per_page)
     page_number = request.GET.get("page", 1)
 
@@ -60,10 +66,15 @@ def receipt_list(request, business_slug):
 
     receipts = (
         Receipt.objects
-        .filter(sales__variant__product__business=business)
+        .filter(
+            Exists(
+                ProductSale.objects.filter(
+                    receipt=OuterRef("pk"), variant__product__business=business
+                )
+            )
+        )
         .filter(is_deleted=False)
         .select_related("payment_method")
-        .distinct()
     )
 
     # Фильтрация по диапазону времени
@@ -83,7 +94,7 @@ def receipt_list(request, business_slug):
     except Exception as e:
         return Response({"error": "Некорректные параметры времени"}, status=400)
 
-    receipts = receipts.order_by("-created_at")
+    receipts = receipts.order_by("-created_at", "-id")
 
     data, pagination = paginate_receipts(request, receipts, quantity=12)
 
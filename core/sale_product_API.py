@@ -1,4 +1,5 @@
 import uuid
+from collections import defaultdict
 from datetime import datetime
 from decimal import Decimal
 
@@ -6,6 +7,7 @@ from accounts.JWT_AUTH import CookieJWTAuthentication
 from accounts.permissions import IsBusinessOwner
 from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from marketplace.models import (
     PaymentMethod,
@@ -14,8 +16,12 @@ from marketplace.models import (
     ProductStock,
     ProductVariant,
     Receipt,
+    StockMovement,
 )
+from marketplace.copurchase import upsell_variants
 from marketplace.ProductsSet import ProductSet
+from marketplace.scan import scan
+from marketplace.stock import record_movements
 from rest_framework import status
 from rest_framework.decorators import (
     api_view,
@@ -25,7 +31,7 @@ from rest_framework.decorators import (
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
-from .models import Business
+from .models import Business, BusinessLocation
 from .product_sale_serializer import (
     EnhancedProductListSerializer,
     PaymentMethodSerializer,
@@ -108,6 +114,54 @@ def sales_products_api(request, business_slug):
     )
 
 
+@api_view(["GET"])
+@authentication_classes([CookieJWTAuthentication])
+@permission_classes([IsAuthenticated, IsBusinessOwner])
+def upsell_api(request, business_slug):
+    """
+    Подсказки на кассе: товары бизнеса, которые чаще всего покупают вместе
+    с вариантами из текущего чека (?variants=1,2,3&limit=5).
+    """
+    business = get_object_or_404(Business, slug=business_slug)
+    try:
+        variant_ids = [
+            int(value)
+            for values in request.GET.getlist("variants")
+            for value in values.split(",")
+            if value
+        ]
+        limit = min(max(int(request.GET.get("limit", 5)), 1), 20)
+    except ValueError:
+        return Response(
+            {"error": "variants — список id вариантов через запятую"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if not variant_ids:
+        return Response({"suggestions": []})
+
+    return Response(
+        {"suggestions": upsell_variants(variant_ids, business, limit=limit)}
+    )
+
+
+@api_view(["GET"])
+@authentication_classes([CookieJWTAuthentication])
+@permission_classes([IsAuthenticated, IsBusinessOwner])
+def scan_api(request, business_slug):
+    """
+    Скан на кассе: вариант бизнеса по точному штрихкоду или артикулу (?code=)
+    с ценой и остатками по локациям, без фильтрации каталога.
+    """
+    code = request.GET.get("code", "")
+    variant = scan(business_slug, code)
+    if variant is None:
+        return Response(
+            {"error": "Товар с таким штрихкодом или артикулом не найден"},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    return Response(variant)
+
+
 import uuid
 from decimal import Decimal
 
@@ -119,7 +173,6 @@ from rest_framework.response import Response
 
 
 @api_view(["POST"])
-@transaction.atomic
 @authentication_classes([CookieJWTAuthentication])
 @permission_classes([IsAuthenticated, IsBusinessOwner])
 def create_receipt(request, business_slug):
@@ -133,83 +186,137 @@ def create_receipt(request, business_slug):
     rcpt_disc_amount = Decimal(v.pop("discount_amount", 0))
     rcpt_disc_percent = Decimal(v.pop("discount_percent", 0))
 
-    # ---------- создаём сам чек ----------
-    receipt = Receipt.objects.create(
-        number=f"CHK-{uuid.uuid4().hex[:8].upper()}",
-        payment_method=v["payment_method"],
-        customer=v.get("customer"),
-        customer_name=v.get("customer_name", ""),
-        customer_phone=v.get("customer_phone", ""),
-        is_online=False,
-        is_paid=True,
-        total_amount=0,  # обновим ниже
-        discount_amount=rcpt_disc_amount,
-        discount_percent=rcpt_disc_percent,
-    )
-
-    total_amount = Decimal("0")
-    product_sales = []
-    affected_products = set()  # ← будем хранить Product-ы
-
-    # ---------- валидация + подготовка ----------
+    # ---------- проверки принадлежности (без блокировок) ----------
+    requested = defaultdict(int)  # (variant_id, location_id) -> количество
     for item in sales_data:
         var: ProductVariant = item["variant"]
         loc: BusinessLocation = item["location"]
-        qty = item["quantity"]
-        disc_amount = Decimal(str(item.get("discount_amount", 0)))
-        disc_percent = Decimal(str(item.get("discount_percent", 0)))
-
-        # проверки принадлежности и наличия
-        if loc.business != business:
+        if loc.business_id != business.id:
             raise ValidationError(f"Локация '{loc}' не принадлежит бизнесу.")
+        requested[(var.id, loc.id)] += item["quantity"]
 
-        if var.product.business != business:
-            raise ValidationError(f"Вариант '{var}' не принадлежит бизнесу.")
-
-        stock = ProductStock.objects.select_for_update().get(variant=var, location=loc)
-        if stock.available_quantity < qty:
-            raise ValidationError(
-                f"Недостаточно '{var}' на '{loc}'. Доступно: {stock.available_quantity}"
+    variant_ids = {item["variant"].id for item in sales_data}
+    own_variant_ids = set(
+        ProductVariant.objects.filter(
+            pk__in=variant_ids, product__business=business
+        ).values_list("pk", flat=True)
+    )
+    for item in sales_data:
+        if item["variant"].id not in own_variant_ids:
+            raise ValidationError(f"Вариант '{item['variant']}' не принадлежит бизнесу.")
+
+    with transaction.atomic():
+        # ---------- блокируем все остатки чека одним запросом ----------
+        # Порядок по первичному ключу одинаков для всех касс, поэтому
+        # параллельные чеки с теми же товарами не блокируют друг друга крест-накрест
+        lookup = Q()
+        for variant_id, location_id in requested:
+            lookup |= Q(variant_id=variant_id, location_id=location_id)
+        stocks = {
+            (row["variant_id"], row["location_id"]): row
+            for row in ProductStock.objects.select_for_update()
+            .filter(lookup)
+            .order_by("pk")
+            .values(
+                "pk",
+                "variant_id",
+                "location_id",
+                "quantity",
+                "reserved_quantity",
+                "defect_quantity",
+                "sold_quantity",
             )
+        }
 
-        price = Decimal(str(var.current_price))
-        unit_disc = price * disc_percent / 100 + disc_amount
-        final_price = max(price - unit_disc, 0)
-        line_total = final_price * qty
+        # ---------- валидация наличия ----------
+        for item in sales_data:
+            var, loc = item["variant"], item["location"]
+            row = stocks.get((var.id, loc.id))
+            if row is None:
+                raise ValidationError(f"Нет остатка '{var}' на '{loc}'.")
+            available = (
+                row["quantity"]
+                - row["reserved_quantity"]
+                - row["defect_quantity"]
+                - row["sold_quantity"]
+            )
+            if available < requested[(var.id, loc.id)]:
+                raise ValidationError(
+                    f"Недостаточно '{var}' на '{loc}'. Доступно: {max(available, 0)}"
+                )
+
+        # ---------- создаём сам чек ----------
+        receipt = Receipt.objects.create(
+            number=f"CHK-{uuid.uuid4().hex[:8].upper()}",
+            payment_method=v["payment_method"],
+            customer=v.get("customer"),
+            customer_name=v.get("customer_name", ""),
+            customer_phone=v.get("customer_phone", ""),
+            is_online=False,
+            is_paid=True,
+            total_amount=0,  # обновим ниже
+            discount_amount=rcpt_disc_amount,
+            discount_percent=rcpt_disc_percent,
+        )
 
-        product_sales.append(
-            ProductSale(
-                receipt=receipt,
-                variant=var,
-                location=loc,
+        total_amount = Decimal("0")
+        product_sales = []
+
+        # ---------- подготовка продаж ----------
+        for item in sales_data:
+            var: ProductVariant = item["variant"]
+            loc: BusinessLocation = item["location"]
+            qty = item["quantity"]
+            disc_amount = Decimal(str(item.get("discount_amount", 0)))
+            disc_percent = Decimal(str(item.get("discount_percent", 0)))
+
+            price = Decimal(str(var.current_price))
+            unit_disc = price * disc_percent / 100 + disc_amount
+            final_price = max(price - unit_disc, 0)
+            line_total = final_price * qty
+
+            product_sales.append(
+                ProductSale(
+                    receipt=receipt,
+                    variant=var,
+                    location=loc,
+                    quantity=qty,
+                    price_per_unit=price,
+                    discount_percent=disc_percent,
+                    discount_amount=disc_amount,
+                    total_price=line_total,
+                    is_paid=True,
+                )
+            )
+            total_amount += line_total
+
+        # ---------- массовое создание продаж и списание ----------
+        # sold_quantity всех строк меняется одним UPDATE;
+        # is_active затронутых товаров пересчитается один раз после коммита
+        ProductSale.objects.bulk_create(product_sales)
+        record_movements(
+            StockMovement(
+                stock_id=stocks[key]["pk"],
+                kind=StockMovement.SALE,
                 quantity=qty,
-                price_per_unit=price,
-                discount_percent=disc_percent,
-                discount_amount=disc_amount,
-                total_price=line_total,
-                is_paid=True,
+                receipt=receipt,
+                user=request.user,
             )
+            for key, qty in requested.items()
         )
-        total_amount += line_total
-        affected_products.add(var.product)  # запоминаем товар
-
-    # ---------- массовое создание продаж ----------
-    ProductSale.objects.bulk_create(product_sales)
-
-    # ---------- перерасчёт итогов чека ----------
-    if rcpt_disc_percent:
-        total_amount -= total_amount * rcpt_disc_percent / 100
-    total_amount -= rcpt_disc_amount
-    receipt.total_amount = max(total_amount, 0)
-    receipt._history_user = request.user
-    receipt.save(update_fields=["total_amount"])
+
+        # ---------- перерасчёт итогов чека ----------
+        if rcpt_disc_percent:
+            total_amount -= total_amount * rcpt_disc_percent / 100
+        total_amount -= rcpt_disc_amount
+        receipt.total_amount = max(total_amount, 0)
+        receipt._history_user = request.user
+        receipt.save(update_fields=["total_amount"])
+
+    # PDF формируется уже после коммита, чтобы не держать блокировки остатков
     generate_receipt_pdf(receipt.id, save=True)
     receipt.refresh_from_db()
 
-    # ---------- ручной update_is_active ----------
-    for product in affected_products:
-        product.update_is_active()
-
     return Response(
         ReceiptDetailSerializer(receipt).data, status=status.HTTP_201_CREATED
     )
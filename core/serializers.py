@@ -8,6 +8,7 @@ from marketplace.models import (
     ProductVariantAttribute,
 )
 from marketplace.serializers import ProductVariantSerializer, ProductImageSerializer
+from marketplace.stock import resolve_product_availability
 
 
 # ✅ Для ProductImage
@@ -149,16 +150,30 @@ class EnhancedProductListSerializer(serializers.ModelSerializer):
             "variants_count",
         ]
 
+    def _availability(self, obj):
+        """
+        Складские остатки из context["availability"] (stock.resolve_availability),
+        без контекста — одним запросом на товар.
+        """
+        availability = self.context.get("availability")
+        if availability is None:
+            availability = resolve_product_availability([obj])
+        return availability
+
     def get_default_variant(self, obj):
         variant = obj.get_default_variant(strict=False)
-        return ProductVariantSerializer(variant).data if variant else None
+        return (
+            ProductVariantSerializer(variant, context=self.context).data
+            if variant
+            else None
+        )
 
     def get_min_price(self, obj):
-        min_price, _ = obj.price_range
+        min_price, _ = obj.get_price_range(self.context.get("availability"))
         return min_price
 
     def get_max_price(self, obj):
-        _, max_price = obj.price_range
+        _, max_price = obj.get_price_range(self.context.get("availability"))
         return max_price
 
     def get_main_image(self, obj):
@@ -166,23 +181,26 @@ class EnhancedProductListSerializer(serializers.ModelSerializer):
         return ProductImageSerializer(main_image).data if main_image else None
 
     def get_stock_info(self, obj):
-        stocks = ProductStock.objects.filter(
-            variant__product=obj, location__location_type__is_warehouse=True
-        ).select_related("location")
+        availability = self._availability(obj)
+        stocks = [
+            (location_id, location)
+            for variant in obj.variants.all()
+            for location_id, location in availability[variant.id]["locations"].items()
+        ]
 
-        total_quantity = sum(stock.quantity for stock in stocks)
-        total_reserved = sum(stock.reserved_quantity for stock in stocks)
+        total_quantity = sum(location["quantity"] for _, location in stocks)
+        total_reserved = sum(location["reserved"] for _, location in stocks)
         total_available = total_quantity - total_reserved
 
         locations = [
             {
-                "location_id": stock.location.id,
-                "location_name": stock.location.name,
-                "quantity": stock.quantity,
-                "reserved": stock.reserved_quantity,
-                "available": stock.available_quantity,
+                "location_id": location_id,
+                "location_name": location["name"],
+                "quantity": location["quantity"],
+                "reserved": location["reserved"],
+                "available": location["available"],
             }
-            for stock in stocks
+            for location_id, location in stocks
         ]
 
         return {
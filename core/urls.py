@@ -109,6 +109,16 @@ urlpatterns.extend(
             sale_product_API.sales_products_api,
             name="sales_products_api",
         ),
+        path(
+            "api/business/<slug:business_slug>/sales-scan/",
+            sale_product_API.scan_api,
+            name="sales-scan",
+        ),
+        path(
+            "api/business/<slug:business_slug>/sales-upsell/",
+            sale_product_API.upsell_api,
+            name="sales-upsell",
+        ),
         path(
             "api/business/<slug:business_slug>/create-receipt/",
             sale_product_API.create_receipt,
@@ -1,26 +1,17 @@
-from django.db.models import (
-    Q,
-    F,
-    Case,
-    When,
-    DecimalField,
-    Min,
-    Max,
-    Sum,
-    Exists,
-    OuterRef,
-    Prefetch,
-)
+from django.db.models import F, Prefetch, prefetch_related_objects
 from django.shortcuts import get_object_or_404
 from .models import (
     Category,
     Product,
     ProductVariant,
-    AttributeValue,
-    Attribute,
-    CategoryAttribute,
+    ProductListing,
+    ProductStock,
     ProductVariantAttribute,
 )
+from .facets import attribute_facets
+from .listing import LISTING_ORDERING
+from .pagination import paginate_by_cursor
+from .search import corrected_query, search_rank
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.http import QueryDict
 
@@ -60,22 +51,83 @@ class ProductSet:
     def filter_products_by_variants(products_queryset):
         """
         Фильтрует продукты, у которых есть хотя бы один вариант с show_this=True.
-        Возвращает QuerySet продуктов.
+        Возвращает QuerySet продуктов (условие EXISTS, без загрузки в Python).
         """
-        valid_product_ids = []
+        return products_queryset.with_visible_variants()
 
-        products = products_queryset.prefetch_related(
+    @staticmethod
+    def _variants_with_details():
+        """Варианты с атрибутами и остатками (вместе с локациями) для карточек."""
+        return ProductVariant.objects.prefetch_related(
             Prefetch(
-                "variants",
-                queryset=ProductVariant.objects.filter(show_this=True),
-            )
+                "attributes",
+                queryset=ProductVariantAttribute.objects.select_related(
+                    "category_attribute__attribute", "predefined_value"
+                ),
+            ),
+            Prefetch("stocks", queryset=ProductStock.objects.select_related("location")),
         )
 
+    @staticmethod
+    def list_prefetches():
+        """
+        Предзагрузки для карточек списка (ProductListSerializer):
+        видимые варианты с атрибутами и остатками в visible_variants и изображения.
+        """
+        variants = ProductSet._variants_with_details().filter(show_this=True)
+        return [
+            Prefetch("variants", queryset=variants, to_attr="visible_variants"),
+            "images",
+        ]
+
+    @staticmethod
+    def prefetch_for_list(products):
+        """
+        Загружает страницу товаров (Page, список или queryset) с данными карточек
+        за постоянное число запросов, независимо от размера страницы.
+        """
+        products = list(products)
+        prefetch_related_objects(products, *ProductSet.list_prefetches())
+        prefetch_related_objects(products, "category", "business")
+        return products
+
+    @staticmethod
+    def prefetch_for_business_list(products):
+        """
+        Как prefetch_for_list, но для списка бизнеса (EnhancedProductListSerializer):
+        все варианты товара, включая скрытые, видимые — ещё и в visible_variants.
+        """
+        products = list(products)
+        prefetch_related_objects(
+            products,
+            Prefetch("variants", queryset=ProductSet._variants_with_details()),
+            "images",
+            "category",
+            "business",
+        )
         for product in products:
-            if product.variants.exists():
-                valid_product_ids.append(product.id)
+            product.visible_variants = [
+                variant for variant in product.variants.all() if variant.show_this
+            ]
+        return products
 
-        return products_queryset.filter(id__in=valid_product_ids)
+    @staticmethod
+    def get_listings(products_qs, sort_option="-created_at", search_query=""):
+        """
+        Строки каталога (ProductListing) для отфильтрованного queryset товаров,
+        отсортированные по sort. Цены, наличие и карточка берутся из одной таблицы.
+        Сортировка relevance — по месту товара в выдаче поиска по search_query
+        (уже исправленному: applied_filters["corrected_query"] из filter_products).
+        """
+        listings = ProductListing.objects.filter(
+            product_id__in=products_qs.order_by().values("pk")
+        )
+        if sort_option == "relevance" and search_query:
+            return listings.annotate(
+                search_rank=search_rank(search_query, "product__")
+            ).order_by(F("search_rank").desc(nulls_last=True), "-product_id")
+        ordering = LISTING_ORDERING.get(sort_option, LISTING_ORDERING["-created_at"])
+        return listings.order_by(*ordering)
 
     @staticmethod
     def get_breadcrumbs_by_category(category):
@@ -93,8 +145,15 @@ class ProductSet:
 
     @staticmethod
     def pagination_for_products(products, request, quantity=12):
-
+        """
+        Страница товаров и данные пагинации.
+        С параметром cursor (пустой — первая страница) используется keyset-пагинация
+        по сортировке queryset без OFFSET и COUNT, иначе — постраничная по номеру.
+        """
         per_page = int(request.GET.get("per_page", quantity))
+        if "cursor" in request.GET:
+            return paginate_by_cursor(products, request, per_page)
+
         paginator = Paginator(products, per_page)
         page_number = request.GET.get("page", 1)
         try:
@@ -132,162 +191,82 @@ class ProductSet:
         return product
 
     @staticmethod
-    def get_same_products(product):
-        same_products = (
+    def get_same_products(product, limit=8):
+        """
+        Похожие товары из заранее рассчитанного SimilarProduct
+        (команда build_similar_products); пока расчёта для товара нет —
+        новые товары той же категории.
+        """
+        same_products = list(
+            Product.objects.filter(similar_to_links__product=product, is_active=True)
+            .order_by("similar_to_links__rank")[:limit]
+        )
+        if same_products:
+            return same_products
+        return list(
             Product.objects.filter(category=product.category, is_active=True)
             .exclude(id=product.id)
-            .order_by("?")[:8]
+            .order_by("-created_at")[:limit]
         )
-        return same_products
 
     @staticmethod
-    def get_filters_by_products(products_qs, category=None):
+    def get_filters_by_products(products_qs, category=None, selections=None):
+        """
+        Фильтры по атрибутам со значениями и количеством товаров ("Красный (14)").
+        products_qs — товары до фильтрации по атрибутам, selections — выбор
+        из parse_attribute_filters: количество для атрибута считается без учёта
+        его собственного выбора (дизъюнктивные фасеты).
+        """
+        filters = attribute_facets(products_qs, selections, category=category)
         if category:
-            product_ids = products_qs.values_list("id", flat=True)
-
-            # Находим все уникальные атрибуты для этих товаров
-            attributes = Attribute.objects.filter(
-                category_attributes__productvariantattribute__variant__product_id__in=product_ids,
-                is_filterable=True,
-            ).distinct()
-
-            filters = []
-
-            for attr in attributes:
-                # Получаем CategoryAttribute для этого атрибута в текущей категории
-                try:
-                    cat_attr = CategoryAttribute.objects.get(
-                        attribute=attr, category=category
-                    )
-                    required = cat_attr.required
-                except CategoryAttribute.DoesNotExist:
-                    required = False
-
-                # Предопределенные значения
-                predefined_values = AttributeValue.objects.filter(
-                    attribute=attr,
-                    productvariantattribute__variant__product_id__in=product_ids,
-                ).distinct()
-
-                # Кастомные значения
-                custom_values = (
-                    ProductVariantAttribute.objects.filter(
-                        category_attribute__attribute=attr,
-                        variant__product_id__in=product_ids,
-                        custom_value__isnull=False,
-                    )
-                    .exclude(custom_value="")
-                    .values_list("custom_value", flat=True)
-                    .distinct()
-                )
-
-                # Формируем список значений
-                values = []
-                for val in predefined_values:
-                    values.append(
-                        {
-                            "id": val.id,
-                            "value": val.value,
-                            "attribute_name": attr.name,
-                            "color_code": val.color_code,
-                        }
-                    )
-
-                for custom_val in custom_values:
-                    values.append(
-                        {
-                            "id": None,
-                            "value": custom_val,
-                            "attribute_name": attr.name,
-                            "color_code": None,
-                        }
-                    )
-
-                if values:
-                    filters.append(
-                        {
-                            "id": attr.id,
-                            "name": attr.name,
-                            "type": "choice",
-                            "has_predefined_values": attr.has_predefined_values,
-                            "required": required,
-                            "values": values,
-                        }
-                    )
-
-            response = {
+            return {
                 "category": {"id": category.id, "name": category.name},
-                "filters": sorted(filters, key=lambda x: x["name"]),
+                "filters": filters,
             }
+        return {"filters": filters}
 
-            return response
-        else:
-            product_ids = products_qs.values_list("id", flat=True)
-
-            # Находим все уникальные атрибуты для этих товаров
-            attributes = Attribute.objects.filter(
-                category_attributes__productvariantattribute__variant__product_id__in=product_ids,
-                is_filterable=True,
-            ).distinct()
-
-            filters = []
-
-            for attr in attributes:
-                # Получаем все значения атрибута для этих товаров
-                predefined_values = AttributeValue.objects.filter(
-                    attribute=attr,
-                    productvariantattribute__variant__product_id__in=product_ids,
-                ).distinct()
-
-                # Кастомные значения
-                custom_values = (
-                    ProductVariantAttribute.objects.filter(
-                        category_attribute__attribute=attr,
-                        variant__product_id__in=product_ids,
-                        custom_value__isnull=False,
-                    )
-                    .exclude(custom_value="")
-                    .values_list("custom_value", flat=True)
-                    .distinct()
-                )
+    @staticmethod
+    def parse_attribute_filters(request):
+        """
+        Выбор по атрибутам из GET: attr_<id>=<id значения> или attr_<id>=val_<текст>.
+        Возвращает {attribute_id: (id значений, произвольные значения)}.
+        """
+        selections = {}
+        for key in request.GET:
+            if not key.startswith("attr_"):
+                continue
+            try:
+                attr_id = int(key.replace("attr_", ""))
+                attr_values = [val for val in request.GET.getlist(key) if val]
+                value_ids = [int(val) for val in attr_values if not val.startswith("val_")]
+            except (ValueError, TypeError) as e:
+                print(f"Error processing attribute filter: {e}")
+                continue
+            custom_values = [
+                val[len("val_"):] for val in attr_values if val.startswith("val_")
+            ]
+            if value_ids or custom_values:
+                selections[attr_id] = (value_ids, custom_values)
+        return selections
 
-                # Формируем список значений
-                values = []
-                for val in predefined_values:
-                    values.append(
-                        {
-                            "id": val.id,
-                            "value": val.value,
-                            "attribute_name": attr.name,
-                            "color_code": val.color_code,
-                        }
-                    )
-
-                for custom_val in custom_values:
-                    values.append(
-                        {
-                            "id": None,
-                            "value": custom_val,
-                            "attribute_name": attr.name,
-                            "color_code": None,
-                        }
-                    )
-
-                if values:
-                    filters.append(
-                        {
-                            "id": attr.id,
-                            "name": attr.name,
-                            "type": "choice",
-                            "has_predefined_values": attr.has_predefined_values,
-                            "required": False,  # Без категории не можем определить обязательность
-                            "values": sorted(values, key=lambda x: x["value"]),
-                        }
-                    )
+    @staticmethod
+    def filter_by_attributes(products_qs, selections):
+        """Применяет выбор по атрибутам: по одному EXISTS на атрибут"""
+        for attr_id, (value_ids, custom_values) in selections.items():
+            products_qs = products_qs.with_attribute_values(
+                attr_id, value_ids, custom_values
+            )
+        return products_qs
 
-            return {
-                "filters": sorted(filters, key=lambda x: x["name"]),
-            }
+    @staticmethod
+    def _parse_price(value):
+        """Цена из GET-параметра; пустое или некорректное значение — без ограничения"""
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return None
 
     @staticmethod
     def filter_products(
@@ -302,133 +281,72 @@ class ProductSet:
         main=False,
         sort=False,
     ):
-        """Фильтрация товаров с возможностью включать/выключать отдельные блоки."""
+        """
+        Фильтрация товаров с возможностью включать/выключать отдельные блоки.
+        Каждый критерий по вариантам — отдельный EXISTS к одному базовому запросу,
+        поэтому результат не требует DISTINCT и одинаково работает
+        для маркетплейса и для бизнеса.
+        """
         in_stock_only = request.GET.get("in_stock") == "1"
         if in_stock and in_stock_only:
-            products_qs = products_qs.filter(variants__stock_quantity__gt=0).distinct()
+            products_qs = products_qs.in_stock()
 
         # Фильтр "только на главной"
         main_only = request.GET.get("main_only") == "1"
         if main and main_only:
             products_qs = products_qs.filter(is_visible_on_marketplace=True)
 
-        # Поиск по названию и описанию
+        # Поиск по названию и описанию; исправление опечаток проверяется
+        # один раз, тот же запрос идёт в фильтр и в сортировку по релевантности
         search_query = request.GET.get("search", "")
+        text_query = search_query
+        if search_query and search:
+            text_query = corrected_query(search_query, products_qs)
         if search_query and (search or barcode):
-            q_objects = Q()
-            if search:
-                q_objects |= Q(name__icontains=search_query)
-                q_objects |= Q(description__icontains=search_query)
-                q_objects |= Q(variants__custom_name__icontains=search_query)
-            if barcode:
-                q_objects |= Q(variants__barcode__icontains=search_query)
-            if q_objects:
-                products_qs = products_qs.filter(q_objects).distinct()
-
-        # Фильтрация по цене
-        price_min = request.GET.get("price_min")
-        if price and price_min:
-            try:
-                # Учитываем скидки при фильтрации по минимальной цене
-                products_qs = products_qs.annotate(
-                    min_price=Min(
-                        Case(
-                            When(
-                                variants__discount__isnull=False,
-                                then=F("variants__price") - F("variants__discount"),
-                            ),
-                            default=F("variants__price"),
-                            output_field=DecimalField(),
-                        )
-                    )
-                ).filter(min_price__gte=float(price_min))
-            except ValueError:
-                pass
+            products_qs = products_qs.search(
+                search_query, text=search, barcode=barcode, text_query=text_query
+            )
 
+        # Фильтрация по цене (с учётом скидок)
+        price_min = request.GET.get("price_min")
         price_max = request.GET.get("price_max")
-        if price and price_max:
-            try:
-                # Учитываем скидки при фильтрации по максимальной цене
-                products_qs = products_qs.annotate(
-                    max_price=Max(
-                        Case(
-                            When(
-                                variants__discount__isnull=False,
-                                then=F("variants__price") - F("variants__discount"),
-                            ),
-                            default=F("variants__price"),
-                            output_field=DecimalField(),
-                        )
-                    )
-                ).filter(max_price__lte=float(price_max))
-            except ValueError:
-                pass
+        if price:
+            products_qs = products_qs.price_between(
+                ProductSet._parse_price(price_min), ProductSet._parse_price(price_max)
+            )
 
         # Фильтрация по атрибутам
         if attributes:
-            for key, value in request.GET.items():
-                if key.startswith("attr_") and value:
-                    try:
-                        attr_id = int(key.replace("attr_", ""))
-                        attr_values = request.GET.getlist(key)
-
-                        q_objects = Q()
-                        for val in attr_values:
-                            if val.startswith("val_"):
-                                text_value = val.replace("val_", "")
-                                q_objects |= Q(
-                                    variants__attributes__category_attribute__attribute_id=attr_id,
-                                    variants__attributes__custom_value=text_value,
-                                )
-                            else:
-                                q_objects |= Q(
-                                    variants__attributes__category_attribute__attribute_id=attr_id,
-                                    variants__attributes__predefined_value__id=val,
-                                )
-
-                        if q_objects:
-                            products_qs = products_qs.filter(q_objects).distinct()
-
-                    except (ValueError, TypeError) as e:
-                        print(f"Error processing attribute filter: {e}")
-                        continue
-
-        # Сортировка
-        sort_option = request.GET.get("sort", "-created_at")
+            products_qs = ProductSet.filter_by_attributes(
+                products_qs, ProductSet.parse_attribute_filters(request)
+            )
+
+        # Сортировка; при поиске по умолчанию — по релевантности
+        default_sort = "relevance" if search_query and search else "-created_at"
+        sort_option = request.GET.get("sort") or default_sort
         if sort:
-            if sort_option == "price":
+            if sort_option == "relevance" and search_query:
+                # Товары, найденные только по штрихкоду, — в конце
                 products_qs = products_qs.annotate(
-                    sort_price=Min(
-                        Case(
-                            When(
-                                variants__discount__isnull=False,
-                                then=F("variants__price") - F("variants__discount"),
-                            ),
-                            default=F("variants__price"),
-                            output_field=DecimalField(),
-                        )
-                    )
-                ).order_by("sort_price")
+                    search_rank=search_rank(text_query)
+                ).order_by(F("search_rank").desc(nulls_last=True), "-created_at")
+            elif sort_option == "price":
+                products_qs = products_qs.with_price_bounds().order_by("min_price")
             elif sort_option == "-price":
                 # Сортировка по максимальной цене с учетом скидок
-                products_qs = products_qs.annotate(
-                    sort_price=Max(
-                        Case(
-                            When(
-                                variants__discount__isnull=False,
-                                then=F("variants__price") - F("variants__discount"),
-                            ),
-                            default=F("variants__price"),
-                            output_field=DecimalField(),
-                        )
-                    )
-                ).order_by("-sort_price")
+                products_qs = products_qs.with_price_bounds().order_by("-max_price")
+            elif sort_option in ["stock", "-stock"]:
+                # Сортировка по доступному количеству на складах
+                products_qs = products_qs.with_availability().order_by(
+                    sort_option.replace("stock", "warehouse_available"), "-created_at"
+                )
             elif sort_option in ["name", "-name", "created_at", "-created_at"]:
                 products_qs = products_qs.order_by(sort_option)
 
         # Формируем объект applied_filters
         applied_filters = {
             "search_query": search_query,
+            "corrected_query": text_query,
             "price_min": price_min,
             "price_max": price_max,
             "in_stock_only": in_stock_only,
@@ -12,7 +12,10 @@ from .models import (
     ProductVariantAttribute,
     ProductImage,  # Новая модель
     ProductStock,
-    ProductDefect
+    ProductDefect,
+    StockMovement,
+    StockReservation,
+    StockSnapshot,
 )
 
 
@@ -111,6 +114,7 @@ class ProductStockAdmin(admin.ModelAdmin):
         "quantity",
         "reserved_quantity",
         "defect_quantity",
+        "sold_quantity",
         "available_quantity",
         "is_available_for_sale",
         "last_updated",
@@ -118,10 +122,10 @@ class ProductStockAdmin(admin.ModelAdmin):
     list_filter = ("is_available_for_sale", "location")
     search_fields = ("variant__name", "variant__sku", "location__name")
     list_editable = ("is_available_for_sale",)
-    readonly_fields = ("available_quantity", "last_updated", "defect_quantity")
+    readonly_fields = ("available_quantity", "last_updated", "defect_quantity", "sold_quantity")
     fieldsets = (
         (None, {"fields": ("variant", "location")}),
-        ("Количества", {"fields": ("quantity", "reserved_quantity", "available_quantity", "defect_quantity")}),
+        ("Количества", {"fields": ("quantity", "reserved_quantity", "available_quantity", "defect_quantity", "sold_quantity")}),
         ("Настройки", {"fields": ("is_available_for_sale", "last_updated")}),
     )
 
@@ -138,6 +142,45 @@ class ProductStockAdmin(admin.ModelAdmin):
 class ProductDefectAdmin(admin.ModelAdmin):
     list_display = ("stock", "quantity", "reason", "created_at")
 
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    """Журнал только для чтения: движения создаются через marketplace.stock"""
+
+    list_display = ("stock", "kind", "quantity", "receipt", "user", "comment", "created_at")
+    list_filter = ("kind", "created_at")
+    search_fields = ("stock__variant__sku", "receipt__number", "comment")
+    list_select_related = ("stock__variant", "stock__location", "receipt", "user")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StockSnapshot)
+class StockSnapshotAdmin(admin.ModelAdmin):
+    list_display = (
+        "stock",
+        "taken_at",
+        "quantity",
+        "reserved_quantity",
+        "defect_quantity",
+        "sold_quantity",
+        "last_movement_id",
+    )
+    list_select_related = ("stock__variant", "stock__location")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 from .models import PaymentMethod, Receipt, ProductSale
 
 
@@ -189,4 +232,20 @@ class ProductSaleAdmin(admin.ModelAdmin):
     search_fields = ['variant__sku', 'receipt__number']
     autocomplete_fields = ['variant', 'location', 'receipt']
     readonly_fields = ['sale_date']
-    ordering = ['-sale_date']
\ No newline at end of file
+    ordering = ['-sale_date']
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    """Резервы создаются и снимаются через marketplace.stock"""
+
+    list_display = ("stock", "quantity", "owner", "status", "created_at", "expires_at")
+    list_filter = ("status", "created_at")
+    search_fields = ("stock__variant__sku", "comment")
+    list_select_related = ("stock__variant", "stock__location", "owner")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -6,4 +6,5 @@ class MarketplaceConfig(AppConfig):
     name = 'marketplace'
 
     def ready(self):
+        import marketplace.checks
         import marketplace.signals
\ No newline at end of file
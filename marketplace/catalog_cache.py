@@ -0,0 +1,191 @@
+"""
+Версионированный кеш ответов публичного каталога.
+
+Ключ ответа состоит из нормализованных параметров запроса и счётчиков
+версий: общего счётчика каталога, категорий и товаров. Изменение товара
+увеличивает версию товара и его категории со всеми предками (страница
+категории показывает товары подкатегорий), поэтому устаревшие ответы
+просто перестают находиться и вытесняются по таймауту, без перебора ключей.
+
+Те же версии служат валидаторами условных GET (ETag): совпадение
+проверяется до построения ответа, без запросов к товарам.
+
+Версии товаров и категорий увеличиваются после коммита из product_refresh
+(товар, варианты, остатки, изображения, атрибуты), общий счётчик —
+при изменении дерева категорий, атрибутов и бизнесов.
+
+Версии и ответы хранятся в кеше Django, общем для всех процессов:
+с локальным кешем в памяти без DEBUG предупреждает проверка marketplace.W001.
+"""
+
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.views.decorators.http import condition
+
+from .models import Category, Product
+
+VERSION_KEY = "catalog:version:{}"
+RESPONSE_KEY = "catalog:response:{}"
+CATALOG = "catalog"
+
+# Параметры, от которых зависят ответы каталога; остальные не дробят кеш
+QUERY_PARAMS = {
+    "page",
+    "per_page",
+    "cursor",
+    "with_count",
+    "sort",
+    "search",
+    "price_min",
+    "price_max",
+    "in_stock",
+    "main_only",
+}
+
+
+def category_scope(pk):
+    return f"category:{pk}"
+
+
+def product_scope(pk):
+    return f"product:{pk}"
+
+
+def _initial_version():
+    # Счётчик, вытесненный из кеша, продолжается с нового значения,
+    # а не с 1, чтобы не совпасть со старыми ключами ответов
+    return time.time_ns()
+
+
+def get_versions(scopes):
+    """Текущие версии областей каталога в порядке scopes."""
+    keys = [VERSION_KEY.format(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _initial_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_versions(scopes):
+    for scope in set(scopes):
+        key = VERSION_KEY.format(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), timeout=None)
+
+
+def invalidate_categories(category_ids):
+    """Новые версии категорий и всех их предков."""
+    category_ids = {pk for pk in category_ids if pk}
+    if not category_ids:
+        return
+    ancestors = Category.objects.get_queryset_ancestors(
+        Category.objects.filter(pk__in=category_ids), include_self=True
+    ).values_list("pk", flat=True)
+    bump_versions(category_scope(pk) for pk in ancestors)
+
+
+def invalidate_products(product_ids, category_ids=()):
+    """
+    Новые версии товаров и категорий, где они лежат сейчас;
+    category_ids — категории, где товары лежали до изменения.
+    """
+    product_ids = set(product_ids)
+    bump_versions(product_scope(pk) for pk in product_ids)
+    invalidate_categories(
+        {
+            *category_ids,
+            *Product.objects.filter(pk__in=product_ids).values_list(
+                "category_id", flat=True
+            ),
+        }
+    )
+
+
+def invalidate_catalog():
+    """Новая версия всего каталога: ответы всех страниц устаревают."""
+    bump_versions([CATALOG])
+
+
+def normalize_query(request):
+    """
+    Параметры запроса, влияющие на ответ, в каноническом виде:
+    ключи и значения отсортированы, пустые значения отброшены.
+    """
+    items = []
+    for key in sorted(request.GET):
+        if key not in QUERY_PARAMS and not key.startswith("attr_"):
+            continue
+        values = sorted(value for value in request.GET.getlist(key) if value)
+        items.extend(f"{key}={value}" for value in values)
+    return "&".join(items)
+
+
+def cache_timeout():
+    """Время жизни ответа в секундах; 0 — кеш ответов выключен."""
+    return getattr(settings, "CATALOG_RESPONSE_CACHE_TIMEOUT", 600)
+
+
+def response_key(name, request, scopes):
+    """Ключ ответа представления name для запроса и текущих версий областей."""
+    scopes = [CATALOG, *scopes]
+    versions = get_versions(scopes)
+    raw = "|".join(
+        [
+            name,
+            normalize_query(request),
+            *(f"{scope}={version}" for scope, version in zip(scopes, versions)),
+        ]
+    )
+    return RESPONSE_KEY.format(hashlib.sha1(raw.encode()).hexdigest())
+
+
+def cached_data(name, request, scopes, build):
+    """Данные ответа из кеша или из build() с сохранением в кеш."""
+    timeout = cache_timeout()
+    if not timeout:
+        return build()
+    key = response_key(name, request, scopes)
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, timeout)
+    return data
+
+
+def catalog_etag(request, *parts):
+    """
+    ETag из версий каталога без рендеринга ответа. Accept входит в ETag:
+    по одному адресу отдаются JSON и browsable API.
+    """
+    raw = "|".join([request.META.get("HTTP_ACCEPT", ""), *map(str, parts)])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def catalog_condition(etag_func):
+    """
+    condition(etag_func=...) для представлений каталога. ETag получают
+    только успешные ответы: ошибка 400/404 не описывается версиями
+    каталога, и подтверждать её через 304 нельзя.
+    """
+
+    def decorator(view):
+        conditional_view = condition(etag_func=etag_func)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if response.status_code >= 400:
+                del response["ETag"]
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,31 @@
+"""
+Проверки конфигурации маркетплейса (manage.py check, запуск сервера и тестов).
+"""
+
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Кеши, которые видит только текущий процесс
+LOCAL_CACHE_BACKENDS = {"django.core.cache.backends.locmem.LocMemCache"}
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Версии кеша ответов каталога и поколения индексов в памяти передаются
+    между процессами через кеш Django. С локальным кешем каждый воркер видит
+    только свои изменения и отдаёт устаревшие ответы. Предупреждение, а не
+    ошибка: в одном процессе (тесты, единственный воркер) такой кеш корректен.
+    """
+    backend = settings.CACHES.get("default", {}).get("BACKEND")
+    if settings.DEBUG or backend not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [
+        Warning(
+            "Кеш по умолчанию локален для процесса: версии каталога и поколения "
+            "индексов не передаются между воркерами.",
+            hint="Настройте общий кеш в CACHES (Redis или Memcached).",
+            obj="CACHES",
+            id="marketplace.W001",
+        )
+    ]
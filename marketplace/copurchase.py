@@ -0,0 +1,201 @@
+"""
+«Покупают вместе»: счётчики совместных покупок по чекам.
+
+Построитель инкрементальный: обрабатывает только чеки после последнего
+учтённого (CoPurchaseProgress) пачками, для каждой пачки считает пары
+товаров и вариантов в памяти (разреженный Counter по парам из одного
+чека) и прибавляет их к сохранённым счётчикам одним upsert. Свежие чеки
+берутся с задержкой, чтобы не пропустить чек с меньшим id из ещё
+не завершённой транзакции. Удаление чека задним числом счётчики
+не уменьшает — для этого есть полный пересчёт (rebuild=True).
+"""
+
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import combinations
+
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .catalog_cache import bump_versions, product_scope
+from .models import (
+    CoPurchaseProgress,
+    ProductCoPurchase,
+    ProductSale,
+    ProductVariant,
+    Receipt,
+    VariantCoPurchase,
+)
+from .stock import resolve_availability
+
+# Чеков за один проход
+BATCH_SIZE = 1000
+# Чеки моложе стольких минут ждут следующего запуска
+SETTLE_MINUTES = 5
+# Из больших чеков берётся не больше стольких позиций (число пар растёт квадратично)
+MAX_BASKET_ITEMS = 50
+
+
+def count_pairs(baskets):
+    """Число корзин с каждой неупорядоченной парой позиций: {(a, b): n}, a < b."""
+    pairs = Counter()
+    for items in baskets:
+        pairs.update(combinations(sorted(items)[:MAX_BASKET_ITEMS], 2))
+    return pairs
+
+
+def _add_pairs(model, owner, pairs):
+    """Прибавляет пары к счётчикам model в обе стороны одним upsert."""
+    deltas = Counter()
+    for (first, second), receipts in pairs.items():
+        deltas[(first, second)] += receipts
+        deltas[(second, first)] += receipts
+    if not deltas:
+        return
+
+    existing = {
+        (owner_id, companion_id): receipts
+        for owner_id, companion_id, receipts in model.objects.filter(
+            **{f"{owner}_id__in": {pair[0] for pair in deltas}},
+            companion_id__in={pair[1] for pair in deltas},
+        ).values_list(f"{owner}_id", "companion_id", "receipts")
+    }
+    rows = [
+        model(
+            **{f"{owner}_id": owner_id},
+            companion_id=companion_id,
+            receipts=existing.get((owner_id, companion_id), 0) + receipts,
+        )
+        for (owner_id, companion_id), receipts in deltas.items()
+    ]
+    # MySQL не принимает unique_fields: ON DUPLICATE KEY срабатывает по любому ключу
+    unique_fields = (
+        [owner, "companion"]
+        if connection.features.supports_update_conflicts_with_target
+        else None
+    )
+    model.objects.bulk_create(
+        rows,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=["receipts"],
+    )
+
+
+def _process_batch(progress, batch_size, settled_before):
+    """Учитывает следующую пачку чеков. Возвращает (чеков, id затронутых товаров)."""
+    receipt_ids = list(
+        Receipt.objects.filter(
+            pk__gt=progress.last_receipt_id, created_at__lte=settled_before
+        )
+        .order_by("pk")
+        .values_list("pk", flat=True)[:batch_size]
+    )
+    if not receipt_ids:
+        return 0, set()
+
+    products = defaultdict(set)
+    variants = defaultdict(set)
+    for receipt_id, variant_id, product_id in ProductSale.objects.filter(
+        receipt_id__in=receipt_ids, receipt__is_deleted=False
+    ).values_list("receipt_id", "variant_id", "variant__product_id"):
+        products[receipt_id].add(product_id)
+        variants[receipt_id].add(variant_id)
+
+    product_pairs = count_pairs(products.values())
+    _add_pairs(ProductCoPurchase, "product", product_pairs)
+    _add_pairs(VariantCoPurchase, "variant", count_pairs(variants.values()))
+
+    progress.last_receipt_id = receipt_ids[-1]
+    progress.save(update_fields=["last_receipt_id", "updated_at"])
+    return len(receipt_ids), {pk for pair in product_pairs for pk in pair}
+
+
+def update_co_purchases(batch_size=BATCH_SIZE, rebuild=False, now=None):
+    """
+    Учитывает новые чеки. rebuild=True стирает счётчики и считает заново.
+    Каждая пачка — отдельная транзакция под блокировкой строки прогресса,
+    поэтому параллельный запуск ждёт, а не считает чеки дважды.
+    Возвращает число обработанных чеков.
+    """
+    settled_before = (now or timezone.now()) - timedelta(minutes=SETTLE_MINUTES)
+    CoPurchaseProgress.objects.get_or_create(pk=1)
+
+    if rebuild:
+        with transaction.atomic():
+            CoPurchaseProgress.objects.select_for_update().filter(pk=1).update(
+                last_receipt_id=0
+            )
+            ProductCoPurchase.objects.all().delete()
+            VariantCoPurchase.objects.all().delete()
+
+    processed = 0
+    while True:
+        with transaction.atomic():
+            progress = CoPurchaseProgress.objects.select_for_update().get(pk=1)
+            receipts, product_ids = _process_batch(progress, batch_size, settled_before)
+        # Блок «покупают вместе» в карточках товаров устарел
+        bump_versions(product_scope(pk) for pk in product_ids)
+        processed += receipts
+        if receipts < batch_size:
+            return processed
+
+
+def bought_together(product, limit=8):
+    """
+    Товары маркетплейса, которые чаще всего покупают вместе с товаром.
+    Для скрытого с маркетплейса товара блок пуст.
+    """
+    if not (product.is_active and product.is_visible_on_marketplace):
+        return []
+    return [
+        link.companion
+        for link in ProductCoPurchase.objects.filter(
+            product=product,
+            companion__is_active=True,
+            companion__is_visible_on_marketplace=True,
+        )
+        .select_related("companion")
+        .order_by("-receipts")[:limit]
+    ]
+
+
+def upsell_variants(variant_ids, business, limit=5):
+    """
+    Варианты бизнеса, которые чаще всего покупают вместе с вариантами
+    из чека, кроме уже добавленных, с остатками на складах.
+    Возвращает список словарей для кассы.
+    """
+    scores = list(
+        VariantCoPurchase.objects.filter(
+            variant_id__in=variant_ids, companion__product__business=business
+        )
+        .exclude(companion_id__in=variant_ids)
+        .values("companion_id")
+        .annotate(score=Sum("receipts"))
+        .order_by("-score")[:limit]
+    )
+    companions = ProductVariant.objects.select_related("product").in_bulk(
+        [row["companion_id"] for row in scores]
+    )
+    availability = resolve_availability(list(companions))
+
+    suggestions = []
+    for row in scores:
+        variant = companions[row["companion_id"]]
+        suggestions.append(
+            {
+                "variant_id": variant.id,
+                "product_id": variant.product_id,
+                "name": variant.name,
+                "sku": variant.sku,
+                "barcode": variant.barcode,
+                "price": variant.price,
+                "current_price": variant.current_price,
+                "available": availability.available(variant.id),
+                "receipts_together": row["score"],
+            }
+        )
+    return suggestions
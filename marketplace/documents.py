@@ -1,25 +1,76 @@
-# from django_elasticsearch_dsl import Document, fields
-# from django_elasticsearch_dsl.registries import registry
-# from .models import Product
-
-# @registry.register_document
-# class ProductDocument(Document):
-#     class Index:
-#         name = 'products'
-#         settings = {
-#             'number_of_shards': 1,
-#             'number_of_replicas': 0
-#         }
-    
-#     # Определите поля для поиска
-#     name = fields.TextField(attr='name')
-#     description = fields.TextField(attr='description')
-#     # Если вам нужны еще поля для поиска, добавьте их здесь
-    
-#     class Django:
-#         model = Product
-#         fields = [
-#             'id',
-#             # другие поля, которые нужно включить в результаты
-#         ]
-# Добавить elastick search
\ No newline at end of file
+"""
+Индекс товаров в Elasticsearch для ElasticsearchSearchBackend.
+
+Документы не регистрируются в django_elasticsearch_dsl: их содержимое
+собирает marketplace.search.build_documents, а обновляются они пачками
+из очереди SearchOutbox (marketplace.search.drain_outbox).
+"""
+
+from django.conf import settings
+
+# Настройки индекса: русский стемминг, название весит больше текста (NAME_BOOST)
+INDEX_SETTINGS = {
+    "number_of_shards": 1,
+    "number_of_replicas": 0,
+}
+INDEX_MAPPINGS = {
+    "properties": {
+        "name": {"type": "text", "analyzer": "russian"},
+        "body": {"type": "text", "analyzer": "russian"},
+    }
+}
+NAME_BOOST = 3
+
+
+class ProductIndex:
+    """Индекс товаров: поиск, пакетное обновление и пересоздание."""
+
+    def __init__(self):
+        from elasticsearch import Elasticsearch
+
+        config = settings.ELASTICSEARCH_DSL["default"]
+        self.client = Elasticsearch(**config)
+        self.name = getattr(settings, "MARKETPLACE_SEARCH_INDEX", "products")
+
+    def search(self, query, limit):
+        """id товаров по убыванию релевантности."""
+        response = self.client.search(
+            index=self.name,
+            query={
+                "multi_match": {
+                    "query": query,
+                    "type": "bool_prefix",
+                    "operator": "and",
+                    "fields": [f"name^{NAME_BOOST}", "body"],
+                }
+            },
+            size=limit,
+            source=False,
+        )
+        return [int(hit["_id"]) for hit in response["hits"]["hits"]]
+
+    def bulk_index(self, documents, deleted=()):
+        """Записывает ProductSearchDocument и удаляет документы deleted одним bulk."""
+        from elasticsearch.helpers import bulk
+
+        actions = [
+            {
+                "_index": self.name,
+                "_id": document.product_id,
+                "_source": {"name": document.name, "body": document.body},
+            }
+            for document in documents
+        ]
+        actions.extend(
+            {"_op_type": "delete", "_index": self.name, "_id": pk} for pk in deleted
+        )
+        if actions:
+            # Удаление отсутствующего документа — не ошибка
+            bulk(self.client, actions, raise_on_error=False)
+
+    def recreate(self):
+        """Пересоздаёт пустой индекс с актуальными настройками."""
+        self.client.indices.delete(index=self.name, ignore_unavailable=True)
+        self.client.indices.create(
+            index=self.name, settings=INDEX_SETTINGS, mappings=INDEX_MAPPINGS
+        )
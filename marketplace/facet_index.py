@@ -0,0 +1,451 @@
+"""
+Инвертированный индекс фасетов категории в памяти процесса.
+
+Для поддерева категории товары нумеруются подряд, и каждому значению
+фильтруемого атрибута (AttributeValue или нормализованному произвольному
+тексту) соответствует битовая маска товаров — целое число Python.
+Фильтр по атрибутам — AND/OR масок, количество для значения фасета —
+popcount пересечения, поэтому горячий запрос каталога не обращается
+к ProductVariantAttribute вовсе.
+
+Индексы строятся лениво при первом запросе категории и не изменяются:
+обновление создаёт новый экземпляр, который заменяет старый в реестре.
+Индекс категории собирает один поток, остальные тем временем отвечают
+по прежнему экземпляру.
+Изменения между процессами передаются через кеш Django: product_refresh
+после пересчёта товаров увеличивает счётчик поколения и записывает
+набор изменённых товаров, а каждый процесс при чтении индекса догоняет
+поколение, перечитывая только эти товары. Если журнал изменений
+потерян или отстал слишком сильно, индекс строится заново. Поэтому кеш
+Django должен быть общим для процессов (CACHES в настройках). Индекс
+старше FACET_INDEX_MAX_AGE строится заново, даже если сигнал об изменении
+был пропущен (правка в обход ORM, недоступный кеш).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+
+from .facets import attribute_facets
+from .models import CategoryAttribute, Product, ProductVariant, ProductVariantAttribute
+
+GENERATION_KEY = "facet_index:generation"
+CHANGES_KEY = "facet_index:changes:{}"
+# Сколько живёт запись журнала изменений (секунды)
+CHANGES_TIMEOUT = 60 * 60
+# Запись журнала «сбросить все индексы» (изменились атрибуты или дерево категорий)
+RESET = "reset"
+# Больше стольких поколений не догоняем — дешевле построить заново
+MAX_CATCH_UP = 200
+
+_lock = threading.Lock()
+_indexes = OrderedDict()
+# Категория -> блокировка её сборки: индекс категории собирает один поток
+_build_locks = {}
+
+
+def normalize_custom_value(value):
+    """Ключ произвольного значения: без лишних пробелов и регистра."""
+    return " ".join(value.split()).casefold()
+
+
+def _to_bits(positions, size):
+    """Маска из номеров товаров; собирается в bytearray, а не сдвигами int."""
+    buffer = bytearray((size >> 3) + 1)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def _positions(bits):
+    """Номера установленных битов маски по возрастанию."""
+    digits = bin(bits)[:1:-1]
+    positions = []
+    position = digits.find("1")
+    while position != -1:
+        positions.append(position)
+        position = digits.find("1", position + 1)
+    return positions
+
+
+def current_generation():
+    return cache.get(GENERATION_KEY, 0)
+
+
+def publish_changes(product_ids=None):
+    """
+    Сообщает индексам всех процессов об изменении товаров.
+    product_ids=None — индексы нужно построить заново.
+    """
+    try:
+        generation = cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, 0, timeout=None)
+        generation = cache.incr(GENERATION_KEY)
+    changes = RESET if product_ids is None else sorted(product_ids)
+    cache.set(CHANGES_KEY.format(generation), changes, CHANGES_TIMEOUT)
+
+
+def changed_products(since, generation):
+    """
+    id товаров, изменённых после поколения since до generation включительно,
+    по журналу изменений. None — журнал потерян, отстал слишком сильно
+    или содержит сброс: читателю нужно построить данные заново.
+    """
+    behind = generation - since
+    if behind <= 0 or behind > MAX_CATCH_UP:
+        return None
+
+    keys = [CHANGES_KEY.format(number) for number in range(since + 1, generation + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) != len(keys) or RESET in changes.values():
+        return None
+
+    product_ids = set()
+    for ids in changes.values():
+        product_ids.update(ids)
+    return product_ids
+
+
+def reset_facet_indexes():
+    """Забывает индексы текущего процесса."""
+    with _lock:
+        _indexes.clear()
+
+
+class FacetIndex:
+    """Неизменяемый индекс фасетов поддерева одной категории."""
+
+    def __init__(self, category, category_ids, generation):
+        self.category = category
+        self.category_ids = category_ids
+        self.generation = generation
+        # Время полной сборки; обновления по журналу его не продлевают
+        self.built_at = time.monotonic()
+        # Номер товара в масках -> id товара и обратно
+        self.product_ids = []
+        self.positions = {}
+        # Товары, которые показывает маркетплейс в категории
+        self.eligible = 0
+        # (attribute_id, value_id, нормализованный текст) -> маска товаров
+        self.values = {}
+        # Подписи значений и атрибутов для ответа
+        self.labels = {}
+        self.attributes = {}
+        self.required = {}
+
+    @classmethod
+    def build(cls, category, generation=None):
+        if generation is None:
+            generation = current_generation()
+        category_ids = frozenset(
+            category.get_descendants(include_self=True).values_list("pk", flat=True)
+        )
+        index = cls(category, category_ids, generation)
+        index._load(product_ids=None, values={})
+        return index
+
+    def updated(self, product_ids, generation):
+        """Новый индекс, в котором товары product_ids перечитаны из базы."""
+        index = FacetIndex(self.category, self.category_ids, generation)
+        index.built_at = self.built_at
+        index.product_ids = list(self.product_ids)
+        index.positions = dict(self.positions)
+        index.labels = dict(self.labels)
+        index.attributes = dict(self.attributes)
+
+        stale = _to_bits(
+            (self.positions[pk] for pk in product_ids if pk in self.positions),
+            len(self.product_ids),
+        )
+        keep = ~stale
+        values = {key: bits & keep for key, bits in self.values.items()}
+        index.eligible = self.eligible & keep
+        index._load(product_ids=product_ids, values=values)
+        return index
+
+    def _load(self, product_ids, values):
+        """Читает товары (все или product_ids) и их атрибуты, дополняя маски."""
+        products = Product.objects.filter(category_id__in=self.category_ids)
+        rows = ProductVariantAttribute.objects.filter(
+            variant__product__category_id__in=self.category_ids,
+            category_attribute__attribute__is_filterable=True,
+        ).exclude(predefined_value__isnull=True, custom_value__isnull=True)
+        if product_ids is not None:
+            products = products.filter(pk__in=product_ids)
+            rows = rows.filter(variant__product_id__in=product_ids)
+
+        products = products.annotate(
+            has_visible_variants=Exists(
+                ProductVariant.objects.filter(product=OuterRef("pk"), show_this=True)
+            )
+        ).order_by("pk")
+
+        eligible = []
+        for pk, is_active, is_visible, has_visible_variants in products.values_list(
+            "pk", "is_active", "is_visible_on_marketplace", "has_visible_variants"
+        ):
+            if pk not in self.positions:
+                self.positions[pk] = len(self.product_ids)
+                self.product_ids.append(pk)
+            if is_active and is_visible and has_visible_variants:
+                eligible.append(self.positions[pk])
+
+        found = {}
+        for (
+            product_id,
+            attribute_id,
+            attribute_name,
+            has_predefined_values,
+            value_id,
+            value,
+            color_code,
+            display_order,
+            custom_value,
+        ) in rows.values_list(
+            "variant__product_id",
+            "category_attribute__attribute_id",
+            "category_attribute__attribute__name",
+            "category_attribute__attribute__has_predefined_values",
+            "predefined_value_id",
+            "predefined_value__value",
+            "predefined_value__color_code",
+            "predefined_value__display_order",
+            "custom_value",
+        ):
+            position = self.positions.get(product_id)
+            if position is None:
+                continue
+            if value_id:
+                key = (attribute_id, value_id, None)
+                label = {
+                    "value": value,
+                    "color_code": color_code,
+                    "order": (0, display_order, value),
+                }
+            else:
+                # Произвольный текст учитывается только у строк без предопределённого значения
+                normalized = normalize_custom_value(custom_value)
+                if not normalized:
+                    continue
+                key = (attribute_id, None, normalized)
+                label = {
+                    "value": custom_value,
+                    "color_code": None,
+                    "order": (1, 0, custom_value),
+                }
+            self.labels.setdefault(key, label)
+            self.attributes[attribute_id] = {
+                "name": attribute_name,
+                "has_predefined_values": has_predefined_values,
+            }
+            found.setdefault(key, []).append(position)
+
+        size = len(self.product_ids)
+        for key, positions in found.items():
+            values[key] = values.get(key, 0) | _to_bits(positions, size)
+        self.values = values
+        self.eligible |= _to_bits(eligible, size)
+        self.required = dict(
+            CategoryAttribute.objects.filter(category=self.category).values_list(
+                "attribute_id", "required"
+            )
+        )
+
+    def bits_for(self, product_ids):
+        """Маска товаров из набора id (товары вне индекса пропускаются)."""
+        return _to_bits(
+            (self.positions[pk] for pk in product_ids if pk in self.positions),
+            len(self.product_ids),
+        )
+
+    def ids_for(self, bits):
+        return [self.product_ids[position] for position in _positions(bits)]
+
+    def _match(self, attribute_id, value_ids, custom_values):
+        """Маска товаров с любым из выбранных значений атрибута."""
+        bits = 0
+        for value_id in value_ids:
+            bits |= self.values.get((attribute_id, value_id, None), 0)
+        for custom_value in custom_values:
+            bits |= self.values.get(
+                (attribute_id, None, normalize_custom_value(custom_value)), 0
+            )
+        return bits
+
+    def filter(self, base, selections):
+        """Маска товаров base, подходящих под выбор по всем атрибутам."""
+        for attribute_id, (value_ids, custom_values) in selections.items():
+            base &= self._match(attribute_id, value_ids, custom_values)
+        return base
+
+    def facets(self, base, selections):
+        """
+        Дизъюнктивные фасеты товаров base в формате facets.attribute_facets:
+        значения атрибута считаются с выбором по всем атрибутам, кроме него самого.
+        """
+        matches = {
+            attribute_id: self._match(attribute_id, *values)
+            for attribute_id, values in selections.items()
+        }
+
+        def all_except(skip):
+            bits = base
+            for attribute_id, match in matches.items():
+                if attribute_id != skip:
+                    bits &= match
+            return bits
+
+        selected_custom = {
+            attribute_id: {normalize_custom_value(value) for value in custom_values}
+            for attribute_id, (_, custom_values) in selections.items()
+        }
+        masks = {}
+        full = all_except(None)
+        filters = {}
+        for key, bits in self.values.items():
+            attribute_id, value_id, normalized = key
+            if attribute_id not in masks:
+                masks[attribute_id] = (
+                    all_except(attribute_id) if attribute_id in matches else full
+                )
+            count = (bits & masks[attribute_id]).bit_count()
+
+            if value_id:
+                selected = value_id in selections.get(attribute_id, ((), ()))[0]
+            else:
+                selected = normalized in selected_custom.get(attribute_id, ())
+            if not count and not selected:
+                continue
+
+            attribute = self.attributes[attribute_id]
+            label = self.labels[key]
+            facet = filters.setdefault(
+                attribute_id,
+                {
+                    "id": attribute_id,
+                    "name": attribute["name"],
+                    "type": "choice",
+                    "has_predefined_values": attribute["has_predefined_values"],
+                    "required": self.required.get(attribute_id, False),
+                    "values": [],
+                },
+            )
+            facet["values"].append(
+                (
+                    label["order"],
+                    {
+                        "id": value_id,
+                        "value": label["value"],
+                        "color_code": label["color_code"],
+                        "attribute_name": attribute["name"],
+                        "count": count,
+                        "selected": selected,
+                    },
+                )
+            )
+
+        result = []
+        for facet in filters.values():
+            ordered = sorted(facet["values"], key=lambda item: item[0])
+            facet["values"] = [value for _, value in ordered]
+            result.append(facet)
+        return sorted(result, key=lambda facet: facet["name"])
+
+    def expired(self):
+        max_age = getattr(settings, "FACET_INDEX_MAX_AGE", 600)
+        return bool(max_age) and time.monotonic() - self.built_at > max_age
+
+    def caught_up(self, generation):
+        """Индекс на поколение generation: догоняет журнал изменений или строится заново."""
+        product_ids = changed_products(self.generation, generation)
+        if product_ids is None:
+            return FacetIndex.build(self.category, generation)
+        return self.updated(product_ids, generation)
+
+
+def _fresh(index, generation):
+    return index is not None and index.generation == generation and not index.expired()
+
+
+def get_facet_index(category):
+    """
+    Актуальный индекс фасетов поддерева категории для текущего процесса.
+    Собирает его один поток; остальные, пока идёт сборка, отвечают
+    по прежнему индексу категории и ждут только первую её сборку.
+    """
+    generation = current_generation()
+    with _lock:
+        current = _indexes.get(category.pk)
+        if current is not None:
+            _indexes.move_to_end(category.pk)
+        build_lock = _build_locks.setdefault(category.pk, threading.Lock())
+    if _fresh(current, generation):
+        return current
+    if not build_lock.acquire(blocking=current is None):
+        return current
+    try:
+        # Пока ждали блокировку, индекс мог собрать другой поток
+        with _lock:
+            current = _indexes.get(category.pk)
+        if _fresh(current, generation):
+            return current
+        if current is None or current.expired():
+            index = FacetIndex.build(category, generation)
+        else:
+            index = current.caught_up(generation)
+
+        with _lock:
+            # reset_facet_indexes мог сбросить индекс во время сборки
+            installed = _indexes.get(category.pk)
+            if (
+                installed is None
+                or installed is current
+                or installed.generation <= index.generation
+            ):
+                _indexes[category.pk] = index
+                _indexes.move_to_end(category.pk)
+            while len(_indexes) > getattr(settings, "FACET_INDEX_MAX_CATEGORIES", 32):
+                _indexes.popitem(last=False)
+    finally:
+        build_lock.release()
+    return index
+
+
+def filter_with_facets(category, products_qs, selections, narrowed=True):
+    """
+    Применяет выбор по атрибутам к products_qs и считает фасеты по индексу категории.
+    products_qs — товары маркетплейса категории после фильтров, кроме атрибутных;
+    narrowed=False означает, что других фильтров нет и маска товаров берётся
+    из индекса без запроса. Возвращает (queryset, фильтры).
+    """
+    if not getattr(settings, "FACET_INDEX_ENABLED", True):
+        from .ProductsSet import ProductSet
+
+        return (
+            ProductSet.filter_by_attributes(products_qs, selections),
+            attribute_facets(products_qs, selections=selections),
+        )
+
+    index = get_facet_index(category)
+    if narrowed:
+        base = index.bits_for(products_qs.values_list("pk", flat=True))
+    else:
+        base = index.eligible
+
+    filters = index.facets(base, selections)
+    if selections:
+        matched = index.filter(base, selections)
+        if matched.bit_count() > getattr(settings, "FACET_INDEX_MAX_IDS", 1000):
+            from .ProductsSet import ProductSet
+
+            # Огромный IN (...) дороже, чем EXISTS по атрибутам
+            products_qs = ProductSet.filter_by_attributes(products_qs, selections)
+        else:
+            # Условия queryset сохраняются: индекс лишь сужает набор по атрибутам
+            products_qs = products_qs.filter(pk__in=index.ids_for(matched))
+    return products_qs, filters
@@ -0,0 +1,254 @@
+"""
+Фасеты каталога: значения фильтруемых атрибутов с количеством товаров.
+
+Фасеты дизъюнктивные: количество для значения атрибута считается с учётом
+выбора по всем остальным атрибутам, но без выбора по самому атрибуту —
+так пользователь видит, сколько товаров добавит соседнее значение.
+Все значения всех атрибутов считаются одним сгруппированным запросом
+по ProductVariantAttribute (плюс запрос обязательности для категории).
+
+Гистограмма цен для слайдера — тоже один запрос: границы берутся
+некоррелированными подзапросами, а товары группируются по корзине.
+"""
+
+from django.db.models import (
+    Case,
+    CharField,
+    Count,
+    Exists,
+    F,
+    IntegerField,
+    Max,
+    Min,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Floor, Least
+
+from .models import CategoryAttribute, ProductVariantAttribute
+
+# Число корзин гистограммы цен
+PRICE_HISTOGRAM_BUCKETS = 20
+
+
+def selection_exists(attribute_id, value_ids=(), custom_values=()):
+    """EXISTS по варианту товара (OuterRef на товар) с выбранным значением атрибута."""
+    condition = Q()
+    if value_ids:
+        condition |= Q(predefined_value_id__in=value_ids)
+    if custom_values:
+        condition |= Q(custom_value__in=custom_values)
+    return Exists(
+        ProductVariantAttribute.objects.filter(
+            condition,
+            variant__product=OuterRef("variant__product"),
+            category_attribute__attribute_id=attribute_id,
+        )
+    )
+
+
+def _count_filter(selections):
+    """
+    Условие для Count по строкам атрибутов: строка атрибута A учитывается,
+    если товар подходит под выбор всех атрибутов, кроме A.
+    """
+    if not selections:
+        return None
+
+    matches = {
+        attribute_id: selection_exists(attribute_id, *values)
+        for attribute_id, values in selections.items()
+    }
+
+    def all_except(skip):
+        condition = Q()
+        for attribute_id, exists in matches.items():
+            if attribute_id != skip:
+                condition &= exists
+        return condition
+
+    condition = Q(
+        all_except(None), ~Q(category_attribute__attribute_id__in=list(matches))
+    )
+    for attribute_id in matches:
+        condition |= Q(
+            all_except(attribute_id), category_attribute__attribute_id=attribute_id
+        )
+    return condition
+
+
+def attribute_facets(products_qs, selections=None, category=None):
+    """
+    Значения фильтруемых атрибутов товаров products_qs с количеством товаров.
+    products_qs — товары после всех фильтров, кроме атрибутных;
+    selections — {attribute_id: (id значений, произвольные значения)}.
+    Возвращает список фильтров в формате ProductSet.get_filters_by_products.
+    """
+    selections = {
+        attribute_id: values
+        for attribute_id, values in (selections or {}).items()
+        if values[0] or values[1]
+    }
+
+    rows = (
+        ProductVariantAttribute.objects.filter(
+            variant__product__in=products_qs.order_by().values("pk"),
+            category_attribute__attribute__is_filterable=True,
+        )
+        .exclude(predefined_value__isnull=True, custom_value__isnull=True)
+        .exclude(predefined_value__isnull=True, custom_value="")
+        # Произвольный текст учитывается только у строк без предопределённого значения
+        .annotate(
+            facet_custom_value=Case(
+                When(predefined_value__isnull=True, then=F("custom_value")),
+                default=Value(None),
+                output_field=CharField(),
+            )
+        )
+        .values(
+            "category_attribute__attribute_id",
+            "category_attribute__attribute__name",
+            "category_attribute__attribute__has_predefined_values",
+            "predefined_value_id",
+            "predefined_value__value",
+            "predefined_value__color_code",
+            "predefined_value__display_order",
+            "facet_custom_value",
+        )
+        .annotate(
+            count=Count("variant__product", distinct=True, filter=_count_filter(selections))
+        )
+        .order_by()
+    )
+
+    required = {}
+    if category is not None:
+        required = dict(
+            CategoryAttribute.objects.filter(category=category).values_list(
+                "attribute_id", "required"
+            )
+        )
+
+    filters = {}
+    for row in rows:
+        attribute_id = row["category_attribute__attribute_id"]
+        value_ids, custom_values = selections.get(attribute_id, ((), ()))
+        if row["predefined_value_id"]:
+            value = {
+                "id": row["predefined_value_id"],
+                "value": row["predefined_value__value"],
+                "color_code": row["predefined_value__color_code"],
+            }
+            selected = row["predefined_value_id"] in value_ids
+            order = (0, row["predefined_value__display_order"], value["value"])
+        else:
+            value = {
+                "id": None,
+                "value": row["facet_custom_value"],
+                "color_code": None,
+            }
+            selected = row["facet_custom_value"] in custom_values
+            order = (1, 0, value["value"])
+        if not row["count"] and not selected:
+            continue
+
+        facet = filters.setdefault(
+            attribute_id,
+            {
+                "id": attribute_id,
+                "name": row["category_attribute__attribute__name"],
+                "type": "choice",
+                "has_predefined_values": row[
+                    "category_attribute__attribute__has_predefined_values"
+                ],
+                "required": required.get(attribute_id, False),
+                "values": [],
+            },
+        )
+        facet["values"].append(
+            (
+                order,
+                {
+                    **value,
+                    "attribute_name": facet["name"],
+                    "count": row["count"],
+                    "selected": selected,
+                },
+            )
+        )
+
+    result = []
+    for facet in filters.values():
+        ordered = sorted(facet["values"], key=lambda item: item[0])
+        facet["values"] = [value for _, value in ordered]
+        result.append(facet)
+    return sorted(result, key=lambda facet: facet["name"])
+
+
+def price_histogram(products_qs, buckets=PRICE_HISTOGRAM_BUCKETS):
+    """
+    Распределение товаров products_qs по цене со скидкой для слайдера:
+    товар попадает в корзину своей минимальной цены, границы слайдера —
+    от минимальной до максимальной цены товаров. products_qs — товары
+    после всех фильтров, кроме цены, чтобы слайдер показывал весь диапазон.
+    """
+    products = products_qs.order_by().filter(min_effective_price__isnull=False)
+    bounds = products.annotate(group=Value(1)).values("group")
+    low = Subquery(bounds.annotate(value=Min("min_effective_price")).values("value"))
+    high = Subquery(bounds.annotate(value=Max("max_effective_price")).values("value"))
+
+    rows = (
+        products.annotate(low=low, high=high)
+        .annotate(
+            bucket=Case(
+                When(high=F("low"), then=Value(0)),
+                default=Least(
+                    Cast(
+                        Floor(
+                            (F("min_effective_price") - F("low"))
+                            * buckets
+                            / (F("high") - F("low"))
+                        ),
+                        IntegerField(),
+                    ),
+                    Value(buckets - 1),
+                ),
+                output_field=IntegerField(),
+            )
+        )
+        .values("bucket")
+        .annotate(count=Count("pk"), low_bound=Max("low"), high_bound=Max("high"))
+        .order_by("bucket")
+    )
+
+    counts = {}
+    low_value = high_value = None
+    for row in rows:
+        counts[int(row["bucket"])] = row["count"]
+        low_value, high_value = row["low_bound"], row["high_bound"]
+    if low_value is None:
+        return {"min": None, "max": None, "buckets": []}
+
+    low_value, high_value = float(low_value), float(high_value)
+    width = (high_value - low_value) / buckets
+    if not width:
+        return {
+            "min": low_value,
+            "max": high_value,
+            "buckets": [{"from": low_value, "to": high_value, "count": counts.get(0, 0)}],
+        }
+    return {
+        "min": low_value,
+        "max": high_value,
+        "buckets": [
+            {
+                "from": round(low_value + width * number, 2),
+                "to": round(low_value + width * (number + 1), 2),
+                "count": counts.get(number, 0),
+            }
+            for number in range(buckets)
+        ],
+    }
@@ -0,0 +1,105 @@
+"""
+Read-model списка товаров (ProductListing).
+
+Строка хранит всё, что нужно карточке в каталоге, поэтому списки
+маркетплейса и бизнеса читают одну таблицу вместо вариантов, остатков
+и изображений каждого товара. Строки пересобираются пачкой по id товаров:
+после коммита из product_refresh и командой rebuild_listings.
+"""
+
+from django.db import connection
+from django.db.models import F
+
+from .models import Product, ProductListing
+from .serializers import ProductImageSerializer, ProductVariantSerializer
+from .stock import resolve_product_availability
+
+# Колонки, перезаписываемые при пересборке строки
+LISTING_FIELDS = [
+    field.name
+    for field in ProductListing._meta.concrete_fields
+    if not field.primary_key
+]
+
+# Параметр sort -> порядок строк каталога
+LISTING_ORDERING = {
+    "-created_at": ("-created_at", "-product_id"),
+    "created_at": ("created_at", "product_id"),
+    "name": ("name", "product_id"),
+    "-name": ("-name", "-product_id"),
+    "price": (F("min_price").asc(nulls_last=True), "product_id"),
+    "-price": (F("max_price").desc(nulls_last=True), "-product_id"),
+    "stock": ("available_quantity", "-created_at", "-product_id"),
+    "-stock": ("-available_quantity", "-created_at", "-product_id"),
+}
+
+
+def _listing_products(product_ids):
+    from .ProductsSet import ProductSet
+
+    return (
+        Product.objects.filter(pk__in=product_ids)
+        .select_related("category", "business")
+        .prefetch_related(*ProductSet.list_prefetches())
+    )
+
+
+def build_listing(product, availability):
+    """Несохранённая строка каталога для товара с предзагруженными данными."""
+    variants = product.visible_variants
+    available = product._available_variants(availability)
+    prices = [v.effective_price for v in available]
+    main_image = product.main_image
+
+    default_variant = ProductVariantSerializer(
+        available[0] if available else None, context={"availability": availability}
+    ).data
+
+    return ProductListing(
+        product=product,
+        business_id=product.business_id,
+        category_id=product.category_id,
+        name=product.name,
+        description=product.description,
+        category_name=product.category.name if product.category else "",
+        business_name=product.business.name,
+        is_active=product.is_active,
+        is_visible_on_marketplace=product.is_visible_on_marketplace,
+        is_visible_on_own_site=product.is_visible_on_own_site,
+        has_visible_variants=bool(variants),
+        in_stock=bool(available),
+        available_quantity=sum(availability.available(v.id) for v in variants),
+        min_price=min(prices) if prices else None,
+        max_price=max(prices) if prices else None,
+        default_variant=default_variant,
+        main_image=ProductImageSerializer(main_image).data if main_image else None,
+        created_at=product.created_at,
+    )
+
+
+def rebuild_listings(product_ids):
+    """
+    Пересобирает строки каталога для набора товаров одним upsert.
+    Строки удалённых товаров удаляются каскадом, поэтому здесь не трогаются.
+    Возвращает число записанных строк.
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return 0
+
+    products = list(_listing_products(product_ids))
+    availability = resolve_product_availability(products, visible_only=True)
+    listings = [build_listing(product, availability) for product in products]
+
+    # MySQL не принимает unique_fields: ON DUPLICATE KEY срабатывает по любому ключу
+    unique_fields = (
+        ["product"] if connection.features.supports_update_conflicts_with_target else None
+    )
+    ProductListing.objects.bulk_create(
+        listings,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=LISTING_FIELDS,
+    )
+    return len(listings)
+
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Category
+from marketplace.similarity import TOP_K, build_similar_products
+
+
+class Command(BaseCommand):
+    help = (
+        "Рассчитывает похожие товары (SimilarProduct) по атрибутам, "
+        "категориям и ценам. Запускать периодически, например раз в сутки"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--category",
+            type=int,
+            help="id категории: пересчитать её поддерево; по умолчанию весь каталог",
+        )
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=TOP_K,
+            help="Сколько похожих товаров хранить для товара",
+        )
+
+    def handle(self, *args, **options):
+        categories = None
+        if options["category"]:
+            categories = Category.objects.get(pk=options["category"]).get_descendants(
+                include_self=True
+            )
+
+        processed = build_similar_products(categories, top_k=options["top_k"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Рассчитаны похожие товары для {processed} товаров")
+        )
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.search import BATCH_SIZE, drain_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит изменения товаров из очереди SearchOutbox в поисковый индекс. "
+        "После коммита процесс сам индексирует только товары своей транзакции; "
+        "категории, значения атрибутов, импорт и ошибки разбирает эта команда — "
+        "запускать по cron раз в минуту или постоянно с --interval"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Записей очереди за одну пачку",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Работать постоянно, проверяя очередь раз в столько секунд",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain_outbox(batch_size=options["batch_size"])
+            if processed or not options["interval"]:
+                self.stdout.write(self.style.SUCCESS(f"Обработано изменений: {processed}"))
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
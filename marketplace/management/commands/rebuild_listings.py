@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.listing import rebuild_listings
+from marketplace.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересобирает строки каталога (ProductListing). "
+        "Запускать один раз после миграции 0029 (миграция строки не заполняет) "
+        "и после изменений в обход сигналов"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--business",
+            help="slug бизнеса; по умолчанию пересобирается весь каталог",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Количество товаров, пересобираемых за один проход",
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options["business"]:
+            products = products.filter(business__slug=options["business"])
+
+        chunk_size = options["chunk_size"]
+        ids = products.order_by("pk").values_list("pk", flat=True)
+        rebuilt = 0
+        last_pk = 0
+        while True:
+            chunk = list(ids.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            rebuilt += rebuild_listings(chunk)
+            last_pk = chunk[-1]
+
+        self.stdout.write(self.style.SUCCESS(f"Пересобрано строк каталога: {rebuilt}"))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Product
+from marketplace.product_refresh import reconcile_is_active
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает is_active товаров по наличию видимых вариантов "
+        "на складах, min/max цену со скидкой и строки каталога "
+        "(после импорта или загрузки фикстур)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--business",
+            help="slug бизнеса; по умолчанию пересчитывается весь маркетплейс",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="Ширина диапазона первичных ключей для одного UPDATE",
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options["business"]:
+            products = products.filter(business__slug=options["business"])
+
+        before = products.filter(is_active=True).count()
+        processed = reconcile_is_active(products, chunk_size=options["chunk_size"])
+        after = products.filter(is_active=True).count()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Обработано товаров: {processed}, активных: {before} -> {after}"
+            )
+        )
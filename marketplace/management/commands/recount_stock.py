@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from marketplace.models import ProductStock
+from marketplace.stock import recount_stock_counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Сверяет счётчики брака и продаж в остатках с исходными записями "
+        "и проводит расхождения корректирующими движениями"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--business",
+            help="slug бизнеса; по умолчанию пересчитываются все остатки",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Количество остатков, пересчитываемых в одной транзакции",
+        )
+
+    def handle(self, *args, **options):
+        stocks = ProductStock.objects.all()
+        if options["business"]:
+            stocks = stocks.filter(variant__product__business__slug=options["business"])
+
+        chunk_size = options["chunk_size"]
+        ids = stocks.order_by("pk").values_list("pk", flat=True)
+        fixed = 0
+        last_pk = 0
+        while True:
+            chunk = list(ids.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                fixed += recount_stock_counters(
+                    ProductStock.objects.filter(pk__in=chunk)
+                )
+            last_pk = chunk[-1]
+
+        self.stdout.write(self.style.SUCCESS(f"Исправлено остатков: {fixed}"))
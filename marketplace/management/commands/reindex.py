@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.search import BATCH_SIZE, get_search_backend, reindex
+
+
+class Command(BaseCommand):
+    help = (
+        "Перестраивает поисковые документы товаров выбранного бэкенда "
+        "(MARKETPLACE_SEARCH_BACKEND) и словарь опечаток параллельно "
+        "по диапазонам id товаров. Нужен после миграций 0030 и 0032 (они данные "
+        "не заполняют), смены бэкенда и массового импорта"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Число процессов индексации",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Товаров в одной пачке",
+        )
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Сначала удалить все документы",
+        )
+
+    def handle(self, *args, **options):
+        processed = reindex(
+            workers=options["workers"],
+            chunk_size=options["chunk_size"],
+            clear=options["clear"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Проиндексировано {processed} товаров "
+                f"({type(get_search_backend()).__name__})"
+            )
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.stock import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Снимает резервы товаров с истёкшим сроком (запускать по расписанию)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Количество резервов, снимаемых в одной транзакции",
+        )
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Снято резервов: {released}"))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import ProductStock
+from marketplace.stock import take_stock_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Создаёт снимки остатков по журналу движений. "
+        "Запускается периодически (например, раз в сутки по cron)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--business",
+            help="slug бизнеса; по умолчанию обрабатываются все остатки",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Количество остатков, обрабатываемых за один проход",
+        )
+
+    def handle(self, *args, **options):
+        stocks = ProductStock.objects.all()
+        if options["business"]:
+            stocks = stocks.filter(variant__product__business__slug=options["business"])
+
+        created = take_stock_snapshots(stocks, chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"Создано снимков: {created}"))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.copurchase import BATCH_SIZE, update_co_purchases
+
+
+class Command(BaseCommand):
+    help = (
+        "Учитывает новые чеки в счётчиках «покупают вместе». "
+        "Запускать периодически (cron), обрабатываются только новые чеки"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Чеков за одну транзакцию",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Стереть счётчики и пересчитать по всем чекам (после удаления чеков)",
+        )
+
+    def handle(self, *args, **options):
+        processed = update_co_purchases(
+            batch_size=options["batch_size"], rebuild=options["rebuild"]
+        )
+        self.stdout.write(self.style.SUCCESS(f"Обработано чеков: {processed}"))
@@ -0,0 +1,63 @@
+# Generated by Django 5.1.2 on 2026-10-17 22:59
+
+from django.db import migrations, models
+from django.db.models import IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_stock_counters(apps, schema_editor):
+    ProductStock = apps.get_model("marketplace", "ProductStock")
+    ProductDefect = apps.get_model("marketplace", "ProductDefect")
+    ProductSale = apps.get_model("marketplace", "ProductSale")
+
+    defects = (
+        ProductDefect.objects.filter(stock=OuterRef("pk"))
+        .values("stock")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    sold = (
+        ProductSale.objects.filter(
+            variant=OuterRef("variant"),
+            location=OuterRef("location"),
+            receipt__is_deleted=False,
+        )
+        .values("variant")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    ProductStock.objects.update(
+        defect_quantity=Coalesce(Subquery(defects, output_field=IntegerField()), Value(0)),
+        sold_quantity=Coalesce(Subquery(sold, output_field=IntegerField()), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0018_historicalproductdefect_historicalproductstock_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalproductstock',
+            name='defect_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Поддерживается автоматически при изменении записей о браке', verbose_name='Количество брака'),
+        ),
+        migrations.AddField(
+            model_name='historicalproductstock',
+            name='sold_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Поддерживается автоматически при продажах и удалении чеков', verbose_name='Продано'),
+        ),
+        migrations.AddField(
+            model_name='productstock',
+            name='defect_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Поддерживается автоматически при изменении записей о браке', verbose_name='Количество брака'),
+        ),
+        migrations.AddField(
+            model_name='productstock',
+            name='sold_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Поддерживается автоматически при продажах и удалении чеков', verbose_name='Продано'),
+        ),
+        migrations.RunPython(fill_stock_counters, migrations.RunPython.noop),
+    ]
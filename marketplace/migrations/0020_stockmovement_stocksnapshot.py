@@ -0,0 +1,83 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_opening_snapshots(apps, schema_editor):
+    """Начальные снимки: текущее состояние остатков до появления журнала."""
+    ProductStock = apps.get_model("marketplace", "ProductStock")
+    StockSnapshot = apps.get_model("marketplace", "StockSnapshot")
+
+    now = timezone.now()
+    stocks = ProductStock.objects.values_list(
+        "pk", "quantity", "reserved_quantity", "defect_quantity", "sold_quantity"
+    ).iterator(chunk_size=2000)
+    batch = []
+    for pk, quantity, reserved, defect, sold in stocks:
+        batch.append(
+            StockSnapshot(
+                stock_id=pk,
+                last_movement_id=0,
+                taken_at=now,
+                quantity=quantity,
+                reserved_quantity=reserved,
+                defect_quantity=defect,
+                sold_quantity=sold,
+            )
+        )
+        if len(batch) >= 2000:
+            StockSnapshot.objects.bulk_create(batch)
+            batch = []
+    StockSnapshot.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0019_productstock_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('receipt', 'Поступление'), ('sale', 'Продажа'), ('defect', 'Брак'), ('reserve', 'Резерв'), ('release', 'Снятие резерва'), ('transfer', 'Перемещение'), ('adjustment', 'Корректировка')], max_length=16, verbose_name='Тип')),
+                ('quantity', models.IntegerField(help_text='Изменение соответствующей колонки остатка со знаком', verbose_name='Изменение')),
+                ('comment', models.CharField(blank=True, max_length=255, verbose_name='Комментарий')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата')),
+                ('receipt', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='marketplace.receipt', verbose_name='Чек')),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='marketplace.productstock', verbose_name='Остаток')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Движение остатка',
+                'verbose_name_plural': 'Движения остатков',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['stock', 'id'], name='marketplace_stock_i_5fa15d_idx'), models.Index(fields=['stock', 'created_at'], name='marketplace_stock_i_750278_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_movement_id', models.BigIntegerField(default=0, verbose_name='Последнее учтённое движение')),
+                ('taken_at', models.DateTimeField(verbose_name='Дата снимка')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Количество')),
+                ('reserved_quantity', models.IntegerField(default=0, verbose_name='Резерв')),
+                ('defect_quantity', models.IntegerField(default=0, verbose_name='Брак')),
+                ('sold_quantity', models.IntegerField(default=0, verbose_name='Продано')),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='marketplace.productstock', verbose_name='Остаток')),
+            ],
+            options={
+                'verbose_name': 'Снимок остатка',
+                'verbose_name_plural': 'Снимки остатков',
+                'indexes': [models.Index(fields=['stock', 'last_movement_id'], name='marketplace_stock_i_474e38_idx'), models.Index(fields=['stock', 'taken_at'], name='marketplace_stock_i_74d83c_idx')],
+            },
+        ),
+        migrations.RunPython(create_opening_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0020_stockmovement_stocksnapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('status', models.CharField(choices=[('active', 'Активен'), ('released', 'Снят'), ('expired', 'Истёк')], default='active', max_length=16, verbose_name='Статус')),
+                ('comment', models.CharField(blank=True, max_length=255, verbose_name='Комментарий')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('expires_at', models.DateTimeField(blank=True, help_text='Пусто — резерв бессрочный', null=True, verbose_name='Действует до')),
+                ('released_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата снятия')),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_reservations', to=settings.AUTH_USER_MODEL, verbose_name='Владелец')),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='marketplace.productstock', verbose_name='Остаток')),
+            ],
+            options={
+                'verbose_name': 'Резерв',
+                'verbose_name_plural': 'Резервы',
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='marketplace_status_69a72c_idx'), models.Index(fields=['stock', 'status'], name='marketplace_stock_i_8ae8c0_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:10
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_business_receipt_css_template_and_more'),
+        ('marketplace', '0021_stockreservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductListing',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='listing', serialize=False, to='marketplace.product', verbose_name='Товар')),
+                ('name', models.CharField(max_length=200, verbose_name='Название')),
+                ('description', models.TextField(blank=True, null=True, verbose_name='Описание')),
+                ('category_name', models.CharField(blank=True, max_length=100, verbose_name='Категория')),
+                ('business_name', models.CharField(blank=True, max_length=255, verbose_name='Бизнес')),
+                ('is_active', models.BooleanField(default=False, verbose_name='Активен')),
+                ('is_visible_on_marketplace', models.BooleanField(default=False, verbose_name='Показывать на маркетплейсе')),
+                ('is_visible_on_own_site', models.BooleanField(default=False, verbose_name='Показывать на личном сайте')),
+                ('has_visible_variants', models.BooleanField(default=False, verbose_name='Есть видимые варианты')),
+                ('in_stock', models.BooleanField(default=False, verbose_name='В наличии')),
+                ('available_quantity', models.IntegerField(default=0, verbose_name='Доступно на складах')),
+                ('min_price', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='Мин. цена')),
+                ('max_price', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='Макс. цена')),
+                ('default_variant', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Вариант по умолчанию')),
+                ('main_image', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Главное изображение')),
+                ('created_at', models.DateTimeField(verbose_name='Дата создания товара')),
+                ('refreshed_at', models.DateTimeField(auto_now=True, verbose_name='Дата пересчёта')),
+                ('business', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.business', verbose_name='Бизнес')),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='marketplace.category', verbose_name='Категория')),
+            ],
+            options={
+                'verbose_name': 'Строка каталога',
+                'verbose_name_plural': 'Строки каталога',
+                'indexes': [models.Index(fields=['category', 'created_at'], name='marketplace_categor_697e36_idx'), models.Index(fields=['category', 'min_price'], name='marketplace_categor_ec6fd7_idx'), models.Index(fields=['category', 'max_price'], name='marketplace_categor_2e8a22_idx'), models.Index(fields=['business', 'created_at'], name='marketplace_busines_f8cede_idx'), models.Index(fields=['business', 'name'], name='marketplace_busines_169640_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:21
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, Max, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Round
+
+
+def fill_effective_prices(apps, schema_editor):
+    Product = apps.get_model("marketplace", "Product")
+    ProductVariant = apps.get_model("marketplace", "ProductVariant")
+
+    ProductVariant.objects.update(
+        effective_price=Round(
+            F("price") * (Value(Decimal(100)) - Coalesce(F("discount"), Value(Decimal(0))))
+            / Value(Decimal(100)),
+            2,
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )
+    )
+    prices = (
+        ProductVariant.objects.filter(product=OuterRef("pk"))
+        .order_by()
+        .values("product")
+        .annotate(low=Min("effective_price"), high=Max("effective_price"))
+    )
+    Product.objects.update(
+        min_effective_price=Subquery(prices.values("low")),
+        max_effective_price=Subquery(prices.values("high")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_business_receipt_css_template_and_more'),
+        ('marketplace', '0022_productlisting'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalproductvariant',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='Цена со скидкой'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='max_effective_price',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=10, null=True, verbose_name='Максимальная цена со скидкой'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='min_effective_price',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=10, null=True, verbose_name='Минимальная цена со скидкой'),
+        ),
+        migrations.AddField(
+            model_name='productvariant',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='Цена со скидкой'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['min_effective_price'], name='marketplace_min_eff_e8f2ff_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['max_effective_price'], name='marketplace_max_eff_16a323_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productvariant',
+            index=models.Index(fields=['product', 'effective_price'], name='marketplace_product_43e4f6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productvariant',
+            index=models.Index(fields=['effective_price'], name='marketplace_effecti_b7afbb_idx'),
+        ),
+        migrations.RunPython(fill_effective_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0024_similarproduct'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoPurchaseProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_receipt_id', models.BigIntegerField(default=0, verbose_name='Последний чек')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Прогресс совместных покупок',
+                'verbose_name_plural': 'Прогресс совместных покупок',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductCoPurchase',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('receipts', models.PositiveIntegerField(default=0, verbose_name='Чеков вместе')),
+                ('companion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='marketplace.product', verbose_name='Покупают вместе')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='co_purchases', to='marketplace.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Совместная покупка товаров',
+                'verbose_name_plural': 'Совместные покупки товаров',
+                'indexes': [models.Index(fields=['product', '-receipts'], name='marketplace_product_e22611_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'companion'), name='unique_product_co_purchase')],
+            },
+        ),
+        migrations.CreateModel(
+            name='VariantCoPurchase',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('receipts', models.PositiveIntegerField(default=0, verbose_name='Чеков вместе')),
+                ('companion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='marketplace.productvariant', verbose_name='Покупают вместе')),
+                ('variant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='co_purchases', to='marketplace.productvariant', verbose_name='Вариант')),
+            ],
+            options={
+                'verbose_name': 'Совместная покупка вариантов',
+                'verbose_name_plural': 'Совместные покупки вариантов',
+                'indexes': [models.Index(fields=['variant', '-receipts'], name='marketplace_variant_103e51_idx')],
+                'constraints': [models.UniqueConstraint(fields=('variant', 'companion'), name='unique_variant_co_purchase')],
+            },
+        ),
+    ]
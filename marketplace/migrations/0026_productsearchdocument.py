@@ -0,0 +1,86 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+DOCUMENT_TABLE = "marketplace_productsearchdocument"
+FTS_TABLE = "marketplace_productsearch_fts"
+
+SQLITE_CREATE = [
+    f"""
+    CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        name, body, content='{DOCUMENT_TABLE}', content_rowid='product_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON {DOCUMENT_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, body)
+        VALUES (new.product_id, new.name, new.body);
+    END
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON {DOCUMENT_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, body)
+        VALUES ('delete', old.product_id, old.name, old.body);
+    END
+    """,
+    f"""
+    CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE ON {DOCUMENT_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, body)
+        VALUES ('delete', old.product_id, old.name, old.body);
+        INSERT INTO {FTS_TABLE}(rowid, name, body)
+        VALUES (new.product_id, new.name, new.body);
+    END
+    """,
+]
+SQLITE_DROP = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+MYSQL_CREATE = [
+    f"ALTER TABLE {DOCUMENT_TABLE} ADD FULLTEXT INDEX {DOCUMENT_TABLE}_name_ft (name)",
+    f"ALTER TABLE {DOCUMENT_TABLE} ADD FULLTEXT INDEX {DOCUMENT_TABLE}_text_ft (name, body)",
+]
+MYSQL_DROP = [
+    f"ALTER TABLE {DOCUMENT_TABLE} DROP INDEX {DOCUMENT_TABLE}_text_ft",
+    f"ALTER TABLE {DOCUMENT_TABLE} DROP INDEX {DOCUMENT_TABLE}_name_ft",
+]
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+
+    return run
+
+
+create_fulltext = _run({"sqlite": SQLITE_CREATE, "mysql": MYSQL_CREATE})
+drop_fulltext = _run({"sqlite": SQLITE_DROP, "mysql": MYSQL_DROP})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0025_copurchase'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='marketplace.product', verbose_name='Товар')),
+                ('name', models.CharField(max_length=200, verbose_name='Название')),
+                ('body', models.TextField(blank=True, help_text='Описание, названия и артикулы вариантов, значения атрибутов, категория', verbose_name='Текст')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Поисковый документ товара',
+                'verbose_name_plural': 'Поисковые документы товаров',
+            },
+        ),
+        migrations.RunPython(create_fulltext, drop_fulltext),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0026_productsearchdocument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.BigIntegerField(blank=True, null=True, verbose_name='Товар')),
+                ('category_id', models.BigIntegerField(blank=True, null=True, verbose_name='Категория')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Изменение для поиска',
+                'verbose_name_plural': 'Изменения для поиска',
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0027_searchoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=40, unique=True, verbose_name='Слово')),
+                ('trigram_count', models.PositiveSmallIntegerField(verbose_name='Число триграмм')),
+            ],
+            options={
+                'verbose_name': 'Слово поиска',
+                'verbose_name_plural': 'Слова поиска',
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3, verbose_name='Триграмма')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='marketplace.searchterm', verbose_name='Слово')),
+            ],
+            options={
+                'verbose_name': 'Триграмма слова',
+                'verbose_name_plural': 'Триграммы слов',
+                'constraints': [models.UniqueConstraint(fields=('trigram', 'term'), name='unique_search_trigram')],
+            },
+        ),
+    ]
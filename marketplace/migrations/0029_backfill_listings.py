@@ -0,0 +1,13 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Строки каталога собираются сериализаторами карточки по рабочим моделям,
+    # поэтому миграция их не заполняет: после migrate выполнить
+    # manage.py rebuild_listings (дальше строки поддерживаются сигналами)
+
+    dependencies = [
+        ('marketplace', '0028_searchterm'),
+    ]
+
+    operations = []
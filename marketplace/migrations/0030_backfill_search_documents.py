@@ -0,0 +1,13 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Документы и словарь опечаток собираются рабочим кодом поиска, поэтому
+    # миграция их не заполняет: после migrate выполнить manage.py reindex
+    # (для Elasticsearch — reindex --clear)
+
+    dependencies = [
+        ('marketplace', '0029_backfill_listings'),
+    ]
+
+    operations = []
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 00:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0030_backfill_search_documents'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchoutbox',
+            name='attribute_value_id',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Значение атрибута'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.2 on 2026-10-18 00:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Словарь опечаток заполняет и размечает manage.py reindex: слова
+    # без seen_at он удаляет, если они не встретились ни в одном товаре
+
+    dependencies = [
+        ('marketplace', '0031_searchoutbox_attribute_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchterm',
+            name='seen_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Встречено'),
+        ),
+    ]
@@ -1,5 +1,7 @@
+from decimal import ROUND_HALF_UP, Decimal
+
 from PIL import Image
-from django.db import models
+from django.db import models, transaction
 from mptt.fields import TreeForeignKey
 from mptt.models import MPTTModel
 from django.core.exceptions import ValidationError
@@ -7,7 +9,21 @@ from core.models import Business, User
 from django.http import Http404
 from core.models import BusinessLocation
 from .EAN_13_barcode_generator import generate_barcode
-from django.db.models import Sum
+from django.db.models import (
+    DecimalField,
+    Exists,
+    F,
+    IntegerField,
+    Max,
+    Min,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+)
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.functions import Cast, Coalesce, Round
 from simple_history.models import HistoricalRecords
 
 
@@ -53,6 +69,210 @@ class Category(MPTTModel):
         return " - ".join([ancestor.name for ancestor in ancestors] + [self.name])
 
 
+def stock_available_expression():
+    """
+    quantity − reserved − defect − sold для строки ProductStock.
+    Колонки беззнаковые, поэтому вычитание ведём в знаковых типах
+    (в MySQL отрицательная разность беззнаковых чисел — ошибка).
+    """
+    return Cast("quantity", output_field=IntegerField()) - Cast(
+        F("reserved_quantity") + F("defect_quantity") + F("sold_quantity"),
+        output_field=IntegerField(),
+    )
+
+
+def effective_price(price, discount):
+    """Цена с учётом скидки в процентах, округлённая до копеек."""
+    price = Decimal(price)
+    if discount:
+        price = price * (100 - Decimal(discount)) / 100
+    return price.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def effective_price_expression(price=None, discount=None):
+    """
+    То же в SQL для UPDATE: по умолчанию из колонок варианта,
+    либо из новых значений price/discount того же UPDATE.
+    """
+    price = F("price") if price is None else price
+    discount = F("discount") if discount is None else discount
+    return Round(
+        price * (Value(Decimal(100)) - Coalesce(discount, Value(Decimal(0))))
+        / Value(Decimal(100)),
+        2,
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+
+
+class ProductVariantQuerySet(models.QuerySet):
+    # Цена со скидкой хранится в effective_price; массовые изменения цены
+    # пересчитывают её тем же запросом и отмечают товары для пересчёта
+    # min/max цены товара (сигналы при этом не срабатывают).
+    # Массовые изменения также сбрасывают кеш сканов кассы (marketplace.scan)
+
+    def update(self, **kwargs):
+        from .scan import invalidate_scan_cache
+
+        invalidate_scan_cache()
+        if {"price", "discount"} & kwargs.keys() and "effective_price" not in kwargs:
+            from .product_refresh import mark_products_dirty
+
+            # Первой колонкой: MySQL вычисляет SET слева направо по новым значениям
+            kwargs = {
+                "effective_price": effective_price_expression(
+                    kwargs.get("price"), kwargs.get("discount")
+                ),
+                **kwargs,
+            }
+            mark_products_dirty(
+                set(self.values_list("product_id", flat=True)), using=self.db
+            )
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.effective_price = effective_price(obj.price, obj.discount)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        from .scan import invalidate_scan_cache
+
+        invalidate_scan_cache()
+        objs = list(objs)
+        fields = list(fields)
+        if {"price", "discount"} & set(fields):
+            from .product_refresh import mark_products_dirty
+
+            for obj in objs:
+                obj.effective_price = effective_price(obj.price, obj.discount)
+            if "effective_price" not in fields:
+                fields.append("effective_price")
+            mark_products_dirty({obj.product_id for obj in objs}, using=self.db)
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    bulk_update.alters_data = True
+
+    def with_availability(self):
+        """Аннотирует warehouse_available — доступное количество на складах."""
+        stocks = (
+            ProductStock.objects.filter(
+                variant=OuterRef("pk"), location__location_type__is_warehouse=True
+            )
+            .values("variant")
+            .annotate(total=Sum(stock_available_expression()))
+            .values("total")
+        )
+        return self.annotate(
+            warehouse_available=Coalesce(
+                Subquery(stocks, output_field=IntegerField()), Value(0)
+            )
+        )
+
+    def in_stock(self):
+        """Варианты с положительным остатком на складах."""
+        return self.with_availability().filter(warehouse_available__gt=0)
+
+
+class ProductQuerySet(models.QuerySet):
+    def with_availability(self):
+        """
+        Аннотирует warehouse_available — суммарное доступное количество
+        видимых вариантов товара на складах.
+        """
+        stocks = (
+            ProductStock.objects.filter(
+                variant__product=OuterRef("pk"),
+                variant__show_this=True,
+                location__location_type__is_warehouse=True,
+            )
+            .values("variant__product")
+            .annotate(total=Sum(stock_available_expression()))
+            .values("total")
+        )
+        return self.annotate(
+            warehouse_available=Coalesce(
+                Subquery(stocks, output_field=IntegerField()), Value(0)
+            )
+        )
+
+    def with_visible_variants(self):
+        """Товары, у которых есть хотя бы один вариант с show_this=True."""
+        return self.filter(
+            Exists(ProductVariant.objects.filter(product=OuterRef("pk"), show_this=True))
+        )
+
+    def search(self, query, text=True, barcode=False, text_query=None):
+        """
+        Поиск: text — полнотекстовый через поисковый бэкенд (marketplace.search)
+        с исправлением опечаток, barcode — подстрока штрихкода варианта через EXISTS.
+        text_query — уже исправленный запрос (search.corrected_query), если он посчитан.
+        """
+        variants = ProductVariant.objects.filter(product=OuterRef("pk"))
+        condition = Q()
+        if text:
+            from .search import corrected_query, search_condition
+
+            if text_query is None:
+                text_query = corrected_query(query, self)
+            condition |= search_condition(text_query)
+        if barcode:
+            condition |= Exists(variants.filter(barcode__icontains=query))
+        return self.filter(condition) if condition else self
+
+    def price_between(self, price_min=None, price_max=None):
+        """
+        Все варианты товара укладываются в диапазон цен (с учётом скидки):
+        условия по хранимым min/max цене товара, товар без вариантов не подходит.
+        """
+        qs = self
+        if price_min is not None:
+            qs = qs.filter(min_effective_price__gte=price_min)
+        if price_max is not None:
+            qs = qs.filter(max_effective_price__lte=price_max)
+        return qs
+
+    def with_attribute_values(self, attribute_id, value_ids=(), custom_values=()):
+        """
+        Товары, у которых есть вариант со значением атрибута из value_ids
+        (предопределённые значения) или custom_values (произвольный текст).
+        """
+        condition = Q()
+        if value_ids:
+            condition |= Q(predefined_value_id__in=value_ids)
+        if custom_values:
+            condition |= Q(custom_value__in=custom_values)
+        if not condition:
+            return self
+        return self.filter(
+            Exists(
+                ProductVariantAttribute.objects.filter(
+                    condition,
+                    variant__product=OuterRef("pk"),
+                    category_attribute__attribute_id=attribute_id,
+                )
+            )
+        )
+
+    def with_price_bounds(self):
+        """Аннотирует min_price/max_price — хранимые цены товара с учётом скидки."""
+        return self.annotate(
+            min_price=F("min_effective_price"), max_price=F("max_effective_price")
+        )
+
+    def in_stock(self):
+        """Товары, у которых есть видимый вариант с положительным остатком на складах."""
+        return self.filter(
+            Exists(
+                ProductVariant.objects.filter(
+                    product=OuterRef("pk"), show_this=True
+                ).in_stock()
+            )
+        )
+
+
 class Product(models.Model):
     """
     Товар на маркетплейсе.
@@ -85,9 +305,28 @@ class Product(models.Model):
         verbose_name="Показывать на личном сайте",
     )
     is_active = models.BooleanField(default=True, verbose_name="Активен")
+    # Пересчитываются по всем вариантам после коммита (product_refresh)
+    min_effective_price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Минимальная цена со скидкой",
+    )
+    max_effective_price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Максимальная цена со скидкой",
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
@@ -96,6 +335,8 @@ class Product(models.Model):
             models.Index(fields=["is_visible_on_marketplace"]),
             models.Index(fields=["is_visible_on_own_site"]),
             models.Index(fields=["created_at"]),
+            models.Index(fields=["min_effective_price"]),
+            models.Index(fields=["max_effective_price"]),
         ]
 
     def __str__(self):
@@ -139,50 +380,58 @@ class Product(models.Model):
         """
         Обновляет поле is_active в зависимости от наличия доступных вариантов.
         Активен, если хотя бы один вариант с show_this=True и available_quantity > 0.
-        Также выводит лог с названием товара, варианта и доступным количеством.
         """
-        for variant in self.variants.filter(show_this=True):
-            qty = variant.available_quantity
-            print(f"[Проверка] Товар: {self.name} | Вариант: {variant} | Доступно: {qty}")
-
-            if qty > 0:
-                if not self.is_active:
-                    self.is_active = True
-                    self.save(update_fields=["is_active"])
-                    print(f"[АКТИВАЦИЯ] '{self.name}' включён, есть доступный вариант: {variant}")
-                return
-
-        # Ни один подходящий вариант не найден
-        if self.is_active:
-            self.is_active = False
-            self.save(update_fields=["is_active"])
-            print(f"[ДЕАКТИВАЦИЯ] '{self.name}' выключен, нет доступных вариантов.")
+        from .product_refresh import refresh_is_active
+
+        refresh_is_active(Product.objects.filter(pk=self.pk))
+        self.is_active = (
+            Product.objects.filter(pk=self.pk).values_list("is_active", flat=True).get()
+        )
+
+    def _visible_variants(self):
+        """
+        Варианты с show_this=True. Если список предзагружен в visible_variants
+        (ProductSet.prefetch_for_list), запрос не выполняется.
+        """
+        if hasattr(self, "visible_variants"):
+            return self.visible_variants
+        return list(self.variants.filter(show_this=True))
+
+    def _available_variants(self, availability=None):
+        """
+        Видимые варианты с положительным остатком на складах.
+        availability — результат stock.resolve_availability; если не передан,
+        остатки вариантов товара получаются одним запросом.
+        """
+        variants = self._visible_variants()
+        if availability is None:
+            from .stock import resolve_availability
+
+            availability = resolve_availability([v.id for v in variants])
+        return [v for v in variants if availability.available(v.id) > 0]
 
     @property
     def default_variant(self):
-        for variant in self.variants.filter(show_this=True):
-            if variant.available_quantity > 0:
-                return variant
-        return None
+        return self.get_default_variant(strict=True)
 
-    def get_default_variant(self, strict=True):
+    def get_default_variant(self, strict=True, availability=None):
         """
         strict=True — только доступный.
         strict=False — любой видимый или просто первый.
         """
         if strict:
-            return self.default_variant
-        return self.variants.filter(show_this=True).first() or self.variants.first()
-
+            variants = self._available_variants(availability)
+            return variants[0] if variants else None
+        visible = self._visible_variants()
+        return visible[0] if visible else self.variants.first()
 
     @property
     def price_range(self):
+        return self.get_price_range()
+
+    def get_price_range(self, availability=None):
         """Возвращает минимальную и максимальную цену среди вариантов с учетом наличия на складах"""
-        variants = [
-            v
-            for v in self.variants.filter(show_this=True)
-            if v.available_quantity > 0
-        ]
+        variants = self._available_variants(availability)
 
         if not variants:
             return None, None
@@ -198,6 +447,10 @@ class Product(models.Model):
     @property
     def main_image(self):
         """Возвращает главное изображение продукта"""
+        if "images" in getattr(self, "_prefetched_objects_cache", {}):
+            images = list(self.images.all())
+            main = next((image for image in images if image.is_main), None)
+            return main or (images[0] if images else None)
         main = self.images.filter(is_main=True).first()
         if not main:
             main = self.images.first()
@@ -366,6 +619,13 @@ class ProductVariant(models.Model):
         blank=True,
         verbose_name="Процент скидки",
     )
+    effective_price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=0,
+        editable=False,
+        verbose_name="Цена со скидкой",
+    )
     show_this = models.BooleanField(
         default=False,
         verbose_name="Показывать в поиске",
@@ -375,12 +635,16 @@ class ProductVariant(models.Model):
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
     history = HistoricalRecords(inherit=True, cascade_delete_history=False)
 
+    objects = ProductVariantQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Вариант товара"
         verbose_name_plural = "Варианты товаров"
         ordering = ["price"]
         indexes = [
             models.Index(fields=["price"]),
+            models.Index(fields=["product", "effective_price"]),
+            models.Index(fields=["effective_price"]),
             models.Index(fields=["show_this"]),
             models.Index(fields=["has_custom_name"]),
             models.Index(fields=["has_custom_description"]),
@@ -389,6 +653,11 @@ class ProductVariant(models.Model):
     def save(self, *args, **kwargs):
         is_new = self.pk is None
 
+        self.effective_price = effective_price(self.price, self.discount)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"price", "discount"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "effective_price"}
+
         if not self.barcode or not self.barcode_image:
 
             ean_code, image = generate_barcode()
@@ -507,6 +776,18 @@ class ProductStock(models.Model):
     reserved_quantity = models.PositiveIntegerField(
         default=0, verbose_name="Зарезервированное количество"
     )
+    defect_quantity = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Количество брака",
+        help_text="Поддерживается автоматически при изменении записей о браке",
+    )
+    sold_quantity = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Продано",
+        help_text="Поддерживается автоматически при продажах и удалении чеков",
+    )
     is_available_for_sale = models.BooleanField(
         default=True,
         verbose_name="Доступен для продажи",
@@ -529,31 +810,46 @@ class ProductStock(models.Model):
     def __str__(self):
         return f"{self.variant} в {self.location}: {self.available_quantity}"
 
-    @property
-    def defect_quantity(self):
-        """Общее количество брака для этой записи"""
+    # Счётчики меняются только через журнал движений (marketplace.stock)
+    COUNTER_FIELDS = ("defect_quantity", "sold_quantity")
 
-        return (
-            self.defects.aggregate(total=Sum("quantity"))
-            .get("total")
-            or 0
-        )
-    
-    @property
-    def sold_quantity(self):
-        """Количество уже проданного товара для этой локации"""
-        return (
-            self.variant.sales.filter(
-                location=self.location, receipt__is_deleted=False
-            )
-            .aggregate(total=Sum("quantity"))
-            .get("total")
-            or 0
-        )
+    def save(self, *args, **kwargs):
+        from .stock import record_stock_edit
+
+        with transaction.atomic():
+            if self._state.adding:
+                previous = None
+                if not self.sold_quantity:
+                    # Продажи по локации могли быть проведены до создания записи остатка
+                    self.sold_quantity = (
+                        ProductSale.objects.filter(
+                            variant_id=self.variant_id,
+                            location_id=self.location_id,
+                            receipt__is_deleted=False,
+                        )
+                        .aggregate(total=Sum("quantity"))
+                        .get("total")
+                        or 0
+                    )
+            else:
+                previous = (
+                    ProductStock.objects.filter(pk=self.pk)
+                    .values("quantity", "reserved_quantity")
+                    .first()
+                )
+                if kwargs.get("update_fields") is None:
+                    # Не перезаписываем счётчики значениями из памяти
+                    kwargs["update_fields"] = [
+                        field.name
+                        for field in self._meta.concrete_fields
+                        if not field.primary_key and field.name not in self.COUNTER_FIELDS
+                    ]
+            super().save(*args, **kwargs)
+            record_stock_edit(self, previous)
 
     @property
     def available_quantity(self):
-        """Доступное количество (с учётом брака и резерва)"""
+        """Доступное количество (с учётом брака, резерва и продаж)"""
         return (
             self.quantity
             - self.reserved_quantity
@@ -583,22 +879,54 @@ class ProductDefect(models.Model):
     def __str__(self):
         return f"Брак {self.quantity} шт. для {self.stock}"
     
-    def clean(self):
+    def _previous_state(self):
+        """(stock_id, quantity) записи в БД до сохранения или None для новой."""
+        if self.pk is None:
+            return None
+        return (
+            ProductDefect.objects.filter(pk=self.pk)
+            .values_list("stock_id", "quantity")
+            .first()
+        )
+
+    def clean(self, previous=None):
         if self.quantity < 0:
             raise ValidationError("Количество брака не может быть отрицательным.")
 
-        current_defect = (
-            self.stock.defects.exclude(pk=self.pk).aggregate(total=Sum("quantity"))["total"] or 0
+        # Берём актуальные счётчики из БД, объект stock в памяти может устареть
+        quantity, reserved_quantity, current_defect = (
+            ProductStock.objects.filter(pk=self.stock_id)
+            .values_list("quantity", "reserved_quantity", "defect_quantity")
+            .get()
         )
+        if previous and previous[0] == self.stock_id:
+            current_defect -= previous[1]
         total_defect_after_save = current_defect + self.quantity
-        available_after_defect = self.stock.quantity - self.stock.reserved_quantity - total_defect_after_save
+        available_after_defect = quantity - reserved_quantity - total_defect_after_save
 
         if available_after_defect < 0:
             raise ValidationError("Недостаточно доступного количества для такого объёма брака.")
 
     def save(self, *args, **kwargs):
-        self.clean()
-        super().save(*args, **kwargs)
+        from .stock import add_defect_quantity
+
+        with transaction.atomic():
+            previous = self._previous_state()
+            self.clean(previous)
+            # Счётчики обновляются до сохранения, чтобы сигналы видели новые остатки
+            if previous:
+                add_defect_quantity(previous[0], -previous[1], comment=self.reason)
+            add_defect_quantity(self.stock_id, self.quantity, comment=self.reason)
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        from .stock import add_defect_quantity
+
+        with transaction.atomic():
+            previous = self._previous_state()
+            if previous:
+                add_defect_quantity(previous[0], -previous[1], comment="Удаление брака")
+            return super().delete(*args, **kwargs)
 
 
 class ProductVariantAttribute(models.Model):
@@ -813,8 +1141,21 @@ class Receipt(models.Model):
     def delete(self, using=None, keep_parents=False):
         if self.is_deleted:
             return
-        self.is_deleted = True
-        self.save(update_fields=["is_deleted"])
+        from .stock import add_sold_quantity
+
+        with transaction.atomic():
+            self.is_deleted = True
+            self.save(update_fields=["is_deleted"])
+            # Продажи удалённого чека больше не уменьшают остатки
+            add_sold_quantity(
+                (
+                    (row["variant_id"], row["location_id"], -row["total"])
+                    for row in self.sales.values("variant_id", "location_id").annotate(
+                        total=Sum("quantity")
+                    )
+                ),
+                receipt=self,
+            )
 
 
 class ProductSale(models.Model):
@@ -863,10 +1204,479 @@ class ProductSale(models.Model):
         verbose_name_plural = "Продажи"
         ordering = ["-sale_date"]
 
+    def _counted_state(self):
+        """
+        (variant_id, location_id, quantity) записи в БД, если она учитывается
+        в остатках (привязана к неудалённому чеку), иначе None.
+        """
+        if self.pk is None:
+            return None
+        return (
+            ProductSale.objects.filter(pk=self.pk, receipt__is_deleted=False)
+            .values_list("variant_id", "location_id", "quantity")
+            .first()
+        )
+
+    @property
+    def is_counted_in_stock(self):
+        return self.receipt_id is not None and not self.receipt.is_deleted
+
     def save(self, *args, **kwargs):
+        from .stock import add_sold_quantity
+
         if not self.total_price:
             self.total_price = self.quantity * float(self.price_per_unit)
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            previous = self._counted_state()
+            changes = []
+            if previous:
+                changes.append((previous[0], previous[1], -previous[2]))
+            if self.is_counted_in_stock:
+                changes.append((self.variant_id, self.location_id, self.quantity))
+            # Счётчики обновляются до сохранения, чтобы сигналы видели новые остатки
+            add_sold_quantity(changes, receipt=self.receipt if self.receipt_id else None)
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        from .stock import add_sold_quantity
+
+        with transaction.atomic():
+            previous = self._counted_state()
+            if previous:
+                add_sold_quantity([(previous[0], previous[1], -previous[2])])
+            return super().delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.variant} — {self.quantity} шт."
+
+
+class StockMovement(models.Model):
+    """
+    Журнал движения остатков. Записи только добавляются: отмена операции
+    проводится новой записью с обратным знаком.
+    """
+
+    RECEIPT = "receipt"
+    SALE = "sale"
+    DEFECT = "defect"
+    RESERVE = "reserve"
+    RELEASE = "release"
+    TRANSFER = "transfer"
+    ADJUSTMENT = "adjustment"
+    KIND_CHOICES = [
+        (RECEIPT, "Поступление"),
+        (SALE, "Продажа"),
+        (DEFECT, "Брак"),
+        (RESERVE, "Резерв"),
+        (RELEASE, "Снятие резерва"),
+        (TRANSFER, "Перемещение"),
+        (ADJUSTMENT, "Корректировка"),
+    ]
+    # Какую колонку ProductStock меняет движение каждого типа
+    STOCK_FIELDS = {
+        RECEIPT: "quantity",
+        TRANSFER: "quantity",
+        ADJUSTMENT: "quantity",
+        SALE: "sold_quantity",
+        DEFECT: "defect_quantity",
+        RESERVE: "reserved_quantity",
+        RELEASE: "reserved_quantity",
+    }
+
+    stock = models.ForeignKey(
+        ProductStock,
+        on_delete=models.CASCADE,
+        related_name="movements",
+        verbose_name="Остаток",
+    )
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, verbose_name="Тип")
+    quantity = models.IntegerField(
+        verbose_name="Изменение",
+        help_text="Изменение соответствующей колонки остатка со знаком",
+    )
+    receipt = models.ForeignKey(
+        Receipt,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="stock_movements",
+        verbose_name="Чек",
+    )
+    user = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name="Пользователь",
+    )
+    comment = models.CharField(max_length=255, blank=True, verbose_name="Комментарий")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата")
+
+    class Meta:
+        verbose_name = "Движение остатка"
+        verbose_name_plural = "Движения остатков"
+        ordering = ["-id"]
+        indexes = [
+            models.Index(fields=["stock", "id"]),
+            models.Index(fields=["stock", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.quantity:+d} — {self.stock_id}"
+
+
+class StockSnapshot(models.Model):
+    """
+    Состояние остатка после движения last_movement_id.
+    Текущее и историческое состояние = последний снимок + движения после него.
+    """
+
+    stock = models.ForeignKey(
+        ProductStock,
+        on_delete=models.CASCADE,
+        related_name="snapshots",
+        verbose_name="Остаток",
+    )
+    last_movement_id = models.BigIntegerField(
+        default=0, verbose_name="Последнее учтённое движение"
+    )
+    taken_at = models.DateTimeField(verbose_name="Дата снимка")
+    quantity = models.IntegerField(default=0, verbose_name="Количество")
+    reserved_quantity = models.IntegerField(default=0, verbose_name="Резерв")
+    defect_quantity = models.IntegerField(default=0, verbose_name="Брак")
+    sold_quantity = models.IntegerField(default=0, verbose_name="Продано")
+
+    class Meta:
+        verbose_name = "Снимок остатка"
+        verbose_name_plural = "Снимки остатков"
+        indexes = [
+            models.Index(fields=["stock", "last_movement_id"]),
+            models.Index(fields=["stock", "taken_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_id} на {self.taken_at:%Y-%m-%d %H:%M}"
+
+
+class StockReservation(models.Model):
+    """
+    Резерв части остатка (корзина, отложенный на кассе товар).
+    Сумма активных резервов входит в ProductStock.reserved_quantity;
+    резерв с истёкшим expires_at снимается командой release_expired_reservations.
+    """
+
+    ACTIVE = "active"
+    RELEASED = "released"
+    EXPIRED = "expired"
+    STATUS_CHOICES = [
+        (ACTIVE, "Активен"),
+        (RELEASED, "Снят"),
+        (EXPIRED, "Истёк"),
+    ]
+
+    stock = models.ForeignKey(
+        ProductStock,
+        on_delete=models.CASCADE,
+        related_name="reservations",
+        verbose_name="Остаток",
+    )
+    quantity = models.PositiveIntegerField(verbose_name="Количество")
+    owner = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="stock_reservations",
+        verbose_name="Владелец",
+    )
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=ACTIVE, verbose_name="Статус"
+    )
+    comment = models.CharField(max_length=255, blank=True, verbose_name="Комментарий")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    expires_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name="Действует до",
+        help_text="Пусто — резерв бессрочный",
+    )
+    released_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата снятия")
+
+    class Meta:
+        verbose_name = "Резерв"
+        verbose_name_plural = "Резервы"
+        indexes = [
+            models.Index(fields=["status", "expires_at"]),
+            models.Index(fields=["stock", "status"]),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} шт. — {self.stock_id} ({self.get_status_display()})"
+
+
+class ProductListing(models.Model):
+    """
+    Строка списка товаров с заранее посчитанными полями карточки
+    (цены, вариант по умолчанию, главное изображение, наличие).
+    Обновляется после коммита вместе с is_active (product_refresh),
+    полностью пересобирается командой rebuild_listings.
+    """
+
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="listing",
+        verbose_name="Товар",
+    )
+    business = models.ForeignKey(
+        Business, on_delete=models.CASCADE, related_name="+", verbose_name="Бизнес"
+    )
+    category = models.ForeignKey(
+        Category,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+        verbose_name="Категория",
+    )
+    name = models.CharField(max_length=200, verbose_name="Название")
+    description = models.TextField(blank=True, null=True, verbose_name="Описание")
+    category_name = models.CharField(max_length=100, blank=True, verbose_name="Категория")
+    business_name = models.CharField(max_length=255, blank=True, verbose_name="Бизнес")
+    is_active = models.BooleanField(default=False, verbose_name="Активен")
+    is_visible_on_marketplace = models.BooleanField(
+        default=False, verbose_name="Показывать на маркетплейсе"
+    )
+    is_visible_on_own_site = models.BooleanField(
+        default=False, verbose_name="Показывать на личном сайте"
+    )
+    has_visible_variants = models.BooleanField(
+        default=False, verbose_name="Есть видимые варианты"
+    )
+    in_stock = models.BooleanField(default=False, verbose_name="В наличии")
+    available_quantity = models.IntegerField(
+        default=0, verbose_name="Доступно на складах"
+    )
+    min_price = models.DecimalField(
+        max_digits=12, decimal_places=2, null=True, blank=True, verbose_name="Мин. цена"
+    )
+    max_price = models.DecimalField(
+        max_digits=12, decimal_places=2, null=True, blank=True, verbose_name="Макс. цена"
+    )
+    default_variant = models.JSONField(
+        null=True, blank=True, encoder=DjangoJSONEncoder, verbose_name="Вариант по умолчанию"
+    )
+    main_image = models.JSONField(
+        null=True, blank=True, encoder=DjangoJSONEncoder, verbose_name="Главное изображение"
+    )
+    created_at = models.DateTimeField(verbose_name="Дата создания товара")
+    refreshed_at = models.DateTimeField(auto_now=True, verbose_name="Дата пересчёта")
+
+    class Meta:
+        verbose_name = "Строка каталога"
+        verbose_name_plural = "Строки каталога"
+        indexes = [
+            models.Index(fields=["category", "created_at"]),
+            models.Index(fields=["category", "min_price"]),
+            models.Index(fields=["category", "max_price"]),
+            models.Index(fields=["business", "created_at"]),
+            models.Index(fields=["business", "name"]),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class SimilarProduct(models.Model):
+    """
+    Похожий товар, рассчитанный заранее (marketplace.similarity):
+    по общим значениям атрибутов, близости категорий и ценовому диапазону.
+    Карточка товара читает первые строки по (product, rank) одним запросом.
+    """
+
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="similar_links",
+        verbose_name="Товар",
+    )
+    similar = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="similar_to_links",
+        verbose_name="Похожий товар",
+    )
+    rank = models.PositiveSmallIntegerField(verbose_name="Место")
+    score = models.FloatField(verbose_name="Сходство")
+
+    class Meta:
+        verbose_name = "Похожий товар"
+        verbose_name_plural = "Похожие товары"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product", "rank"], name="unique_similar_product_rank"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.similar_id} ({self.score:.3f})"
+
+
+class ProductCoPurchase(models.Model):
+    """
+    Сколько чеков содержат оба товара (marketplace.copurchase).
+    Пара хранится в обе стороны, поэтому «покупают вместе» для товара —
+    один проход по индексу (product, -receipts).
+    """
+
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="co_purchases",
+        verbose_name="Товар",
+    )
+    companion = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="+", verbose_name="Покупают вместе"
+    )
+    receipts = models.PositiveIntegerField(default=0, verbose_name="Чеков вместе")
+
+    class Meta:
+        verbose_name = "Совместная покупка товаров"
+        verbose_name_plural = "Совместные покупки товаров"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product", "companion"], name="unique_product_co_purchase"
+            ),
+        ]
+        indexes = [models.Index(fields=["product", "-receipts"])]
+
+
+class VariantCoPurchase(models.Model):
+    """То же для вариантов: подсказки кассиру по товарам в чеке"""
+
+    variant = models.ForeignKey(
+        ProductVariant,
+        on_delete=models.CASCADE,
+        related_name="co_purchases",
+        verbose_name="Вариант",
+    )
+    companion = models.ForeignKey(
+        ProductVariant,
+        on_delete=models.CASCADE,
+        related_name="+",
+        verbose_name="Покупают вместе",
+    )
+    receipts = models.PositiveIntegerField(default=0, verbose_name="Чеков вместе")
+
+    class Meta:
+        verbose_name = "Совместная покупка вариантов"
+        verbose_name_plural = "Совместные покупки вариантов"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["variant", "companion"], name="unique_variant_co_purchase"
+            ),
+        ]
+        indexes = [models.Index(fields=["variant", "-receipts"])]
+
+
+class CoPurchaseProgress(models.Model):
+    """Последний учтённый чек: построитель обрабатывает только новые чеки"""
+
+    last_receipt_id = models.BigIntegerField(default=0, verbose_name="Последний чек")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Прогресс совместных покупок"
+        verbose_name_plural = "Прогресс совместных покупок"
+
+
+class ProductSearchDocument(models.Model):
+    """
+    Текст товара для полнотекстового поиска (marketplace.search).
+    На MySQL таблица покрыта FULLTEXT-индексами, на SQLite — внешней
+    таблицей FTS5, которую синхронизируют триггеры (см. миграцию).
+    """
+
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="search_document",
+        verbose_name="Товар",
+    )
+    name = models.CharField(max_length=200, verbose_name="Название")
+    body = models.TextField(
+        blank=True,
+        verbose_name="Текст",
+        help_text="Описание, названия и артикулы вариантов, значения атрибутов, категория",
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Поисковый документ товара"
+        verbose_name_plural = "Поисковые документы товаров"
+
+    def __str__(self):
+        return self.name
+
+
+class SearchOutbox(models.Model):
+    """
+    Изменения для поискового индекса, записанные в транзакции самого изменения.
+    Строка хранит id товара, категории или значения атрибута (все их товары)
+    без внешнего ключа: запись об удалённом товаре должна дожить до обработки.
+    Очередь разбирает marketplace.search.drain_outbox.
+    """
+
+    product_id = models.BigIntegerField(null=True, blank=True, verbose_name="Товар")
+    category_id = models.BigIntegerField(null=True, blank=True, verbose_name="Категория")
+    attribute_value_id = models.BigIntegerField(
+        null=True, blank=True, verbose_name="Значение атрибута"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        verbose_name = "Изменение для поиска"
+        verbose_name_plural = "Изменения для поиска"
+
+
+class SearchTerm(models.Model):
+    """
+    Слово из названий и описаний товаров и вариантов — словарь для
+    исправления опечаток в поиске (marketplace.trigrams).
+    """
+
+    term = models.CharField(max_length=40, unique=True, verbose_name="Слово")
+    trigram_count = models.PositiveSmallIntegerField(verbose_name="Число триграмм")
+    # Когда слово последний раз встретилось при индексации: полный reindex
+    # удаляет слова, которых не было ни в одном товаре
+    seen_at = models.DateTimeField(null=True, blank=True, verbose_name="Встречено")
+
+    class Meta:
+        verbose_name = "Слово поиска"
+        verbose_name_plural = "Слова поиска"
+
+    def __str__(self):
+        return self.term
+
+
+class SearchTrigram(models.Model):
+    """Триграмма слова словаря: по ней ищутся слова, похожие на слово с опечаткой"""
+
+    trigram = models.CharField(max_length=3, verbose_name="Триграмма")
+    term = models.ForeignKey(
+        SearchTerm,
+        on_delete=models.CASCADE,
+        related_name="trigrams",
+        verbose_name="Слово",
+    )
+
+    class Meta:
+        verbose_name = "Триграмма слова"
+        verbose_name_plural = "Триграммы слов"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["trigram", "term"], name="unique_search_trigram"
+            )
+        ]
@@ -0,0 +1,175 @@
+"""
+Keyset (курсорная) пагинация.
+
+Вместо OFFSET следующая страница выбирается условием «строки после последней
+показанной» по колонкам сортировки queryset, поэтому глубокая страница
+бесконечной прокрутки стоит столько же, сколько первая, а COUNT(*)
+выполняется только по запросу. Курсор — непрозрачная строка base64(JSON)
+с сортировкой (колонки и направления) и значениями ключа последней строки;
+курсор другой сортировки отвергается, даже если типы значений совпадают.
+"""
+
+import base64
+import binascii
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, OrderBy, Q
+from rest_framework import exceptions
+
+
+class _CursorEncoder(DjangoJSONEncoder):
+    """Даты с микросекундами: DjangoJSONEncoder обрезает их до миллисекунд"""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class CursorPaginator:
+    """
+    Пагинатор по queryset с детерминированной сортировкой.
+    Ключ сортировки берётся из queryset.query.order_by; если в нём нет
+    первичного ключа, он добавляется последним для однозначности.
+    Поддерживаются колонки модели и аннотации (без переходов по связям);
+    NULL допускается в колонках с nulls_last, остальные считаются NOT NULL.
+    """
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = self._ordering_keys(queryset)
+        self.queryset = queryset.order_by(*(self._order_expression(key) for key in self.keys))
+
+    @staticmethod
+    def _ordering_keys(queryset):
+        ordering = queryset.query.order_by or queryset.model._meta.ordering or ()
+        pk_name = queryset.model._meta.pk.attname
+        keys = []
+        for item in ordering:
+            if isinstance(item, OrderBy) and isinstance(item.expression, F):
+                keys.append((item.expression.name, item.descending, bool(item.nulls_last)))
+            elif isinstance(item, str) and "__" not in item and item != "?":
+                keys.append((item.lstrip("-"), item.startswith("-"), False))
+            else:
+                raise ValueError(f"Сортировка {item!r} не поддерживает курсорную пагинацию")
+
+        names = {name if name != "pk" else pk_name for name, _, _ in keys}
+        if pk_name not in names and "id" not in names:
+            descending = keys[-1][1] if keys else False
+            keys.append((pk_name, descending, False))
+        return keys
+
+    @staticmethod
+    def _order_expression(key):
+        name, descending, nulls_last = key
+        if descending:
+            return F(name).desc(nulls_last=nulls_last or None)
+        return F(name).asc(nulls_last=nulls_last or None)
+
+    def _field(self, name):
+        return self.queryset.query.resolve_ref(name).output_field
+
+    @staticmethod
+    def _after(name, descending, nulls_last, value):
+        """Условие «значение колонки идёт после value» в данном направлении."""
+        if value is None:
+            # NULL в конце: после него только такие же NULL (их различает следующий ключ)
+            return Q(pk__in=[]) if nulls_last else Q(**{f"{name}__isnull": False})
+        condition = Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+        if nulls_last:
+            condition |= Q(**{f"{name}__isnull": True})
+        return condition
+
+    @staticmethod
+    def _equal(name, value):
+        if value is None:
+            return Q(**{f"{name}__isnull": True})
+        return Q(**{name: value})
+
+    def ordering(self):
+        """Сортировка ключа в виде order_by: ["-price", "id"]."""
+        return [f"{'-' if descending else ''}{name}" for name, descending, _ in self.keys]
+
+    def encode_cursor(self, obj):
+        values = [getattr(obj, name) for name, _, _ in self.keys]
+        raw = json.dumps(
+            {"order": self.ordering(), "values": values},
+            cls=_CursorEncoder,
+            separators=(",", ":"),
+        )
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+    def decode_cursor(self, cursor):
+        """
+        Значения ключа из курсора. ValueError — курсор повреждён
+        или выдан для другой сортировки.
+        """
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError("Некорректный курсор") from e
+        if not isinstance(data, dict) or data.get("order") != self.ordering():
+            raise ValueError("Курсор не соответствует сортировке")
+        values = data.get("values")
+        if not isinstance(values, list) or len(values) != len(self.keys):
+            raise ValueError("Некорректный курсор")
+        try:
+            return [
+                None if value is None else self._field(name).to_python(value)
+                for (name, _, _), value in zip(self.keys, values)
+            ]
+        except (ValidationError, TypeError) as e:
+            raise ValueError("Некорректный курсор") from e
+
+    def page(self, cursor=None):
+        """
+        Возвращает (объекты страницы, курсор следующей страницы или None).
+        Берётся per_page + 1 строка, чтобы узнать о следующей странице без COUNT.
+        """
+        queryset = self.queryset
+        if cursor:
+            values = self.decode_cursor(cursor)
+            condition = Q()
+            for index, (name, descending, nulls_last) in enumerate(self.keys):
+                step = self._after(name, descending, nulls_last, values[index])
+                for (prev_name, _, _), prev_value in zip(self.keys[:index], values):
+                    step &= self._equal(prev_name, prev_value)
+                condition |= step
+            queryset = queryset.filter(condition)
+
+        items = list(queryset[: self.per_page + 1])
+        has_next = len(items) > self.per_page
+        items = items[: self.per_page]
+        next_cursor = self.encode_cursor(items[-1]) if has_next else None
+        return items, next_cursor
+
+
+def paginate_by_cursor(queryset, request, per_page):
+    """
+    Страница queryset по GET-параметру cursor (пустой — первая страница).
+    with_count=1 добавляет точное total_items, иначе COUNT не выполняется.
+    Повреждённый курсор или курсор другой сортировки — ошибка 400,
+    а не тихий возврат к первой странице.
+    Возвращает (объекты, pagination).
+    """
+    paginator = CursorPaginator(queryset, per_page)
+    cursor = request.GET.get("cursor") or None
+    try:
+        items, next_cursor = paginator.page(cursor)
+    except ValueError as e:
+        raise exceptions.ValidationError({"cursor": [str(e)]}) from e
+
+    pagination = {
+        "cursor": cursor,
+        "next_cursor": next_cursor,
+        "has_next": next_cursor is not None,
+        "has_previous": cursor is not None,
+        "per_page": per_page,
+        "total_items": queryset.count() if request.GET.get("with_count") == "1" else None,
+    }
+    return items, pagination
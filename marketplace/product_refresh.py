@@ -0,0 +1,156 @@
+"""
+Отложенный пересчёт производных полей товаров (is_active, строка каталога,
+индекс фасетов, версии кеша ответов).
+
+Сигналы не пересчитывают товар сразу, а отмечают его как изменённый.
+Набор изменённых товаров копится в пределах транзакции и обрабатывается
+один раз в transaction.on_commit set-based запросами, поэтому сохранение
+50 остатков одного товара приводит к одному пересчёту.
+"""
+
+import threading
+
+from django.db import transaction
+from django.db.models import Exists, Max, Min, OuterRef, Subquery
+
+from .models import Product, ProductListing, ProductVariant
+
+_local = threading.local()
+
+
+class _DirtyBatch:
+    """Изменённые товары одной транзакции."""
+
+    def __init__(self, hooks):
+        # Список on_commit-колбэков соединения: Django создаёт новый список
+        # для каждой транзакции, по нему отличаем текущую транзакцию от прошлой
+        self.hooks = hooks
+        self.product_ids = set()
+
+    def flush(self):
+        product_ids, self.product_ids = self.product_ids, set()
+        if product_ids:
+            refresh_products(product_ids)
+
+
+def mark_products_dirty(product_ids, using=None):
+    """Отмечает товары для пересчёта после коммита текущей транзакции."""
+    product_ids = {pk for pk in product_ids if pk}
+    if not product_ids:
+        return
+
+    connection = transaction.get_connection(using)
+    batch = getattr(_local, "batch", None)
+    if batch is None or batch.hooks is not connection.run_on_commit:
+        batch = _DirtyBatch(connection.run_on_commit)
+        _local.batch = batch
+
+    batch.product_ids |= product_ids
+    # Колбэк регистрируется на каждую отметку: если часть транзакции
+    # откатится до savepoint, оставшиеся колбэки всё равно выполнят пересчёт.
+    # Первый выполненный забирает весь набор, остальные ничего не делают.
+    transaction.on_commit(batch.flush, using=using)
+
+
+def available_variant_exists():
+    """Exists по видимому варианту товара с положительным остатком на складах."""
+    return Exists(
+        ProductVariant.objects.filter(product=OuterRef("pk"), show_this=True).in_stock()
+    )
+
+
+def price_bounds():
+    """
+    Выражения min/max цены товара со скидкой для UPDATE — по тем же вариантам,
+    что и цена карточки (ProductListing.min_price): видимым и с остатком на складах.
+    """
+    prices = (
+        ProductVariant.objects.filter(product=OuterRef("pk"), show_this=True)
+        .in_stock()
+        .order_by()
+        .values("product")
+        .annotate(low=Min("effective_price"), high=Max("effective_price"))
+    )
+    return {
+        "min_effective_price": Subquery(prices.values("low")),
+        "max_effective_price": Subquery(prices.values("high")),
+    }
+
+
+def refresh_is_active(products):
+    """
+    Пересчитывает is_active для queryset товаров двумя UPDATE,
+    которые затрагивают только изменившиеся строки.
+    Возвращает (включено, выключено).
+    """
+    activated = (
+        products.filter(is_active=False)
+        .filter(available_variant_exists())
+        .update(is_active=True)
+    )
+    deactivated = (
+        products.filter(is_active=True)
+        .exclude(available_variant_exists())
+        .update(is_active=False)
+    )
+    return activated, deactivated
+
+
+def refresh_products(product_ids):
+    """
+    Пересчитывает производные поля и строки каталога сразу для набора товаров,
+    сообщает индексам фасетов, какие товары перечитать, и обновляет версии
+    кеша ответов каталога. Поисковый индекс обновляется отдельно, через
+    очередь SearchOutbox (marketplace.search).
+    """
+    from .catalog_cache import invalidate_products
+    from .facet_index import publish_changes
+    from .listing import rebuild_listings
+
+    # Категории до изменения: товар мог переехать в другую категорию
+    previous_categories = set(
+        ProductListing.objects.filter(product_id__in=product_ids).values_list(
+            "category_id", flat=True
+        )
+    )
+    products = Product.objects.filter(pk__in=product_ids)
+    refresh_is_active(products)
+    products.update(**price_bounds())
+    rebuild_listings(product_ids)
+    publish_changes(product_ids)
+    invalidate_products(product_ids, previous_categories)
+
+
+def reconcile_is_active(products=None, chunk_size=10000):
+    """
+    Пересчитывает is_active и min/max цену для всего каталога (или queryset
+    товаров) одним UPDATE ... SET is_active = EXISTS(...) на каждый диапазон
+    первичных ключей, без сигналов и загрузки товаров в Python, и пересобирает
+    строки каталога диапазона. В конце индексы фасетов строятся заново
+    и кеш ответов каталога сбрасывается целиком.
+    Нужен после массового импорта и loaddata. Возвращает число обработанных товаров.
+    """
+    from .catalog_cache import invalidate_catalog
+    from .facet_index import publish_changes
+    from .listing import rebuild_listings
+
+    if products is None:
+        products = Product.objects.all()
+
+    bounds = products.aggregate(first=Min("pk"), last=Max("pk"))
+    if bounds["first"] is None:
+        return 0
+
+    processed = 0
+    start = bounds["first"]
+    while start <= bounds["last"]:
+        end = start + chunk_size
+        with transaction.atomic():
+            chunk = products.filter(pk__gte=start, pk__lt=end)
+            processed += chunk.update(is_active=available_variant_exists(), **price_bounds())
+            rebuild_listings(chunk.values_list("pk", flat=True))
+        start = end
+
+    publish_changes()
+    invalidate_catalog()
+    return processed
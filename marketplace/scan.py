@@ -0,0 +1,189 @@
+"""
+Поиск варианта по отсканированному штрихкоду или артикулу на кассе.
+
+Точное совпадение по уникальным индексам barcode и sku в пределах
+бизнеса (по slug, чтобы не загружать сам бизнес). Найденный вариант
+(название, цены, id) запоминается в LRU текущего процесса по (бизнес,
+код), поэтому повторный скан — один запрос остатков по id варианта,
+а первый — один запрос варианта вместе с остатками (LEFT JOIN).
+Остатки не кешируются: они меняются с каждой продажей. Изменение
+вариантов и товаров увеличивает счётчик поколения в общем кеше Django,
+и LRU всех процессов сбрасываются при следующем скане; изменения
+в обход сигналов (update, импорт) видны не позже чем через ENTRY_TTL.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from .models import ProductStock, ProductVariant
+
+GENERATION_KEY = "pos_scan:generation"
+# Сколько кодов помнит процесс
+MAX_ENTRIES = 10000
+# Сколько секунд процесс помнит вариант
+ENTRY_TTL = 60
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_generation = None
+
+STOCK_FIELDS = (
+    "location_id",
+    "location__name",
+    "location__location_type__is_warehouse",
+    "is_available_for_sale",
+    "quantity",
+    "reserved_quantity",
+    "defect_quantity",
+    "sold_quantity",
+)
+
+
+def invalidate_scan_cache():
+    """Сбрасывает LRU сканов всех процессов (после коммита текущей транзакции)."""
+
+    def bump():
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.add(GENERATION_KEY, 0, timeout=None)
+            cache.incr(GENERATION_KEY)
+
+    transaction.on_commit(bump)
+
+
+def reset_scan_cache():
+    """Забывает LRU текущего процесса."""
+    with _lock:
+        _entries.clear()
+
+
+def _sync_generation():
+    """Сбрасывает LRU процесса, если поколение в кеше изменилось; возвращает поколение."""
+    global _generation
+    generation = cache.get(GENERATION_KEY, 0)
+    with _lock:
+        if generation != _generation:
+            _entries.clear()
+            _generation = generation
+    return generation
+
+
+def _location(row, prefix=""):
+    quantity = row[f"{prefix}quantity"]
+    reserved = row[f"{prefix}reserved_quantity"]
+    defect = row[f"{prefix}defect_quantity"]
+    sold = row[f"{prefix}sold_quantity"]
+    return {
+        "location_id": row[f"{prefix}location_id"],
+        "name": row[f"{prefix}location__name"],
+        "is_warehouse": row[f"{prefix}location__location_type__is_warehouse"],
+        "is_available_for_sale": row[f"{prefix}is_available_for_sale"],
+        "quantity": quantity,
+        "available": quantity - reserved - defect - sold,
+        "reserved": reserved,
+    }
+
+
+def _lookup(business_slug, code):
+    """Вариант с остатками одним запросом: (данные варианта, локации) или None."""
+    rows = list(
+        ProductVariant.objects.filter(
+            Q(barcode=code) | Q(sku=code), product__business__slug=business_slug
+        )
+        .order_by("pk", "stocks__location_id")
+        .values(
+            "pk",
+            "product_id",
+            "product__name",
+            "has_custom_name",
+            "custom_name",
+            "barcode",
+            "sku",
+            "price",
+            "discount",
+            "effective_price",
+            *(f"stocks__{field}" for field in STOCK_FIELDS),
+        )
+    )
+    if not rows:
+        return None
+    # Код может совпасть со штрихкодом одного варианта и артикулом другого:
+    # штрихкод важнее
+    variant_id = next((row["pk"] for row in rows if row["barcode"] == code), rows[0]["pk"])
+    rows = [row for row in rows if row["pk"] == variant_id]
+    first = rows[0]
+    variant = {
+        "variant_id": first["pk"],
+        "product_id": first["product_id"],
+        "name": (
+            first["custom_name"]
+            if first["has_custom_name"] and first["custom_name"]
+            else first["product__name"]
+        ),
+        "barcode": first["barcode"],
+        "sku": first["sku"],
+        "price": first["price"],
+        "discount": first["discount"],
+        "current_price": first["effective_price"],
+    }
+    locations = [
+        _location(row, "stocks__") for row in rows if row["stocks__location_id"] is not None
+    ]
+    return variant, locations
+
+
+def _stocks(variant_id):
+    return [
+        _location(row)
+        for row in ProductStock.objects.filter(variant_id=variant_id)
+        .order_by("location_id")
+        .values(*STOCK_FIELDS)
+    ]
+
+
+def scan(business_slug, code):
+    """
+    Вариант бизнеса по штрихкоду или артикулу с ценой и остатками по локациям.
+    Возвращает словарь для кассы или None, если код не найден.
+    """
+    code = code.strip()
+    if not code:
+        return None
+    key = (business_slug, code)
+    generation = _sync_generation()
+    now = time.monotonic()
+    with _lock:
+        variant, expires_at = _entries.get(key, (None, None))
+        if variant is not None and expires_at <= now:
+            del _entries[key]
+            variant = None
+        elif variant is not None:
+            _entries.move_to_end(key)
+
+    if variant is not None:
+        locations = _stocks(variant["variant_id"])
+    else:
+        found = _lookup(business_slug, code)
+        if found is None:
+            return None
+        variant, locations = found
+        with _lock:
+            # Поколение могло смениться, пока шёл запрос
+            if generation == _generation:
+                _entries[key] = (variant, now + ENTRY_TTL)
+                while len(_entries) > MAX_ENTRIES:
+                    _entries.popitem(last=False)
+
+    return {
+        **variant,
+        "available": sum(
+            location["available"] for location in locations if location["is_warehouse"]
+        ),
+        "locations": locations,
+    }
@@ -0,0 +1,582 @@
+"""
+Полнотекстовый поиск товаров.
+
+Поиск отделён от queryset интерфейсом SearchBackend: бэкенд по строке
+запроса строит условие фильтра и выражение релевантности для сортировки.
+Они вычисляются в том же запросе, что и остальные фильтры (бизнес,
+категория, видимость), поэтому выдача не ограничена лучшими товарами
+всего маркетплейса. Бэкенд выбирается настройкой MARKETPLACE_SEARCH_BACKEND:
+
+- DatabaseSearchBackend — таблица ProductSearchDocument с FULLTEXT
+  на MySQL и FTS5 на SQLite, на других СУБД — поиск подстроки;
+- LikeSearchBackend — прежний поиск подстроки без внешних зависимостей;
+- ElasticsearchSearchBackend — индекс Elasticsearch (marketplace.documents);
+  внешний индекс не видит фильтров queryset, поэтому выдача — SEARCH_LIMIT
+  лучших товаров маркетплейса.
+
+Документы собираются build_documents одинаково для всех бэкендов.
+
+Слова запроса приводятся к основе русским стеммером и ищутся как
+префиксы, поэтому находятся все формы слова. Если запрос ничего не
+нашёл среди товаров выдачи (того же queryset), слова с опечатками
+заменяются похожими словами словаря (marketplace.trigrams).
+
+Изменения товаров попадают в индекс через транзакционную очередь
+SearchOutbox: сигналы пишут в неё в той же транзакции, а после коммита
+процесс сам индексирует только товары этой транзакции, не больше
+ON_COMMIT_LIMIT (MARKETPLACE_SEARCH_INDEX_ON_COMMIT). Очередь целиком —
+переименования категорий и значений атрибутов, импорт, записи, которые
+не удалось проиндексировать, — разбирает команда drain_search_outbox;
+её нужно запускать по расписанию (cron раз в минуту) или постоянно
+с --interval. Полная переиндексация (reindex) идёт параллельно
+по диапазонам первичных ключей и не блокирует запись.
+"""
+
+import hashlib
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.db.models import (
+    Case,
+    Exists,
+    F,
+    FloatField,
+    Func,
+    IntegerField,
+    Max,
+    Min,
+    OuterRef,
+    Q,
+    Value,
+    When,
+)
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import trigrams
+from .catalog_cache import bump_versions, get_versions
+from .models import (
+    Product,
+    ProductSearchDocument,
+    ProductVariant,
+    ProductVariantAttribute,
+    SearchOutbox,
+)
+from .stemmer import stem
+
+# Сколько лучших результатов возвращает внешний индекс (Elasticsearch)
+SEARCH_LIMIT = 1000
+# Результаты внешнего индекса и исправления опечаток переиспользуются
+# до изменения индекса (секунды)
+SEARCH_CACHE_TIMEOUT = 600
+# Область версий кеша: увеличивается при каждом обновлении индекса
+SEARCH_SCOPE = "search"
+# Записей очереди и товаров переиндексации за одну пачку
+BATCH_SIZE = 1000
+# Сколько товаров транзакции индексируется сразу после её коммита
+ON_COMMIT_LIMIT = 100
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def query_terms(query):
+    """Слова запроса без знаков операторов полнотекстового поиска."""
+    return _WORD.findall(trigrams.normalize_word(query))
+
+
+def term_prefix(term):
+    """Префикс для поиска форм слова: основа, если она не слишком коротка."""
+    base = stem(term)
+    return base if len(base) >= trigrams.MIN_LENGTH else term
+
+
+def build_documents(product_ids):
+    """
+    Несохранённые ProductSearchDocument для товаров: название отдельно,
+    остальной текст — описание, варианты, значения атрибутов, категория.
+    """
+    parts = defaultdict(list)
+    for product_id, custom_name, sku in ProductVariant.objects.filter(
+        product_id__in=product_ids
+    ).values_list("product_id", "custom_name", "sku"):
+        parts[product_id].extend(value for value in (custom_name, sku) if value)
+
+    for product_id, value, custom_value in ProductVariantAttribute.objects.filter(
+        variant__product_id__in=product_ids
+    ).values_list("variant__product_id", "predefined_value__value", "custom_value"):
+        parts[product_id].append(value or custom_value or "")
+
+    documents = []
+    for pk, name, description, category_name in Product.objects.filter(
+        pk__in=product_ids
+    ).values_list("pk", "name", "description", "category__name"):
+        body = [description or "", category_name or "", *dict.fromkeys(parts[pk])]
+        documents.append(
+            ProductSearchDocument(
+                product_id=pk, name=name, body="\n".join(filter(None, body))
+            )
+        )
+    return documents
+
+
+class Match(Func):
+    """MATCH (колонки) AGAINST (запрос IN BOOLEAN MODE) в MySQL."""
+
+    output_field = FloatField()
+
+    def __init__(self, *columns, query):
+        super().__init__(*columns)
+        self.query = query
+
+    def as_sql(self, compiler, connection, **extra_context):
+        columns, params = [], []
+        for expression in self.get_source_expressions():
+            sql, column_params = compiler.compile(expression)
+            columns.append(sql)
+            params.extend(column_params)
+        return f"MATCH ({', '.join(columns)}) AGAINST (%s IN BOOLEAN MODE)", [
+            *params,
+            self.query,
+        ]
+
+
+class Fts5Rank(Func):
+    """Релевантность товара по таблице FTS5 в SQLite (больше — выше)."""
+
+    output_field = FloatField()
+
+    def __init__(self, product_id, match):
+        super().__init__(product_id)
+        self.match = match
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.get_source_expressions()[0])
+        table = DatabaseSearchBackend.fts_table
+        return (
+            f"(SELECT -bm25({table}, 3.0, 1.0) FROM {table} "
+            f"WHERE {table} MATCH %s AND rowid = {sql})",
+            [self.match, *params],
+        )
+
+
+class SearchBackend(ABC):
+    """
+    Интерфейс поискового бэкенда. path — путь к товару от модели queryset:
+    "" для товаров, "product__" для строк каталога.
+    """
+
+    @abstractmethod
+    def matches(self, query, path=""):
+        """Условие фильтра «товар найден по запросу»."""
+
+    @abstractmethod
+    def rank(self, query, path=""):
+        """Выражение релевантности найденного товара: больше — выше в выдаче."""
+
+    @abstractmethod
+    def index_products(self, product_ids):
+        """Обновляет документы товаров; удалённые товары убираются из индекса."""
+
+    @abstractmethod
+    def clear(self):
+        """Удаляет все документы (перед полной переиндексацией)."""
+
+
+class LikeSearchBackend(SearchBackend):
+    """Поиск подстроки по товару и его вариантам, без индекса."""
+
+    def matches(self, query, path=""):
+        variants = ProductVariant.objects.filter(
+            product=OuterRef(f"{path}pk"), custom_name__icontains=query
+        )
+        return (
+            Q(**{f"{path}name__icontains": query})
+            | Q(**{f"{path}description__icontains": query})
+            | Exists(variants)
+        )
+
+    def rank(self, query, path=""):
+        # Совпадение в названии выше совпадений в описании и вариантах
+        return Case(
+            When(**{f"{path}name__icontains": query}, then=Value(1)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+
+    def index_products(self, product_ids):
+        pass
+
+    def clear(self):
+        pass
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """
+    Полнотекстовый индекс в основной базе по ProductSearchDocument.
+    Все слова запроса обязательны и ищутся как префиксы по основе
+    (формы слова и поиск по мере ввода); совпадение в названии весит больше.
+    Условие — подзапрос к полнотекстовому индексу, который база выполняет
+    один раз; релевантность считается только для строк выдачи.
+    """
+
+    fts_table = "marketplace_productsearch_fts"
+    document_table = ProductSearchDocument._meta.db_table
+
+    def matches(self, query, path=""):
+        terms = query_terms(query)
+        if not terms:
+            return Q(pk__in=[])
+        vendor = connection.vendor
+        if vendor == "mysql":
+            sql = (
+                f"SELECT product_id FROM {self.document_table} "
+                "WHERE MATCH(name, body) AGAINST (%s IN BOOLEAN MODE)"
+            )
+            return Q(**{f"{path}pk__in": RawSQL(sql, [self._boolean_query(terms)])})
+        if vendor == "sqlite":
+            sql = f"SELECT rowid FROM {self.fts_table} WHERE {self.fts_table} MATCH %s"
+            return Q(**{f"{path}pk__in": RawSQL(sql, [self._fts5_query(terms)])})
+        return LikeSearchBackend().matches(query, path)
+
+    def rank(self, query, path=""):
+        terms = query_terms(query)
+        vendor = connection.vendor
+        if not terms:
+            return Value(0, output_field=FloatField())
+        if vendor == "mysql":
+            boolean_query = self._boolean_query(terms)
+            name = F(f"{path}search_document__name")
+            body = F(f"{path}search_document__body")
+            return 3 * Match(name, query=boolean_query) + Match(
+                name, body, query=boolean_query
+            )
+        if vendor == "sqlite":
+            return Fts5Rank(F(f"{path}pk"), self._fts5_query(terms))
+        return LikeSearchBackend().rank(query, path)
+
+    @staticmethod
+    def _boolean_query(terms):
+        return " ".join(f"+{term_prefix(term)}*" for term in terms)
+
+    @staticmethod
+    def _fts5_query(terms):
+        # Слова в кавычках: в FTS5 они не считаются операторами
+        return " ".join(f'"{term_prefix(term)}"*' for term in terms)
+
+    def index_products(self, product_ids):
+        product_ids = list(product_ids)
+        documents = build_documents(product_ids)
+        ProductSearchDocument.objects.filter(product_id__in=product_ids).exclude(
+            product_id__in=[document.product_id for document in documents]
+        ).delete()
+        # MySQL не принимает unique_fields: ON DUPLICATE KEY срабатывает по любому ключу
+        unique_fields = (
+            ["product"] if connection.features.supports_update_conflicts_with_target else None
+        )
+        ProductSearchDocument.objects.bulk_create(
+            documents,
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=["name", "body", "updated_at"],
+        )
+
+    def clear(self):
+        ProductSearchDocument.objects.all().delete()
+
+
+class ElasticsearchSearchBackend(SearchBackend):
+    """Индекс Elasticsearch; подключение — из настройки ELASTICSEARCH_DSL."""
+
+    def __init__(self):
+        from .documents import ProductIndex
+
+        self.index = ProductIndex()
+
+    def ranked_ids(self, query):
+        """
+        id лучших SEARCH_LIMIT товаров по убыванию релевантности. Результат
+        кешируется до следующего обновления индекса: условие, ранг и страницы
+        одной выдачи не повторяют запрос к Elasticsearch.
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        (version,) = get_versions([SEARCH_SCOPE])
+        raw = f"{version}|{' '.join(terms)}"
+        key = f"search:{hashlib.sha1(raw.encode()).hexdigest()}"
+        ranked = cache.get(key)
+        if ranked is None:
+            ranked = self.index.search(query, SEARCH_LIMIT)
+            cache.set(key, ranked, SEARCH_CACHE_TIMEOUT)
+        return ranked
+
+    def matches(self, query, path=""):
+        return Q(**{f"{path}pk__in": self.ranked_ids(query)})
+
+    def rank(self, query, path=""):
+        ranked = self.ranked_ids(query)
+        if not ranked:
+            return Value(0, output_field=IntegerField())
+        return Case(
+            *(
+                When(**{f"{path}pk": pk}, then=Value(len(ranked) - position))
+                for position, pk in enumerate(ranked)
+            ),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+
+    def index_products(self, product_ids):
+        product_ids = list(product_ids)
+        documents = build_documents(product_ids)
+        found = {document.product_id for document in documents}
+        self.index.bulk_index(
+            documents, deleted=[pk for pk in product_ids if pk not in found]
+        )
+
+    def clear(self):
+        self.index.recreate()
+
+
+_backend = None
+
+
+def get_search_backend():
+    """Бэкенд из MARKETPLACE_SEARCH_BACKEND (один на процесс)."""
+    global _backend
+    path = getattr(
+        settings, "MARKETPLACE_SEARCH_BACKEND", "marketplace.search.DatabaseSearchBackend"
+    )
+    if _backend is None or _backend[0] != path:
+        _backend = (path, import_string(path)())
+    return _backend[1]
+
+
+def index_products(product_ids):
+    """Обновляет документы товаров в бэкенде; закешированные выдачи устаревают."""
+    get_search_backend().index_products(product_ids)
+    trigrams.add_terms(product_ids)
+    bump_versions([SEARCH_SCOPE])
+
+
+class _PendingIndex:
+    """Товары, поставленные в очередь одной транзакцией."""
+
+    def __init__(self, hooks):
+        # Список on_commit-колбэков соединения отличает транзакцию (как в product_refresh)
+        self.hooks = hooks
+        self.product_ids = set()
+        # Записи очереди, id которых известны после вставки (не MySQL)
+        self.row_ids = set()
+        self.done = False
+
+    def __call__(self):
+        if self.done:
+            return
+        self.done = True
+        if getattr(_local, "pending", None) is self:
+            _local.pending = None
+        # Большие изменения (импорт) не задерживают ответ — их разберёт команда
+        if len(self.product_ids) > ON_COMMIT_LIMIT:
+            return
+        index_products(self.product_ids)
+        if self.row_ids:
+            SearchOutbox.objects.filter(pk__in=self.row_ids).delete()
+
+
+_local = threading.local()
+
+
+def _index_after_commit(rows):
+    connection = transaction.get_connection()
+    pending = getattr(_local, "pending", None)
+    if pending is None or pending.hooks is not connection.run_on_commit:
+        pending = _PendingIndex(connection.run_on_commit)
+        _local.pending = pending
+    pending.product_ids.update(row.product_id for row in rows)
+    pending.row_ids.update(row.pk for row in rows if row.pk)
+    # Колбэк регистрируется на каждую запись (откат до savepoint не теряет индексацию);
+    # ошибка индекса не ломает ответ — записи дождутся drain_search_outbox
+    transaction.on_commit(pending, robust=True)
+
+
+def enqueue(product_ids=(), category_ids=(), value_ids=()):
+    """
+    Записывает изменения в очередь индекса в текущей транзакции:
+    при откате записи исчезают вместе с изменением. После коммита
+    процесс сам индексирует товары этой транзакции; категории и значения
+    атрибутов (изменения многих товаров) остаются команде drain_search_outbox.
+    """
+    product_rows = [SearchOutbox(product_id=pk) for pk in set(product_ids) if pk]
+    rows = product_rows + [SearchOutbox(category_id=pk) for pk in set(category_ids) if pk]
+    rows += [SearchOutbox(attribute_value_id=pk) for pk in set(value_ids) if pk]
+    if not rows:
+        return
+    SearchOutbox.objects.bulk_create(rows)
+    if product_rows and getattr(settings, "MARKETPLACE_SEARCH_INDEX_ON_COMMIT", True):
+        _index_after_commit(product_rows)
+
+
+def drain_outbox(batch_size=BATCH_SIZE):
+    """
+    Переносит изменения из очереди в индекс пачками.
+    Записи читаются без блокировок и удаляются по id после индексации:
+    запись, которая появится во время пачки, дождётся следующей. Документы
+    строятся по текущему состоянию товаров, поэтому повторная обработка
+    безопасна и разборщики можно запускать параллельно. Возвращает число записей.
+    """
+    processed = 0
+    while True:
+        rows = list(
+            SearchOutbox.objects.order_by("pk").values_list(
+                "pk", "product_id", "category_id", "attribute_value_id"
+            )[:batch_size]
+        )
+        if not rows:
+            return processed
+        product_ids = {row[1] for row in rows if row[1]}
+        category_ids = {row[2] for row in rows if row[2]}
+        value_ids = {row[3] for row in rows if row[3]}
+        if category_ids:
+            product_ids.update(
+                Product.objects.filter(category_id__in=category_ids).values_list(
+                    "pk", flat=True
+                )
+            )
+        if value_ids:
+            product_ids.update(
+                ProductVariantAttribute.objects.filter(
+                    predefined_value_id__in=value_ids
+                ).values_list("variant__product_id", flat=True)
+            )
+        if product_ids:
+            index_products(product_ids)
+        SearchOutbox.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        processed += len(rows)
+        if len(rows) < batch_size:
+            return processed
+
+
+def index_range(bounds, chunk_size=BATCH_SIZE):
+    """Индексирует товары с pk в полуинтервале bounds = (start, end)."""
+    start, end = bounds
+    backend = get_search_backend()
+    processed = 0
+    last_pk = start - 1
+    while True:
+        product_ids = list(
+            Product.objects.filter(pk__gt=last_pk, pk__lt=end)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:chunk_size]
+        )
+        if not product_ids:
+            return processed
+        backend.index_products(product_ids)
+        trigrams.add_terms(product_ids)
+        processed += len(product_ids)
+        last_pk = product_ids[-1]
+
+
+def _start_worker():
+    import django
+
+    # При запуске через spawn дочернему процессу нужна настройка Django
+    django.setup()
+
+
+def reindex(workers=1, chunk_size=BATCH_SIZE, clear=False):
+    """
+    Строит поисковые документы всех товаров. Диапазон первичных ключей
+    делится на части, которые индексируют workers процессов; каждая пачка —
+    отдельная короткая запись, без блокировки таблиц товаров.
+    Изменения во время переиндексации ложатся в очередь и применяются
+    drain_outbox. clear=True сначала очищает индекс (поиск будет неполным
+    до конца перестроения). После прохода из словаря опечаток удаляются
+    слова, которых не было ни в одном товаре. Возвращает число товаров.
+    """
+    started = timezone.now()
+    if clear:
+        get_search_backend().clear()
+        trigrams.clear_terms()
+    bounds = Product.objects.aggregate(first=Min("pk"), last=Max("pk"))
+    if bounds["first"] is None:
+        trigrams.prune_terms(started)
+        return 0
+
+    if connection.vendor == "sqlite":
+        # SQLite допускает одного пишущего: процессы только ждали бы блокировку
+        workers = 1
+    first, last = bounds["first"], bounds["last"] + 1
+    # Частей больше, чем процессов: неравномерные диапазоны выравниваются
+    parts = workers * 4 if workers > 1 else 1
+    step = max((last - first + parts - 1) // parts, 1)
+    ranges = [(start, min(start + step, last)) for start in range(first, last, step)]
+
+    if workers > 1:
+        # Дочерние процессы открывают свои соединения: общее соединение
+        # после fork использовать нельзя
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker) as pool:
+            processed = sum(
+                pool.map(partial(index_range, chunk_size=chunk_size), ranges)
+            )
+    else:
+        processed = sum(index_range(bounds, chunk_size) for bounds in ranges)
+    trigrams.prune_terms(started)
+    bump_versions([SEARCH_SCOPE])
+    return processed
+
+
+def search_condition(query, path=""):
+    """Условие фильтра по поисковому запросу для текущего бэкенда."""
+    return get_search_backend().matches(query, path)
+
+
+def search_rank(query, path=""):
+    """Релевантность для сортировки по убыванию (F(...).desc(nulls_last=True))."""
+    return get_search_backend().rank(query, path)
+
+
+def corrected_query(query, queryset=None):
+    """
+    Запрос для поиска в queryset (по умолчанию — всех товаров): если он
+    ничего не находит в queryset, слова с опечатками заменяются похожими
+    словами словаря (marketplace.trigrams). Решение принимается по каждой
+    выдаче, кешируется только исправление — до следующего обновления индекса.
+    """
+    if queryset is None:
+        queryset = Product.objects.all()
+    if queryset.filter(search_condition(query)).exists():
+        return query
+    terms = query_terms(query)
+    if not terms:
+        return query
+    (version,) = get_versions([SEARCH_SCOPE])
+    raw = f"{version}|{' '.join(terms)}"
+    key = f"search:corrected:{hashlib.sha1(raw.encode()).hexdigest()}"
+    corrected = cache.get(key)
+    if corrected is None:
+        corrected = " ".join(trigrams.correct_query(terms))
+        cache.set(key, corrected, SEARCH_CACHE_TIMEOUT)
+    return corrected
+
+
+def search_products(query, queryset=None):
+    """id товаров queryset (по умолчанию — всех), найденных по запросу, по релевантности."""
+    if queryset is None:
+        queryset = Product.objects.all()
+    query = corrected_query(query, queryset)
+    return list(
+        queryset.filter(search_condition(query))
+        .annotate(search_rank=search_rank(query))
+        .order_by(F("search_rank").desc(nulls_last=True), "-pk")
+        .values_list("pk", flat=True)
+    )
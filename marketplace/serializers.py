@@ -9,7 +9,9 @@ from .models import (
     ProductStock,
     Attribute,
     CategoryAttribute,
+    ProductListing,
 )
+from .stock import resolve_product_availability
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -81,7 +83,8 @@ class ProductVariantSerializer(serializers.ModelSerializer):
     stocks = ProductStockSerializer(many=True, read_only=True)
     current_price = serializers.SerializerMethodField()
     discount_amount = serializers.SerializerMethodField()  # Исправлено название
-    is_in_stock = serializers.BooleanField(read_only=True)
+    stock_quantity = serializers.SerializerMethodField()
+    is_in_stock = serializers.SerializerMethodField()
     display_name = serializers.SerializerMethodField()
     display_description = serializers.SerializerMethodField()
 
@@ -107,6 +110,25 @@ class ProductVariantSerializer(serializers.ModelSerializer):
             "stocks",
         ]
 
+    def _availability(self, obj):
+        """Остатки варианта из context["availability"] (stock.resolve_availability)"""
+        availability = self.context.get("availability")
+        if availability is None:
+            return None
+        return availability[obj.id]
+
+    def get_stock_quantity(self, obj):
+        entry = self._availability(obj)
+        if entry is None:
+            return obj.stock_quantity
+        return entry["quantity"] - entry["defect"]
+
+    def get_is_in_stock(self, obj):
+        entry = self._availability(obj)
+        if entry is None:
+            return obj.is_in_stock
+        return entry["available"] > 0
+
     def get_display_name(self, obj):
         return obj.name
 
@@ -157,16 +179,18 @@ class ProductListSerializer(serializers.ModelSerializer):
         ]
 
     def get_default_variant(self, obj):
-        variant = obj.default_variant
+        variant = obj.get_default_variant(
+            strict=True, availability=self.context.get("availability")
+        )
 
-        return ProductVariantSerializer(variant).data
+        return ProductVariantSerializer(variant, context=self.context).data
 
     def get_min_price(self, obj):
-        min_price, _ = obj.price_range
+        min_price, _ = obj.get_price_range(self.context.get("availability"))
         return min_price
 
     def get_max_price(self, obj):
-        _, max_price = obj.price_range
+        _, max_price = obj.get_price_range(self.context.get("availability"))
         return max_price
 
     def get_main_image(self, obj):
@@ -176,6 +200,43 @@ class ProductListSerializer(serializers.ModelSerializer):
         return None
 
 
+class ProductListingSerializer(serializers.ModelSerializer):
+    """
+    Карточка товара из строки каталога (ProductListing).
+    Формат совпадает с ProductListSerializer.
+    """
+
+    id = serializers.IntegerField(source="product_id", read_only=True)
+    category = serializers.IntegerField(source="category_id", read_only=True)
+    business = serializers.IntegerField(source="business_id", read_only=True)
+    min_price = serializers.SerializerMethodField()
+    max_price = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ProductListing
+        fields = [
+            "id",
+            "name",
+            "description",
+            "is_active",
+            "category",
+            "category_name",
+            "business",
+            "business_name",
+            "default_variant",
+            "min_price",
+            "max_price",
+            "created_at",
+            "main_image",
+        ]
+
+    def get_min_price(self, obj):
+        return float(obj.min_price) if obj.min_price is not None else None
+
+    def get_max_price(self, obj):
+        return float(obj.max_price) if obj.max_price is not None else None
+
+
 class ProductDetailSerializer(serializers.ModelSerializer):
     category_name = serializers.CharField(source="category.name", read_only=True)
     business_name = serializers.CharField(source="business.name", read_only=True)
@@ -210,22 +271,43 @@ class ProductDetailSerializer(serializers.ModelSerializer):
     def get_available_attributes(self, obj):
         return obj.available_attributes
 
+    def _availability(self, obj):
+        """Остатки вариантов товара: из контекста или одним запросом на товар"""
+        availability = self.context.get("availability")
+        if availability is not None:
+            return availability
+        if not hasattr(self, "_resolved"):
+            self._resolved = {}
+        if obj.id not in self._resolved:
+            self._resolved[obj.id] = resolve_product_availability(
+                [obj], visible_only=True
+            )
+        return self._resolved[obj.id]
+
     def get_default_variant(self, obj):
-        variant = obj.get_default_variant(strict=True)
+        availability = self._availability(obj)
+        variant = obj.get_default_variant(strict=True, availability=availability)
         if variant:
-            return ProductVariantSerializer(variant).data
+            return ProductVariantSerializer(
+                variant, context={**self.context, "availability": availability}
+            ).data
         return None
 
     def get_variants(self, obj):
+        availability = self._availability(obj)
         valid_variants = [
             v
-            for v in obj.variants.filter(show_this=True)
-            if v.available_quantity > 0
+            for v in obj.variants.all()
+            if v.show_this and availability.available(v.id) > 0
         ]
-        return ProductVariantSerializer(valid_variants, many=True).data
+        return ProductVariantSerializer(
+            valid_variants,
+            many=True,
+            context={**self.context, "availability": availability},
+        ).data
 
     def get_price_range(self, obj):
-        min_price, max_price = obj.price_range
+        min_price, max_price = obj.get_price_range(self._availability(obj))
         if min_price is None:
             return None
         return {
@@ -1,27 +1,140 @@
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import ProductStock, ProductDefect, ProductSale
+from core.models import Business
+from .catalog_cache import invalidate_catalog, invalidate_categories
+from .facet_index import publish_changes
+from .models import (
+    Attribute,
+    AttributeValue,
+    Category,
+    CategoryAttribute,
+    Product,
+    ProductImage,
+    ProductListing,
+    ProductStock,
+    ProductVariant,
+    ProductVariantAttribute,
+)
+from .product_refresh import mark_products_dirty
+from .scan import invalidate_scan_cache
+from .search import enqueue as enqueue_search
+
+# Брак, продажи и резервы проходят через журнал движений (marketplace.stock),
+# который сам отмечает товары для пересчёта; здесь остаются изменения,
+# которые мимо журнала: смена локации, удаление остатка, правка варианта,
+# а также поля карточки в строке каталога (ProductListing).
 
 
 @receiver([post_save, post_delete], sender=ProductStock)
 def update_product_is_active_on_stock_change(sender, instance, **kwargs):
-    if instance.variant and instance.variant.product:
-        instance.variant.product.update_is_active()
+    mark_products_dirty(
+        ProductVariant.objects.filter(pk=instance.variant_id).values_list(
+            "product_id", flat=True
+        )
+    )
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+def update_product_is_active_on_variant_change(sender, instance, **kwargs):
+    """Видимость варианта и его удаление влияют на is_active товара"""
+    mark_products_dirty([instance.product_id])
+
+
+@receiver([post_save, post_delete], sender=Product)
+def update_listing_on_product_change(sender, instance, **kwargs):
+    mark_products_dirty([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def invalidate_cache_on_product_delete(sender, instance, **kwargs):
+    """Строки каталога удалённого товара уже нет — категорию берём из экземпляра"""
+    category_id = instance.category_id
+    transaction.on_commit(lambda: invalidate_categories([category_id]))
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def update_listing_on_image_change(sender, instance, **kwargs):
+    mark_products_dirty([instance.product_id])
+
+
+@receiver([post_save, post_delete], sender=ProductVariantAttribute)
+def update_listing_on_attribute_change(sender, instance, **kwargs):
+    mark_products_dirty(
+        ProductVariant.objects.filter(pk=instance.variant_id).values_list(
+            "product_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=Category)
+def update_listing_category_name(sender, instance, **kwargs):
+    ProductListing.objects.filter(category=instance).exclude(
+        category_name=instance.name
+    ).update(category_name=instance.name)
+
+
+@receiver(post_save, sender=Business)
+def update_listing_business_name(sender, instance, **kwargs):
+    ProductListing.objects.filter(business=instance).exclude(
+        business_name=instance.name
+    ).update(business_name=instance.name)
+    transaction.on_commit(invalidate_catalog)
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Attribute)
+@receiver([post_save, post_delete], sender=AttributeValue)
+@receiver([post_save, post_delete], sender=CategoryAttribute)
+def reset_facet_indexes_on_catalog_change(sender, instance, **kwargs):
+    """
+    Дерево категорий и подписи атрибутов меняются редко:
+    индексы фасетов строятся заново, кеш ответов каталога сбрасывается целиком
+    """
+    transaction.on_commit(publish_changes)
+    transaction.on_commit(invalidate_catalog)
+
+
+# Поисковый индекс: запись в очередь в транзакции изменения, индексация —
+# после коммита (marketplace.search.enqueue) и командой drain_search_outbox
+
+
+@receiver([post_save, post_delete], sender=Product)
+def enqueue_search_on_product_change(sender, instance, **kwargs):
+    enqueue_search([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+def enqueue_search_on_variant_change(sender, instance, **kwargs):
+    enqueue_search([instance.product_id])
+
+
+@receiver([post_save, post_delete], sender=ProductVariantAttribute)
+def enqueue_search_on_attribute_change(sender, instance, **kwargs):
+    enqueue_search(
+        ProductVariant.objects.filter(pk=instance.variant_id).values_list(
+            "product_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=Category)
+def enqueue_search_on_category_change(sender, instance, **kwargs):
+    """Название категории входит в документы всех её товаров"""
+    enqueue_search(category_ids=[instance.pk])
 
 
-@receiver([post_save, post_delete], sender=ProductDefect)
-def update_product_is_active_on_defect_change(sender, instance, **kwargs):
+@receiver(post_save, sender=AttributeValue)
+def enqueue_search_on_value_change(sender, instance, **kwargs):
     """
-    Обновляет is_active у продукта при изменении брака, так как он влияет на available_quantity.
+    Значение атрибута входит в документы товаров с ним; удалить
+    используемое значение нельзя (PROTECT), поэтому достаточно сохранения
     """
-    stock = instance.stock
-    if stock and stock.variant and stock.variant.product:
-        stock.variant.product.update_is_active()
+    enqueue_search(value_ids=[instance.pk])
 
 
-@receiver([post_save, post_delete], sender=ProductSale)
-def update_product_is_active_on_sale_change(sender, instance, **kwargs):
-    """Обновляет is_active при продаже или отмене продажи"""
-    variant = instance.variant
-    if variant and variant.product:
-        variant.product.update_is_active()
\ No newline at end of file
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductVariant)
+def invalidate_scan_cache_on_variant_change(sender, instance, **kwargs):
+    """Код, цена и название варианта в кеше сканов кассы устарели"""
+    invalidate_scan_cache()
@@ -0,0 +1,169 @@
+"""
+Расчёт похожих товаров (SimilarProduct) пакетной задачей.
+
+Товары обрабатываются группами: категории с общим родителем (соседние
+категории), так что кандидаты ищутся только среди близких товаров.
+Кандидаты для товара — товары с общими редкими значениями атрибутов
+(по инвертированному списку) и соседи по цене в своей категории;
+полный перебор пар не выполняется. Сходство складывается из взвешенного
+по IDF коэффициента Жаккара значений атрибутов, близости категорий
+и близости цен со скидкой.
+"""
+
+import heapq
+import math
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from django.db import transaction
+
+from .catalog_cache import bump_versions, product_scope
+from .facet_index import normalize_custom_value
+from .models import Category, Product, ProductVariantAttribute, SimilarProduct
+
+# Сколько похожих товаров хранится для товара
+TOP_K = 8
+# Веса составляющих сходства
+ATTRIBUTE_WEIGHT = 0.6
+CATEGORY_WEIGHT = 0.25
+PRICE_WEIGHT = 0.15
+# Близость категорий: та же категория / соседняя
+SAME_CATEGORY = 1.0
+SIBLING_CATEGORY = 0.5
+# Значения, которые есть у большего числа товаров группы,
+# не порождают кандидатов (но учитываются в сходстве)
+MAX_CANDIDATE_FREQUENCY = 200
+# Соседей по цене в своей категории с каждой стороны
+PRICE_NEIGHBOURS = 20
+
+
+def _product_features(product_ids):
+    """Значения атрибутов товаров: id значения или (атрибут, нормализованный текст)."""
+    features = defaultdict(set)
+    rows = (
+        ProductVariantAttribute.objects.filter(variant__product_id__in=product_ids)
+        .exclude(predefined_value__isnull=True, custom_value__isnull=True)
+        .values_list(
+            "variant__product_id",
+            "predefined_value_id",
+            "category_attribute__attribute_id",
+            "custom_value",
+        )
+    )
+    for product_id, value_id, attribute_id, custom_value in rows:
+        if value_id:
+            features[product_id].add(value_id)
+        else:
+            normalized = normalize_custom_value(custom_value)
+            if normalized:
+                features[product_id].add((attribute_id, normalized))
+    return features
+
+
+def _price_similarity(first, second):
+    if not first or not second:
+        return 0.0
+    return 1.0 / (1.0 + abs(math.log(float(first) / float(second))))
+
+
+def similar_for_group(products, top_k=TOP_K):
+    """
+    Похожие товары внутри группы соседних категорий.
+    products — список (id, category_id, min_effective_price, is_active).
+    Возвращает {id товара: [(score, id похожего), ...]} по убыванию сходства.
+    """
+    features = _product_features([pk for pk, _, _, _ in products])
+    frequency = Counter(value for values in features.values() for value in values)
+    weight = {
+        value: math.log(1 + len(products) / count) for value, count in frequency.items()
+    }
+
+    # Кандидатами бывают только активные товары
+    inverted = defaultdict(list)
+    by_category = defaultdict(list)
+    info = {}
+    for pk, category_id, price, is_active in products:
+        info[pk] = (category_id, price)
+        if not is_active:
+            continue
+        for value in features.get(pk, ()):
+            if frequency[value] <= MAX_CANDIDATE_FREQUENCY:
+                inverted[value].append(pk)
+        by_category[category_id].append((float(price or 0), pk))
+    for neighbours in by_category.values():
+        neighbours.sort()
+
+    result = {}
+    for pk, category_id, price, _ in products:
+        own = features.get(pk, set())
+        candidates = set()
+        for value in own:
+            candidates.update(inverted.get(value, ()))
+        neighbours = by_category.get(category_id, [])
+        position = bisect_left(neighbours, (float(price or 0), pk))
+        candidates.update(
+            other
+            for _, other in neighbours[
+                max(position - PRICE_NEIGHBOURS, 0) : position + PRICE_NEIGHBOURS + 1
+            ]
+        )
+        candidates.discard(pk)
+
+        scored = []
+        for other in candidates:
+            other_category, other_price = info[other]
+            theirs = features.get(other, set())
+            union = sum(weight[value] for value in own | theirs)
+            attributes = (
+                sum(weight[value] for value in own & theirs) / union if union else 0.0
+            )
+            proximity = SAME_CATEGORY if other_category == category_id else SIBLING_CATEGORY
+            score = (
+                ATTRIBUTE_WEIGHT * attributes
+                + CATEGORY_WEIGHT * proximity
+                + PRICE_WEIGHT * _price_similarity(price, other_price)
+            )
+            scored.append((round(score, 6), -other))
+        result[pk] = [(score, -negated) for score, negated in heapq.nlargest(top_k, scored)]
+    return result
+
+
+def _groups(categories):
+    """id категорий, сгруппированные по родителю (корневые — каждая отдельно)."""
+    groups = defaultdict(list)
+    for pk, parent_id in categories.values_list("pk", "parent_id"):
+        groups[parent_id or ("root", pk)].append(pk)
+    return list(groups.values())
+
+
+def build_similar_products(categories=None, top_k=TOP_K):
+    """
+    Пересчитывает похожие товары для товаров категорий (по умолчанию всех).
+    Строки каждой группы заменяются в отдельной транзакции, версии кеша
+    карточек пересчитанных товаров увеличиваются. Возвращает число товаров.
+    """
+    if categories is None:
+        categories = Category.objects.all()
+
+    processed = 0
+    for category_ids in _groups(categories):
+        products = list(
+            Product.objects.filter(category_id__in=category_ids)
+            .order_by("pk")
+            .values_list("pk", "category_id", "min_effective_price", "is_active")
+        )
+        if not products:
+            continue
+
+        similar = similar_for_group(products, top_k=top_k)
+        rows = [
+            SimilarProduct(product_id=pk, similar_id=other, rank=rank, score=score)
+            for pk, items in similar.items()
+            for rank, (score, other) in enumerate(items)
+        ]
+        with transaction.atomic():
+            SimilarProduct.objects.filter(product_id__in=list(similar)).delete()
+            SimilarProduct.objects.bulk_create(rows, batch_size=1000)
+        bump_versions(product_scope(pk) for pk in similar)
+        processed += len(similar)
+    return processed
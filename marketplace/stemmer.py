@@ -0,0 +1,113 @@
+"""
+Стеммер русского языка (алгоритм Snowball для русского).
+
+Отрезает окончания, не заменяя буквы, поэтому основа — начало слова:
+поиск по основе как по префиксу находит все формы слова
+(«футболки» → «футболк» → «футболка», «футболкой»).
+"""
+
+VOWELS = "аеиоуыэюя"
+
+PERFECTIVE_GERUND = (("в", "вши", "вшись"), ("ив", "ивши", "ившись", "ыв", "ывши", "ывшись"))
+ADJECTIVE = (
+    (),
+    (
+        "ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый", "ой", "ем", "им", "ым",
+        "ом", "его", "ого", "ему", "ому", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+    ),
+)
+PARTICIPLE = (("ем", "нн", "вш", "ющ", "щ"), ("ивш", "ывш", "ующ"))
+REFLEXIVE = ((), ("ся", "сь"))
+VERB = (
+    ("ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но", "ет", "ют", "ны",
+     "ть", "ешь", "нно"),
+    (
+        "ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей", "уй", "ил", "ыл",
+        "им", "ым", "ен", "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт", "ены",
+        "ить", "ыть", "ишь", "ую", "ю",
+    ),
+)
+NOUN = (
+    (),
+    (
+        "а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией",
+        "ей", "ой", "ий", "й", "иям", "ям", "ием", "ем", "ам", "ом", "о", "у", "ах",
+        "иях", "ях", "ы", "ь", "ию", "ью", "ю", "ия", "ья", "я",
+    ),
+)
+DERIVATIONAL = ("ость", "ост")
+SUPERLATIVE = ("ейше", "ейш")
+
+
+def _regions(word):
+    """Начала областей RV и R2 (индексы в слове)."""
+    rv = next((i + 1 for i, letter in enumerate(word) if letter in VOWELS), len(word))
+
+    def after_consonant(start):
+        for i in range(max(start, 1), len(word)):
+            if word[i] not in VOWELS and word[i - 1] in VOWELS and i - 1 >= start:
+                return i + 1
+        return len(word)
+
+    return rv, after_consonant(after_consonant(0))
+
+
+def _strip(word, rv, groups):
+    """
+    Удаляет самое длинное окончание из groups в области RV; окончания первой
+    группы должны следовать за «а» или «я». None — окончание не найдено.
+    """
+    preceded, plain = groups
+    endings = sorted(
+        [(ending, True) for ending in preceded] + [(ending, False) for ending in plain],
+        key=lambda item: -len(item[0]),
+    )
+    for ending, needs_a in endings:
+        start = len(word) - len(ending)
+        if start < rv or not word.endswith(ending):
+            continue
+        if needs_a and (start - 1 < rv or word[start - 1] not in "ая"):
+            return None
+        return word[:start]
+    return None
+
+
+def stem(word):
+    """Основа слова в нижнем регистре."""
+    word = word.lower().replace("ё", "е")
+    rv, r2 = _regions(word)
+    if rv >= len(word):
+        return word
+
+    # Шаг 1: деепричастие, иначе возвратность и прилагательное, глагол или существительное
+    stripped = _strip(word, rv, PERFECTIVE_GERUND)
+    if stripped is not None:
+        word = stripped
+    else:
+        word = _strip(word, rv, REFLEXIVE) or word
+        adjective = _strip(word, rv, ADJECTIVE)
+        if adjective is not None:
+            word = _strip(adjective, rv, PARTICIPLE) or adjective
+        else:
+            word = _strip(word, rv, VERB) or _strip(word, rv, NOUN) or word
+
+    # Шаг 2
+    if word.endswith("и") and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3: словообразовательное окончание в R2
+    for ending in DERIVATIONAL:
+        if word.endswith(ending) and len(word) - len(ending) >= r2:
+            word = word[: -len(ending)]
+            break
+
+    # Шаг 4: превосходная степень, двойная «н», мягкий знак
+    for ending in SUPERLATIVE:
+        if word.endswith(ending) and len(word) - len(ending) >= rv:
+            word = word[: -len(ending)]
+            break
+    if word.endswith("нн") and len(word) - 2 >= rv:
+        word = word[:-1]
+    elif word.endswith("ь") and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
@@ -0,0 +1,676 @@
+"""
+Работа с остатками товаров.
+
+Счётчики брака и продаж хранятся прямо в ProductStock и обновляются
+в той же транзакции, что и исходные записи (ProductDefect, ProductSale, Receipt),
+поэтому доступное количество считается арифметикой по колонкам.
+Все изменения остатков проходят через журнал StockMovement (record_movements),
+историческое состояние восстанавливается по снимкам StockSnapshot.
+Для списков товаров остатки получаются пачкой через resolve_availability.
+Резервы (StockReservation) берутся условным UPDATE без блокировки строки
+остатка и снимаются по истечении срока.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import (
+    Case,
+    F,
+    IntegerField,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import (
+    ProductDefect,
+    ProductSale,
+    ProductStock,
+    ProductVariant,
+    StockMovement,
+    StockReservation,
+    StockSnapshot,
+)
+from .product_refresh import mark_products_dirty
+
+SNAPSHOT_FIELDS = ("quantity", "reserved_quantity", "defect_quantity", "sold_quantity")
+
+
+def _empty_availability():
+    return {
+        "quantity": 0,
+        "available": 0,
+        "reserved": 0,
+        "defect": 0,
+        "sold": 0,
+        "locations": {},
+    }
+
+
+class AvailabilityMap(dict):
+    """
+    Результат resolve_availability: variant_id -> остатки.
+    Для вариантов без остатков по [] возвращаются нули.
+    """
+
+    def __missing__(self, variant_id):
+        return _empty_availability()
+
+    def available(self, variant_id):
+        return self[variant_id]["available"]
+
+
+def resolve_availability(variant_ids, warehouse_only=True):
+    """
+    Остатки сразу для набора вариантов одним сгруппированным запросом.
+
+    variant_ids — список id или queryset со значениями id.
+    Для каждого варианта возвращаются суммы quantity, available, reserved,
+    defect, sold и разбивка по локациям (тот же набор полей + name).
+    """
+    stocks = ProductStock.objects.filter(variant_id__in=variant_ids)
+    if warehouse_only:
+        stocks = stocks.filter(location__location_type__is_warehouse=True)
+
+    rows = stocks.values("variant_id", "location_id", "location__name").annotate(
+        total_quantity=Sum("quantity"),
+        total_reserved=Sum("reserved_quantity"),
+        total_defect=Sum("defect_quantity"),
+        total_sold=Sum("sold_quantity"),
+    )
+
+    availability = AvailabilityMap()
+    for row in rows:
+        quantity = row["total_quantity"] or 0
+        reserved = row["total_reserved"] or 0
+        defect = row["total_defect"] or 0
+        sold = row["total_sold"] or 0
+        location = {
+            "name": row["location__name"],
+            "quantity": quantity,
+            "available": quantity - reserved - defect - sold,
+            "reserved": reserved,
+            "defect": defect,
+            "sold": sold,
+        }
+
+        entry = availability.setdefault(row["variant_id"], _empty_availability())
+        entry["locations"][row["location_id"]] = location
+        for key in ("quantity", "available", "reserved", "defect", "sold"):
+            entry[key] += location[key]
+
+    return availability
+
+
+def resolve_product_availability(products, warehouse_only=True, visible_only=False):
+    """Остатки всех вариантов переданных товаров (список, страница или queryset)."""
+    variants = ProductVariant.objects.filter(product__in=products)
+    if visible_only:
+        variants = variants.filter(show_this=True)
+    return resolve_availability(variants.values("id"), warehouse_only=warehouse_only)
+
+
+def _apply_movements(movements):
+    """
+    Применяет движения к колонкам ProductStock одним UPDATE по всем
+    затронутым остаткам (CASE по первичному ключу). Строки остатков
+    блокируются одним запросом в порядке pk. Колонки беззнаковые:
+    уменьшение ниже нуля урезается до текущего значения, и в журнал
+    пишется применённое количество, поэтому журнал и колонки не расходятся.
+    Возвращает движения с ненулевым количеством.
+    """
+    fields = sorted({StockMovement.STOCK_FIELDS[movement.kind] for movement in movements})
+    current = {
+        row["pk"]: row
+        for row in ProductStock.objects.select_for_update()
+        .filter(pk__in={movement.stock_id for movement in movements})
+        .order_by("pk")
+        .values("pk", *fields)
+    }
+
+    applied = []
+    changes = defaultdict(dict)
+    for movement in movements:
+        row = current.get(movement.stock_id)
+        if row is None:
+            continue
+        field = StockMovement.STOCK_FIELDS[movement.kind]
+        quantity = max(movement.quantity, -row[field])
+        if quantity != movement.quantity:
+            note = f"применено {quantity} из {movement.quantity}"
+            movement.comment = f"{movement.comment}; {note}"[:255] if movement.comment else note
+            movement.quantity = quantity
+        if quantity:
+            row[field] += quantity
+            changes[field][movement.stock_id] = row[field]
+            applied.append(movement)
+
+    if changes:
+        ProductStock.objects.filter(
+            pk__in={pk for values in changes.values() for pk in values}
+        ).update(
+            **{
+                field: Case(
+                    *(When(pk=pk, then=Value(value)) for pk, value in values.items()),
+                    default=F(field),
+                    output_field=IntegerField(),
+                )
+                for field, values in changes.items()
+            }
+        )
+    return applied
+
+
+def record_movements(movements, apply=True):
+    """
+    Единая точка записи в журнал движений.
+    movements — несохранённые StockMovement; при apply=True их изменения
+    применяются к колонкам ProductStock (один UPDATE на все остатки).
+    apply=False — движение уже отражено в остатке (например, правка через save()).
+    """
+    movements = [movement for movement in movements if movement.quantity]
+    if not movements:
+        return []
+
+    with transaction.atomic():
+        if apply:
+            movements = _apply_movements(movements)
+
+        StockMovement.objects.bulk_create(movements)
+        mark_products_dirty(
+            ProductStock.objects.filter(
+                pk__in={movement.stock_id for movement in movements}
+            ).values_list("variant__product_id", flat=True)
+        )
+    return movements
+
+
+def record_stock_edit(stock, previous):
+    """
+    Записывает в журнал прямую правку остатка (админка, редактирование товара).
+    previous — словарь quantity/reserved_quantity до сохранения или None для нового остатка.
+    """
+    if previous is None:
+        movements = [
+            StockMovement(stock=stock, kind=StockMovement.RECEIPT, quantity=stock.quantity),
+            StockMovement(
+                stock=stock,
+                kind=StockMovement.RESERVE,
+                quantity=stock.reserved_quantity,
+            ),
+            StockMovement(
+                stock=stock,
+                kind=StockMovement.SALE,
+                quantity=stock.sold_quantity,
+                comment="Продажи до создания остатка",
+            ),
+        ]
+    else:
+        reserved_delta = stock.reserved_quantity - previous["reserved_quantity"]
+        movements = [
+            StockMovement(
+                stock=stock,
+                kind=StockMovement.ADJUSTMENT,
+                quantity=stock.quantity - previous["quantity"],
+            ),
+            StockMovement(
+                stock=stock,
+                kind=StockMovement.RESERVE if reserved_delta > 0 else StockMovement.RELEASE,
+                quantity=reserved_delta,
+            ),
+        ]
+    record_movements(movements, apply=False)
+
+
+def add_defect_quantity(stock_id, delta, comment=""):
+    """Изменяет счётчик брака у остатка на delta (может быть отрицательным)."""
+    if not stock_id or not delta:
+        return
+    record_movements(
+        [
+            StockMovement(
+                stock_id=stock_id,
+                kind=StockMovement.DEFECT,
+                quantity=delta,
+                comment=comment[:255],
+            )
+        ]
+    )
+
+
+def add_sold_quantity(changes, receipt=None, user=None):
+    """
+    Изменяет счётчики проданного.
+    changes — iterable из (variant_id, location_id, delta); строки по одному
+    остатку суммируются в одно движение.
+    """
+    totals = defaultdict(int)
+    for variant_id, location_id, delta in changes:
+        totals[(variant_id, location_id)] += delta
+    totals = {key: delta for key, delta in totals.items() if delta}
+    if not totals:
+        return
+
+    lookup = Q()
+    for variant_id, location_id in totals:
+        lookup |= Q(variant_id=variant_id, location_id=location_id)
+    stock_ids = {
+        (variant_id, location_id): pk
+        for pk, variant_id, location_id in ProductStock.objects.filter(
+            lookup
+        ).values_list("pk", "variant_id", "location_id")
+    }
+
+    record_movements(
+        StockMovement(
+            stock_id=stock_ids[key],
+            kind=StockMovement.SALE,
+            quantity=delta,
+            receipt=receipt,
+            user=user,
+        )
+        for key, delta in totals.items()
+        if key in stock_ids
+    )
+
+
+def transfer_stock(source, target, quantity, user=None, comment=""):
+    """
+    Перемещает quantity единиц между остатками одного варианта.
+    Списание с источника — условный UPDATE, без блокировки строки.
+    """
+    if source.variant_id != target.variant_id:
+        raise ValidationError("Перемещать можно только остатки одного варианта.")
+    if quantity <= 0:
+        raise ValidationError("Количество должно быть больше нуля.")
+
+    with transaction.atomic():
+        updated = ProductStock.objects.filter(
+            pk=source.pk,
+            quantity__gte=F("reserved_quantity")
+            + F("defect_quantity")
+            + F("sold_quantity")
+            + quantity,
+        ).update(quantity=F("quantity") - quantity)
+        if not updated:
+            raise ValidationError("Недостаточно товара для перемещения.")
+        ProductStock.objects.filter(pk=target.pk).update(quantity=F("quantity") + quantity)
+
+        record_movements(
+            [
+                StockMovement(
+                    stock=source,
+                    kind=StockMovement.TRANSFER,
+                    quantity=-quantity,
+                    user=user,
+                    comment=comment or f"Перемещение в {target.location}",
+                ),
+                StockMovement(
+                    stock=target,
+                    kind=StockMovement.TRANSFER,
+                    quantity=quantity,
+                    user=user,
+                    comment=comment or f"Перемещение из {source.location}",
+                ),
+            ],
+            apply=False,
+        )
+
+
+def _reservation_ttl(ttl_minutes):
+    """expires_at для нового резерва; None/0 в настройках — бессрочно."""
+    if ttl_minutes is None:
+        ttl_minutes = getattr(settings, "STOCK_RESERVATION_TTL_MINUTES", 0)
+    if not ttl_minutes:
+        return None
+    return timezone.now() + timedelta(minutes=ttl_minutes)
+
+
+def _decrease_reserved(stock_id, quantity):
+    """
+    Уменьшает reserved_quantity одним UPDATE. Резерв мог быть изменён
+    вручную при редактировании товара, поэтому значение не уходит ниже нуля.
+    """
+    ProductStock.objects.filter(pk=stock_id).update(
+        reserved_quantity=Case(
+            When(reserved_quantity__gte=quantity, then=F("reserved_quantity") - quantity),
+            default=Value(0),
+        )
+    )
+
+
+def reserve_quantity(stock_id, quantity, owner=None, ttl_minutes=None, comment=""):
+    """
+    Резервирует quantity единиц остатка и возвращает StockReservation.
+    Проверка доступности и увеличение резерва — один условный UPDATE,
+    строка остатка не блокируется дольше этого запроса.
+    ttl_minutes=None — срок из STOCK_RESERVATION_TTL_MINUTES, 0 — бессрочно.
+    """
+    if quantity <= 0:
+        raise ValidationError("Количество должно быть больше нуля.")
+
+    with transaction.atomic():
+        updated = ProductStock.objects.filter(
+            pk=stock_id,
+            quantity__gte=F("reserved_quantity")
+            + F("defect_quantity")
+            + F("sold_quantity")
+            + quantity,
+        ).update(reserved_quantity=F("reserved_quantity") + quantity)
+        if not updated:
+            raise ValidationError("Недостаточно товара")
+
+        reservation = StockReservation.objects.create(
+            stock_id=stock_id,
+            quantity=quantity,
+            owner=owner,
+            comment=comment[:255],
+            expires_at=_reservation_ttl(ttl_minutes),
+        )
+        record_movements(
+            [
+                StockMovement(
+                    stock_id=stock_id,
+                    kind=StockMovement.RESERVE,
+                    quantity=quantity,
+                    user=owner,
+                    comment=comment[:255],
+                )
+            ],
+            apply=False,
+        )
+    return reservation
+
+
+def release_reservation(reservation, user=None):
+    """
+    Снимает активный резерв. Повторный вызов и гонка со сборщиком
+    истёкших резервов безопасны: статус меняется условным UPDATE.
+    Возвращает True, если резерв был снят этим вызовом.
+    """
+    with transaction.atomic():
+        updated = StockReservation.objects.filter(
+            pk=reservation.pk, status=StockReservation.ACTIVE
+        ).update(status=StockReservation.RELEASED, released_at=timezone.now())
+        if not updated:
+            return False
+
+        _decrease_reserved(reservation.stock_id, reservation.quantity)
+        record_movements(
+            [
+                StockMovement(
+                    stock_id=reservation.stock_id,
+                    kind=StockMovement.RELEASE,
+                    quantity=-reservation.quantity,
+                    user=user,
+                )
+            ],
+            apply=False,
+        )
+    reservation.status = StockReservation.RELEASED
+    return True
+
+
+def release_reserved_quantity(stock_id, quantity, user=None):
+    """
+    Снимает quantity единиц резерва остатка без указания конкретного резерва.
+    Активные резервы остатка гасятся начиная со старых; резерв, выставленный
+    вручную при редактировании товара, снимается напрямую.
+    """
+    if quantity <= 0:
+        raise ValidationError("Количество должно быть больше нуля.")
+
+    with transaction.atomic():
+        updated = ProductStock.objects.filter(
+            pk=stock_id, reserved_quantity__gte=quantity
+        ).update(reserved_quantity=F("reserved_quantity") - quantity)
+        if not updated:
+            raise ValidationError("Нельзя снять больше, чем зарезервировано")
+
+        remaining = quantity
+        reservations = (
+            StockReservation.objects.select_for_update()
+            .filter(stock_id=stock_id, status=StockReservation.ACTIVE)
+            .order_by("created_at", "pk")
+        )
+        for reservation in reservations:
+            if remaining <= 0:
+                break
+            if reservation.quantity <= remaining:
+                remaining -= reservation.quantity
+                reservation.status = StockReservation.RELEASED
+                reservation.released_at = timezone.now()
+                reservation.save(update_fields=["status", "released_at"])
+            else:
+                reservation.quantity -= remaining
+                remaining = 0
+                reservation.save(update_fields=["quantity"])
+
+        record_movements(
+            [
+                StockMovement(
+                    stock_id=stock_id,
+                    kind=StockMovement.RELEASE,
+                    quantity=-quantity,
+                    user=user,
+                )
+            ],
+            apply=False,
+        )
+
+
+def release_expired_reservations(batch_size=500, now=None):
+    """
+    Снимает резервы с истёкшим сроком пачками по batch_size.
+    Строки, заблокированные параллельным снятием, пропускаются (skip_locked)
+    и будут обработаны следующим запуском. Возвращает число снятых резервов.
+    """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                StockReservation.objects.select_for_update(skip_locked=True)
+                .filter(status=StockReservation.ACTIVE, expires_at__lte=now)
+                .order_by("pk")
+                .values_list("pk", "stock_id", "quantity")[:batch_size]
+            )
+            if not batch:
+                break
+
+            StockReservation.objects.filter(pk__in=[pk for pk, _, _ in batch]).update(
+                status=StockReservation.EXPIRED, released_at=now
+            )
+            totals = defaultdict(int)
+            for _, stock_id, quantity in batch:
+                totals[stock_id] += quantity
+            for stock_id, quantity in totals.items():
+                _decrease_reserved(stock_id, quantity)
+            record_movements(
+                [
+                    StockMovement(
+                        stock_id=stock_id,
+                        kind=StockMovement.RELEASE,
+                        quantity=-quantity,
+                        comment="Истёк срок резерва",
+                    )
+                    for stock_id, quantity in totals.items()
+                ],
+                apply=False,
+            )
+        released += len(batch)
+        if len(batch) < batch_size:
+            break
+    return released
+
+
+def _movement_totals(movements):
+    """Суммы движений по колонкам ProductStock: {(stock_id, field): delta}"""
+    totals = defaultdict(int)
+    rows = movements.values("stock_id", "kind").annotate(total=Sum("quantity")).order_by()
+    for row in rows:
+        totals[(row["stock_id"], StockMovement.STOCK_FIELDS[row["kind"]])] += row["total"]
+    return totals
+
+
+def stock_state(stock, at=None):
+    """
+    Состояние остатка на момент at (по умолчанию — текущее):
+    последний снимок до at + движения после него.
+    """
+    snapshots = StockSnapshot.objects.filter(stock=stock)
+    movements = StockMovement.objects.filter(stock=stock)
+    if at is not None:
+        snapshots = snapshots.filter(taken_at__lte=at)
+        movements = movements.filter(created_at__lte=at)
+
+    snapshot = snapshots.order_by("-last_movement_id").first()
+    state = {
+        field: getattr(snapshot, field) if snapshot else 0 for field in SNAPSHOT_FIELDS
+    }
+    if snapshot:
+        movements = movements.filter(id__gt=snapshot.last_movement_id)
+
+    for (_, field), delta in _movement_totals(movements).items():
+        state[field] += delta
+
+    state["available_quantity"] = (
+        state["quantity"]
+        - state["reserved_quantity"]
+        - state["defect_quantity"]
+        - state["sold_quantity"]
+    )
+    return state
+
+
+def take_stock_snapshots(stocks=None, chunk_size=1000):
+    """
+    Создаёт снимки для остатков, по которым были движения после последнего снимка.
+    Возвращает количество созданных снимков.
+    """
+    if stocks is None:
+        stocks = ProductStock.objects.all()
+
+    latest = StockSnapshot.objects.filter(stock=OuterRef("pk")).order_by(
+        "-last_movement_id"
+    )
+    latest_for_movement = StockSnapshot.objects.filter(
+        stock=OuterRef("stock")
+    ).order_by("-last_movement_id")
+
+    ids = stocks.order_by("pk").values_list("pk", flat=True)
+    created = 0
+    last_pk = 0
+    while True:
+        chunk = list(ids.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1]
+
+        snapshot_ids = dict(
+            ProductStock.objects.filter(pk__in=chunk)
+            .annotate(snapshot_id=Subquery(latest.values("id")[:1]))
+            .values_list("pk", "snapshot_id")
+        )
+        snapshots = StockSnapshot.objects.in_bulk(
+            [pk for pk in snapshot_ids.values() if pk]
+        )
+
+        movements = (
+            StockMovement.objects.filter(stock_id__in=chunk)
+            .annotate(
+                since=Coalesce(
+                    Subquery(latest_for_movement.values("last_movement_id")[:1]),
+                    Value(0),
+                )
+            )
+            .filter(id__gt=F("since"))
+        )
+        rows = (
+            movements.values("stock_id", "kind")
+            .annotate(total=Sum("quantity"), last_id=Max("id"))
+            .order_by()
+        )
+
+        states = {}
+        now = timezone.now()
+        for row in rows:
+            stock_id = row["stock_id"]
+            if stock_id not in states:
+                previous = snapshots.get(snapshot_ids.get(stock_id))
+                states[stock_id] = StockSnapshot(
+                    stock_id=stock_id,
+                    taken_at=now,
+                    last_movement_id=0,
+                    **{
+                        field: getattr(previous, field) if previous else 0
+                        for field in SNAPSHOT_FIELDS
+                    },
+                )
+            state = states[stock_id]
+            field = StockMovement.STOCK_FIELDS[row["kind"]]
+            setattr(state, field, getattr(state, field) + row["total"])
+            state.last_movement_id = max(state.last_movement_id, row["last_id"])
+
+        StockSnapshot.objects.bulk_create(states.values())
+        created += len(states)
+
+    return created
+
+
+def recount_stock_counters(stocks=None):
+    """
+    Сверяет defect_quantity и sold_quantity с исходными записями и проводит
+    расхождения корректирующими движениями. Возвращает количество исправленных остатков.
+    """
+    if stocks is None:
+        stocks = ProductStock.objects.all()
+
+    defects = (
+        ProductDefect.objects.filter(stock=OuterRef("pk"))
+        .values("stock")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    sold = (
+        ProductSale.objects.filter(
+            variant=OuterRef("variant"),
+            location=OuterRef("location"),
+            receipt__is_deleted=False,
+        )
+        .values("variant")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    rows = stocks.annotate(
+        expected_defect=Coalesce(
+            Subquery(defects, output_field=IntegerField()), Value(0)
+        ),
+        expected_sold=Coalesce(Subquery(sold, output_field=IntegerField()), Value(0)),
+    ).values_list("pk", "defect_quantity", "sold_quantity", "expected_defect", "expected_sold")
+
+    movements = []
+    fixed = set()
+    for pk, defect, sold_quantity, expected_defect, expected_sold in rows:
+        for kind, delta in (
+            (StockMovement.DEFECT, expected_defect - defect),
+            (StockMovement.SALE, expected_sold - sold_quantity),
+        ):
+            if delta:
+                movements.append(
+                    StockMovement(stock_id=pk, kind=kind, quantity=delta, comment="Пересчёт")
+                )
+                fixed.add(pk)
+
+    record_movements(movements)
+    return len(fixed)
@@ -0,0 +1,330 @@
+"""
+Подсказки поиска по мере ввода (typeahead) из префиксного индекса в памяти.
+
+Индекс — отсортированные ключи (слово, вид, id, текст): для каждой
+подписи хранятся все её окончания, начинающиеся с границы слова
+(«футболка хлопковая», «хлопковая»), поэтому префикс запроса находится
+двоичным поиском, а совпадения лежат подряд. Ключи разбиты на корзины
+ограниченного размера: вставка и удаление сдвигают одну корзину,
+а не весь список. Подписи — названия товаров маркетплейса и своих
+названий их видимых вариантов, пути категорий и значения фильтруемых
+атрибутов.
+
+Индекс строится лениво в каждом процессе и догоняет тот же журнал
+изменений, что и индексы фасетов (facet_index): изменённые товары
+перечитываются в новую копию индекса, а сброс журнала (изменились
+категории или атрибуты) или возраст больше SUGGEST_INDEX_MAX_AGE строит
+индекс заново. Индекс не меняется после сборки: новую копию собирает
+один поток, остальные тем временем отвечают по прежнему индексу, затем
+копия подменяет его. Копия разделяет с исходным индексом незатронутые
+корзины ключей.
+"""
+
+import threading
+import time
+from bisect import bisect_left, insort
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+
+from .facet_index import changed_products, current_generation
+from .models import AttributeValue, Category, Product, ProductVariant
+
+PRODUCT = "product"
+CATEGORY = "category"
+VALUE = "value"
+
+# Размер корзины отсортированных ключей
+BUCKET_SIZE = 1000
+# Сколько первых слов подписи дают ключи (длинные названия не раздувают индекс)
+MAX_WORDS = 8
+# Сколько совпадений префикса просматривается для ранжирования
+SCAN_LIMIT = 256
+# Подсказок каждого вида по умолчанию и максимум
+DEFAULT_LIMIT = 5
+MAX_LIMIT = 20
+
+_lock = threading.Lock()
+# Индекс собирает один поток за раз
+_build_lock = threading.Lock()
+_index = None
+
+
+def normalize(text):
+    """Текст ключа: нижний регистр, ё как е, одиночные пробелы."""
+    return " ".join(text.casefold().replace("ё", "е").split())
+
+
+def _keys(kind, pk, text):
+    words = normalize(text).split(" ")[:MAX_WORDS]
+    return [
+        (" ".join(words[start:]), kind, pk, text)
+        for start in range(len(words))
+        if words[start]
+    ]
+
+
+def _product_texts(product_ids=None):
+    """{id товара: [название, свои названия вариантов]} для товаров маркетплейса."""
+    products = Product.objects.filter(
+        is_active=True, is_visible_on_marketplace=True, category__is_active=True
+    )
+    variants = ProductVariant.objects.filter(
+        show_this=True, has_custom_name=True, product__in=products
+    ).exclude(Q(custom_name__isnull=True) | Q(custom_name=""))
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+        variants = variants.filter(product_id__in=product_ids)
+
+    texts = {pk: [name] for pk, name in products.values_list("pk", "name")}
+    for product_id, custom_name in variants.values_list("product_id", "custom_name"):
+        if custom_name not in texts[product_id]:
+            texts[product_id].append(custom_name)
+    return texts
+
+
+def _category_paths():
+    """{id активной категории: «Родитель / Категория»}."""
+    categories = {
+        pk: (parent_id, name, is_active)
+        for pk, parent_id, name, is_active in Category.objects.values_list(
+            "pk", "parent_id", "name", "is_active"
+        )
+    }
+    paths = {}
+    for pk, (parent_id, name, is_active) in categories.items():
+        if not is_active:
+            continue
+        names = [name]
+        while parent_id in categories:
+            parent_id, parent_name, _ = categories[parent_id]
+            names.append(parent_name)
+        paths[pk] = (name, " / ".join(reversed(names)))
+    return paths
+
+
+class SortedKeys:
+    """
+    Отсортированный список ключей, разбитый на корзины по BUCKET_SIZE.
+    Изменение заменяет корзину копией, поэтому копия списка (copy) может
+    разделять корзины с исходным.
+    """
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.buckets = [
+            keys[start : start + BUCKET_SIZE] for start in range(0, len(keys), BUCKET_SIZE)
+        ]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def copy(self):
+        keys = SortedKeys()
+        keys.buckets = list(self.buckets)
+        keys.maxes = list(self.maxes)
+        return keys
+
+    def add(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            return
+        number = min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = list(self.buckets[number])
+        insort(bucket, key)
+        if len(bucket) > 2 * BUCKET_SIZE:
+            self.buckets[number : number + 1] = [bucket[:BUCKET_SIZE], bucket[BUCKET_SIZE:]]
+            self.maxes[number : number + 1] = [bucket[BUCKET_SIZE - 1], bucket[-1]]
+        else:
+            self.buckets[number] = bucket
+            self.maxes[number] = bucket[-1]
+
+    def discard(self, key):
+        number = bisect_left(self.maxes, key)
+        if number == len(self.buckets):
+            return
+        bucket = self.buckets[number]
+        position = bisect_left(bucket, key)
+        if position == len(bucket) or bucket[position] != key:
+            return
+        bucket = bucket[:position] + bucket[position + 1 :]
+        if bucket:
+            self.buckets[number] = bucket
+            self.maxes[number] = bucket[-1]
+        else:
+            del self.buckets[number]
+            del self.maxes[number]
+
+    def iter_from(self, key):
+        """Ключи не меньше key по порядку."""
+        number = bisect_left(self.maxes, key)
+        if number == len(self.buckets):
+            return
+        bucket = self.buckets[number]
+        yield from islice(bucket, bisect_left(bucket, key), None)
+        for bucket in self.buckets[number + 1 :]:
+            yield from bucket
+
+
+class SuggestIndex:
+    """Неизменяемый префиксный индекс подсказок одного процесса."""
+
+    def __init__(self, generation):
+        self.generation = generation
+        # Время полной сборки; обновления по журналу его не продлевают
+        self.built_at = time.monotonic()
+        self.keys = SortedKeys()
+        # Ключи товара — чтобы заменить их при изменении товара
+        self.product_keys = {}
+        # Данные ответа для категорий и значений атрибутов
+        self.categories = {}
+        self.values = {}
+
+    @classmethod
+    def build(cls, generation=None):
+        if generation is None:
+            generation = current_generation()
+        index = cls(generation)
+        keys = []
+        for pk, texts in _product_texts().items():
+            index.product_keys[pk] = [key for text in texts for key in _keys(PRODUCT, pk, text)]
+            keys.extend(index.product_keys[pk])
+
+        for pk, (name, path) in _category_paths().items():
+            index.categories[pk] = {"id": pk, "name": name, "path": path}
+            keys.extend(_keys(CATEGORY, pk, name))
+
+        for pk, value, attribute_id, attribute_name in AttributeValue.objects.filter(
+            attribute__is_filterable=True
+        ).values_list("pk", "value", "attribute_id", "attribute__name"):
+            index.values[pk] = {
+                "id": pk,
+                "value": value,
+                "attribute_id": attribute_id,
+                "attribute_name": attribute_name,
+            }
+            keys.extend(_keys(VALUE, pk, value))
+
+        index.keys = SortedKeys(keys)
+        return index
+
+    def updated(self, product_ids, generation):
+        """Новый индекс, в котором ключи товаров product_ids перечитаны из базы."""
+        index = SuggestIndex(generation)
+        index.built_at = self.built_at
+        index.keys = self.keys.copy()
+        index.product_keys = dict(self.product_keys)
+        # Категории и значения атрибутов меняются только со сбросом журнала
+        index.categories = self.categories
+        index.values = self.values
+
+        texts = _product_texts(product_ids)
+        for pk in product_ids:
+            for key in index.product_keys.pop(pk, ()):
+                index.keys.discard(key)
+            if pk in texts:
+                index.product_keys[pk] = [
+                    key for text in texts[pk] for key in _keys(PRODUCT, pk, text)
+                ]
+                for key in index.product_keys[pk]:
+                    index.keys.add(key)
+        return index
+
+    def expired(self):
+        max_age = getattr(settings, "SUGGEST_INDEX_MAX_AGE", 600)
+        return bool(max_age) and time.monotonic() - self.built_at > max_age
+
+    def matches(self, query):
+        """Ключи, начинающиеся с query: не больше SCAN_LIMIT, по порядку ключей."""
+        found = []
+        for key in self.keys.iter_from((query,)):
+            if len(found) == SCAN_LIMIT or not key[0].startswith(query):
+                break
+            found.append(key)
+        return found
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        query = normalize(query)
+        result = {"products": [], "categories": [], "values": []}
+        if not query:
+            return result
+
+        # Выше — подписи, начинающиеся с запроса, затем более короткие
+        ranked = sorted(
+            self.matches(query),
+            key=lambda key: (normalize(key[3]) != key[0], len(key[3]), key[2]),
+        )
+        seen = set()
+        for term, kind, pk, text in ranked:
+            if (kind, pk) in seen:
+                continue
+            seen.add((kind, pk))
+            if kind == PRODUCT:
+                group, item = result["products"], {"id": pk, "name": text}
+            elif kind == CATEGORY:
+                group, item = result["categories"], self.categories[pk]
+            else:
+                group, item = result["values"], self.values[pk]
+            if len(group) < limit:
+                group.append(item)
+        return result
+
+
+def reset_suggest_index():
+    """Забывает индекс текущего процесса."""
+    global _index
+    with _lock:
+        _index = None
+
+
+def _fresh(index, generation):
+    return index is not None and index.generation == generation and not index.expired()
+
+
+def get_suggest_index():
+    """
+    Актуальный индекс подсказок текущего процесса. Собирает его один поток;
+    остальные, пока идёт сборка, отвечают по прежнему индексу и ждут только
+    первую сборку процесса.
+    """
+    global _index
+    generation = current_generation()
+    current = _index
+    if _fresh(current, generation):
+        return current
+    if not _build_lock.acquire(blocking=current is None):
+        return current
+    try:
+        # Пока ждали блокировку, индекс мог собрать другой поток
+        current = _index
+        if _fresh(current, generation):
+            return current
+        if current is None or current.expired():
+            index = SuggestIndex.build(generation)
+        else:
+            product_ids = changed_products(current.generation, generation)
+            if product_ids is None:
+                index = SuggestIndex.build(generation)
+            else:
+                index = current.updated(product_ids, generation)
+
+        with _lock:
+            # reset_suggest_index мог сбросить индекс во время сборки
+            installed = _index
+            if (
+                installed is None
+                or installed is current
+                or installed.generation <= index.generation
+            ):
+                _index = index
+    finally:
+        _build_lock.release()
+    return index
+
+
+def suggest(query, limit=DEFAULT_LIMIT):
+    """Подсказки по префиксу query: товары, категории и значения атрибутов."""
+    return get_suggest_index().suggest(query, limit)
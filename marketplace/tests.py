@@ -1,3 +1,1372 @@
-from django.test import TestCase
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection, transaction
+from django.db.models import F
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from core import business_API, sale_product_API
+from core.models import Business, BusinessLocation, BusinessLocationType, BusinessType, User
+
+from . import views
+from .checks import check_shared_cache
+from .facet_index import FacetIndex, get_facet_index, reset_facet_indexes
+from .copurchase import bought_together, update_co_purchases, upsell_variants
+from .facets import attribute_facets
+from .listing import rebuild_listings
+from .pagination import CursorPaginator
+from .ProductsSet import ProductSet
+from .product_refresh import reconcile_is_active, refresh_products
+from .scan import reset_scan_cache, scan
+from .search import (
+    SearchBackend,
+    corrected_query,
+    drain_outbox,
+    reindex,
+    search_products,
+)
+from . import facet_index as facet_index_module
+from . import suggest as suggest_module
+from .suggest import SuggestIndex, get_suggest_index, reset_suggest_index, suggest
+from .similarity import build_similar_products
+from .stock import (
+    add_sold_quantity,
+    recount_stock_counters,
+    release_expired_reservations,
+    release_reservation,
+    reserve_quantity,
+    resolve_availability,
+    resolve_product_availability,
+    stock_state,
+)
+from .models import (
+    Attribute,
+    AttributeValue,
+    Category,
+    CategoryAttribute,
+    PaymentMethod,
+    Product,
+    ProductCoPurchase,
+    ProductDefect,
+    ProductImage,
+    ProductListing,
+    ProductSale,
+    ProductStock,
+    ProductVariant,
+    ProductSearchDocument,
+    ProductVariantAttribute,
+    Receipt,
+    SearchOutbox,
+    SearchTerm,
+    StockMovement,
+)
+
+
+# Варианты при сохранении генерируют изображения штрихкодов
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class CatalogTestCase(TestCase):
+    """Категория с атрибутом «Цвет» и товарами по два варианта"""
+
+    # test_api читает категорию с фиксированным pk
+    CATEGORY_PK = 33
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        reset_facet_indexes()
+        reset_scan_cache()
+        reset_suggest_index()
+        self.factory = APIRequestFactory()
+        owner = User.objects.create(username="owner")
+        self.business = Business.objects.create(
+            owner=owner,
+            business_type=BusinessType.objects.create(name="shop"),
+            name="Магазин",
+            slug="shop",
+        )
+        self.warehouse = BusinessLocation.objects.create(
+            business=self.business,
+            name="Склад",
+            location_type=BusinessLocationType.objects.create(
+                code="warehouse", name="Склад", is_warehouse=True
+            ),
+            address="-",
+            contact_phone="-",
+        )
+        self.category = Category.objects.create(pk=self.CATEGORY_PK, name="Футболки")
+        attribute = Attribute.objects.create(
+            name="Цвет", has_predefined_values=True, is_filterable=True
+        )
+        self.colors = [
+            AttributeValue.objects.create(attribute=attribute, value="Красный"),
+            AttributeValue.objects.create(attribute=attribute, value="Синий"),
+        ]
+        self.category_attribute = CategoryAttribute.objects.create(
+            category=self.category, attribute=attribute
+        )
+
+    def create_products(self, count):
+        # Строки каталога пересобираются в on_commit
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(count):
+                product = Product.objects.create(
+                    business=self.business,
+                    category=self.category,
+                    name=f"Футболка {Product.objects.count()}",
+                    is_visible_on_marketplace=True,
+                )
+                ProductImage.objects.create(
+                    product=product, image="product_images/test.jpg", is_main=True
+                )
+                for j, color in enumerate(self.colors):
+                    variant = ProductVariant.objects.create(
+                        product=product,
+                        price=100 + i,
+                        discount=10 if j else None,
+                        show_this=True,
+                    )
+                    ProductVariantAttribute.objects.create(
+                        variant=variant,
+                        category_attribute=self.category_attribute,
+                        predefined_value=color,
+                    )
+                    ProductStock.objects.create(
+                        variant=variant, location=self.warehouse, quantity=5
+                    )
+
+
+@override_settings(CATALOG_RESPONSE_CACHE_TIMEOUT=0)
+class ProductListQueryCountTests(CatalogTestCase):
+    """Число запросов списков товаров не зависит от размера страницы"""
+
+    def count_queries(self, view, **kwargs):
+        request = self.factory.get("/", {"per_page": 50})
+        # Первый запрос категории строит индекс фасетов
+        view(request, **kwargs).render()
+        with CaptureQueriesContext(connection) as context:
+            response = view(request, **kwargs)
+            response.render()
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response
+
+    def test_category_products_api_constant_queries(self):
+        self.create_products(2)
+        small, _ = self.count_queries(views.category_products_api, pk=self.CATEGORY_PK)
+        self.create_products(10)
+        large, response = self.count_queries(
+            views.category_products_api, pk=self.CATEGORY_PK
+        )
+
+        self.assertEqual(len(response.data["oldData"]["products"]), 12)
+        self.assertEqual(small, large)
+
+    def test_category_products_api_query_count(self):
+        self.create_products(12)
+        request = self.factory.get("/", {"per_page": 50})
+        views.category_products_api(request, pk=self.CATEGORY_PK).render()
+        # Фасеты и фильтр по атрибутам считаются по индексу без запросов
+        with self.assertNumQueries(8):
+            views.category_products_api(request, pk=self.CATEGORY_PK).render()
+
+    def test_business_products_api_constant_queries(self):
+        def count():
+            request = self.factory.get("/", {"per_page": 50})
+            force_authenticate(request, user=self.business.owner)
+            with CaptureQueriesContext(connection) as context:
+                response = business_API.business_products_api(
+                    request, business_slug=self.business.slug
+                )
+                response.render()
+            self.assertEqual(response.status_code, 200)
+            return len(context.captured_queries), response
+
+        self.create_products(2)
+        small, _ = count()
+        self.create_products(10)
+        # Скрытые варианты тоже попадают в список бизнеса
+        hidden = ProductVariant.objects.order_by("pk").first()
+        ProductVariant.objects.filter(pk=hidden.pk).update(show_this=False)
+        large, response = count()
+
+        self.assertEqual(len(response.data["products"]), 12)
+        self.assertEqual(sum(len(row["variants"]) for row in response.data["products"]), 24)
+        self.assertEqual(small, large)
+
+    def test_test_api_constant_queries(self):
+        self.create_products(2)
+        small, _ = self.count_queries(views.test_api)
+        self.create_products(10)
+        large, response = self.count_queries(views.test_api)
+
+        self.assertEqual(len(response.data["products"]), 12)
+        self.assertEqual(small, large)
+
+    def test_test_api_query_count(self):
+        self.create_products(12)
+        request = self.factory.get("/", {"per_page": 50})
+        with self.assertNumQueries(15):
+            views.test_api(request).render()
+
+
+@override_settings(CATALOG_RESPONSE_CACHE_TIMEOUT=0)
+class CursorPaginationTests(CatalogTestCase):
+    """Страницы по курсору повторяют сортировку queryset без пропусков и повторов"""
+
+    def setUp(self):
+        super().setUp()
+        # Две партии с одинаковыми ценами — равные ключи различает pk
+        self.create_products(3)
+        self.create_products(3)
+        # Товар без доступных вариантов — min_price/max_price строки NULL
+        self.empty = Product.objects.order_by("pk").first()
+        ProductStock.objects.filter(variant__product=self.empty).update(quantity=0)
+        rebuild_listings([self.empty.pk])
+
+    def walk(self, queryset, per_page=2):
+        paginator = CursorPaginator(queryset, per_page)
+        items, cursor = paginator.page()
+        while cursor is not None:
+            # Курсор переживает кодирование в строку запроса
+            self.assertEqual(
+                paginator.decode_cursor(cursor),
+                [getattr(items[-1], name) for name, _, _ in paginator.keys],
+            )
+            page, cursor = paginator.page(cursor)
+            items.extend(page)
+        self.assertEqual([item.pk for item in items], [item.pk for item in paginator.queryset])
+        return [item.pk for item in items]
+
+    def test_listing_orderings(self):
+        for sort in ("price", "-price", "created_at", "-created_at", "name", "-stock"):
+            with self.subTest(sort=sort):
+                pks = self.walk(ProductSet.get_listings(Product.objects.all(), sort))
+                self.assertEqual(len(pks), 6)
+                self.assertEqual(len(set(pks)), 6)
+
+        # NULL цены — в конце в обоих направлениях
+        for sort in ("price", "-price"):
+            listings = ProductSet.get_listings(Product.objects.all(), sort)
+            self.assertEqual(self.walk(listings, per_page=1)[-1], self.empty.pk)
+
+    def test_annotation_keys(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            drain_outbox()
+        pks = self.walk(
+            ProductSet.get_listings(Product.objects.all(), "relevance", "футболка")
+        )
+        self.assertEqual(len(pks), 6)
+        pks = self.walk(Product.objects.with_price_bounds().order_by("min_price"), 4)
+        self.assertEqual(len(pks), 6)
+        pks = self.walk(Product.objects.with_price_bounds().order_by("-max_price"), 4)
+        self.assertEqual(len(pks), 6)
+
+    def next_cursor(self, sort):
+        request = self.factory.get("/", {"cursor": "", "sort": sort, "per_page": 2})
+        response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        return response.data["oldData"]["pagination"]["next_cursor"]
+
+    def test_invalid_cursor(self):
+        for params in (
+            {"cursor": "не курсор"},
+            {"cursor": "WzEsMiwzXQ"},
+            # Курсор сортировки по названию не подходит для сортировки по цене
+            {"cursor": self.next_cursor("name"), "sort": "price"},
+            # Те же колонки в обратном направлении: типы значений совпадают
+            {"cursor": self.next_cursor("price"), "sort": "-price"},
+            {"cursor": self.next_cursor("-created_at"), "sort": "created_at"},
+        ):
+            with self.subTest(params=params):
+                request = self.factory.get("/", {"per_page": 2, **params})
+                response = views.category_products_api(request, pk=self.CATEGORY_PK)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("cursor", response.data)
+
+
+class ProductFilterTests(CatalogTestCase):
+    """Фильтры выдачи — условия EXISTS одного запроса, без DISTINCT и повторов"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_products(4)
+        products = Product.objects.order_by("pk")
+        self.empty, self.hidden, self.cheap, self.expensive = products
+        ProductStock.objects.filter(variant__product=self.empty).update(quantity=0)
+        ProductVariant.objects.filter(product=self.hidden).update(show_this=False)
+
+    def test_visible_variants(self):
+        self.assertEqual(
+            set(ProductSet.filter_products_by_variants(Product.objects.all())),
+            {self.empty, self.cheap, self.expensive},
+        )
+
+    def test_combined_filters(self):
+        red, blue = self.colors
+        # Оба значения есть у двух вариантов каждого товара — товар всё равно один раз
+        request = self.factory.get(
+            "/",
+            {
+                "in_stock": "1",
+                f"attr_{red.attribute_id}": [red.pk, blue.pk],
+                "sort": "-price",
+            },
+        )
+        products, applied_filters = ProductSet.filter_products(
+            Product.objects.all(), request, attributes=True, in_stock=True, sort=True
+        )
+        self.assertEqual(applied_filters["in_stock_only"], True)
+
+        with CaptureQueriesContext(connection) as queries:
+            pks = list(products.values_list("pk", flat=True))
+        self.assertEqual(pks, [self.expensive.pk, self.cheap.pk])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("DISTINCT", queries[0]["sql"])
+
+
+class FacetIndexTests(CatalogTestCase):
+    """Фасеты индекса совпадают с SQL-подсчётом и обновляются после изменений"""
+
+    def products(self):
+        return Product.objects.filter(
+            category=self.category, is_active=True, is_visible_on_marketplace=True
+        ).with_visible_variants()
+
+    def assert_same_facets(self, selections):
+        index = FacetIndex.build(self.category)
+        self.assertEqual(
+            index.facets(index.eligible, selections),
+            attribute_facets(self.products(), selections=selections),
+        )
+
+    def test_facets_match_sql(self):
+        self.create_products(3)
+        red, blue = self.colors
+        self.assert_same_facets({})
+        self.assert_same_facets({red.attribute_id: ([red.pk], [])})
+
+    def test_filter_by_index(self):
+        self.create_products(3)
+        red, _ = self.colors
+        request = self.factory.get("/", {"per_page": 50, f"attr_{red.attribute_id}": red.pk})
+        views.category_products_api(request, pk=self.CATEGORY_PK)
+
+        # Индекс перечитывает только изменённый товар
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductVariantAttribute.objects.filter(
+                predefined_value=red, variant__product=Product.objects.first()
+            ).delete()
+
+        response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        self.assertEqual(len(response.data["oldData"]["products"]), 2)
+        counts = {
+            value["value"]: value["count"] for value in response.data["filters"][0]["values"]
+        }
+        self.assertEqual(counts, {"Красный": 2, "Синий": 3})
+
+    def test_index_rebuilt_after_max_age(self):
+        self.create_products(3)
+        index = get_facet_index(self.category)
+        # Изменение в обход сигналов не публикуется в журнал
+        Product.objects.filter(pk=Product.objects.order_by("pk").first().pk).update(
+            is_visible_on_marketplace=False
+        )
+        self.assertIs(get_facet_index(self.category), index)
+
+        index.built_at -= 601
+        self.assertEqual(get_facet_index(self.category).eligible.bit_count(), 2)
+
+    def test_stale_index_served_during_build(self):
+        self.create_products(1)
+        index = get_facet_index(self.category)
+        index.built_at -= 601
+        # Пока другой поток собирает индекс категории, ответ идёт по прежнему
+        with facet_index_module._build_locks[self.category.pk]:
+            with self.assertNumQueries(0):
+                self.assertIs(get_facet_index(self.category), index)
+        self.assertIsNot(get_facet_index(self.category), index)
+
+    def test_large_selection_filtered_in_sql(self):
+        self.create_products(3)
+        red, _ = self.colors
+        request = self.factory.get("/", {"per_page": 50, f"attr_{red.attribute_id}": red.pk})
+        with override_settings(FACET_INDEX_MAX_IDS=2), mock.patch.object(
+            FacetIndex, "ids_for"
+        ) as ids_for:
+            response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        ids_for.assert_not_called()
+        self.assertEqual(len(response.data["oldData"]["products"]), 3)
+        counts = {
+            value["value"]: value["count"] for value in response.data["filters"][0]["values"]
+        }
+        self.assertEqual(counts, {"Красный": 3, "Синий": 3})
+
+    def test_reconcile_refreshes_listing_and_indexes(self):
+        self.create_products(3)
+        request = self.factory.get("/", {"per_page": 50})
+        views.category_products_api(request, pk=self.CATEGORY_PK)
+
+        # Остатки обнулены в обход сигналов, как при импорте
+        first = Product.objects.order_by("pk").first()
+        ProductStock.objects.filter(variant__product=first).update(quantity=0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(reconcile_is_active(chunk_size=2), 3)
+
+        first.refresh_from_db()
+        self.assertFalse(first.is_active)
+        response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        self.assertEqual(len(response.data["oldData"]["products"]), 2)
+        counts = {
+            value["value"]: value["count"] for value in response.data["filters"][0]["values"]
+        }
+        self.assertEqual(counts, {"Красный": 2, "Синий": 2})
+
+
+class EffectivePriceTests(CatalogTestCase):
+    """Хранимая цена со скидкой совпадает с ценой карточки"""
+
+    def test_effective_price_on_save_and_update(self):
+        self.create_products(1)
+        product = Product.objects.get()
+        variants = list(product.variants.order_by("pk"))
+        self.assertEqual(
+            [variant.effective_price for variant in variants],
+            [Decimal("100.00"), Decimal("90.00")],
+        )
+        self.assertEqual(
+            [float(variant.effective_price) for variant in variants],
+            [variant.current_price for variant in variants],
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.variants.update(price=F("price") * 2, discount=Decimal("25"))
+        product.refresh_from_db()
+        self.assertEqual(product.min_effective_price, Decimal("150.00"))
+        self.assertEqual(product.max_effective_price, Decimal("150.00"))
+        self.assertTrue(Product.objects.price_between(150, 150).filter(pk=product.pk).exists())
+        self.assertFalse(Product.objects.price_between(151, None).exists())
+
+    def test_bounds_match_card_price(self):
+        self.create_products(1)
+        product = Product.objects.get()
+        cheap, regular = product.variants.order_by("effective_price")
+        # Самый дешёвый вариант скрыт — цена карточки и фильтра берётся без него
+        with self.captureOnCommitCallbacks(execute=True):
+            cheap.show_this = False
+            cheap.save()
+        product.refresh_from_db()
+        listing = ProductListing.objects.get(product=product)
+        self.assertEqual(product.min_effective_price, regular.effective_price)
+        self.assertEqual(product.min_effective_price, listing.min_price)
+        self.assertFalse(Product.objects.price_between(None, 95).exists())
+
+        # Вариант без остатка тоже не влияет на цену
+        with self.captureOnCommitCallbacks(execute=True):
+            cheap.show_this = True
+            cheap.save()
+            ProductStock.objects.get(variant=cheap).delete()
+        product.refresh_from_db()
+        self.assertEqual(product.min_effective_price, regular.effective_price)
+
+
+class ProductRefreshTests(CatalogTestCase):
+    """Изменённые товары пересчитываются один раз после коммита транзакции"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_products(1)
+        self.product = Product.objects.get()
+        self.stocks = list(ProductStock.objects.filter(variant__product=self.product))
+
+    def refresh(self):
+        return mock.patch(
+            "marketplace.product_refresh.refresh_products", wraps=refresh_products
+        )
+
+    def test_changes_coalesced(self):
+        with self.refresh() as refresh, self.captureOnCommitCallbacks(execute=True):
+            for stock in self.stocks * 25:
+                stock.quantity = 0
+                stock.save()
+            # До коммита товар не пересчитывается
+            refresh.assert_not_called()
+        refresh.assert_called_once_with({self.product.pk})
+        self.product.refresh_from_db()
+        self.assertFalse(self.product.is_active)
+        self.assertFalse(ProductListing.objects.get(product=self.product).in_stock)
+
+    def test_rolled_back_changes_ignored(self):
+        with self.refresh() as refresh, self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.stocks[0].quantity = 0
+                self.stocks[0].save()
+                raise RuntimeError
+        refresh.assert_not_called()
+
+
+class AttributeFacetTests(CatalogTestCase):
+    """Фасеты дизъюнктивные: счётчики атрибута не учитывают его собственный выбор"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_products(3)
+        self.products = list(Product.objects.order_by("pk"))
+        self.red, self.blue = self.colors
+        # У первого товара только красный вариант
+        ProductVariantAttribute.objects.filter(
+            variant__product=self.products[0], predefined_value=self.blue
+        ).delete()
+        size = CategoryAttribute.objects.create(
+            category=self.category,
+            attribute=Attribute.objects.create(
+                name="Размер", has_predefined_values=False, is_filterable=True
+            ),
+            required=True,
+        )
+        self.size_id = size.attribute_id
+        for product, value in zip(self.products, ("M", "M", "L")):
+            ProductVariantAttribute.objects.create(
+                variant=product.variants.order_by("pk").first(),
+                category_attribute=size,
+                custom_value=value,
+            )
+
+    def counts(self, selections=None):
+        filters = attribute_facets(Product.objects.all(), selections=selections)
+        return {
+            facet["name"]: {
+                value["value"]: (value["count"], value["selected"])
+                for value in facet["values"]
+            }
+            for facet in filters
+        }
+
+    def test_counts_without_selection(self):
+        with self.assertNumQueries(1):
+            counts = self.counts()
+        self.assertEqual(
+            counts,
+            {
+                "Размер": {"L": (1, False), "M": (2, False)},
+                "Цвет": {"Красный": (3, False), "Синий": (2, False)},
+            },
+        )
+        filters = attribute_facets(Product.objects.all(), category=self.category)
+        self.assertEqual(
+            {facet["name"]: facet["required"] for facet in filters},
+            {"Размер": True, "Цвет": False},
+        )
+
+    def test_disjunctive_counts(self):
+        # Выбор цвета не меняет счётчики цветов, но сужает размеры
+        self.assertEqual(
+            self.counts({self.red.attribute_id: ([self.blue.pk], [])}),
+            {
+                "Размер": {"L": (1, False), "M": (1, False)},
+                "Цвет": {"Красный": (3, False), "Синий": (2, True)},
+            },
+        )
+        with self.assertNumQueries(1):
+            counts = self.counts(
+                {
+                    self.red.attribute_id: ([self.blue.pk], []),
+                    self.size_id: ([], ["M"]),
+                }
+            )
+        self.assertEqual(
+            counts,
+            {
+                "Размер": {"L": (1, False), "M": (1, True)},
+                "Цвет": {"Красный": (2, False), "Синий": (1, True)},
+            },
+        )
+
+
+class PriceHistogramTests(CatalogTestCase):
+    """Гистограмма цен считается по товарам без учёта фильтра по цене"""
+
+    def test_price_histogram(self):
+        # Минимальные цены товаров со скидкой: 90.00, 90.90, 91.80
+        self.create_products(3)
+        request = self.factory.get("/", {"price_min": 91, "per_page": 50})
+        response = views.category_products_api(request, pk=self.CATEGORY_PK)
+
+        self.assertEqual(len(response.data["oldData"]["products"]), 1)
+        histogram = response.data["price_histogram"]
+        self.assertEqual((histogram["min"], histogram["max"]), (90.0, 102.0))
+        self.assertEqual(len(histogram["buckets"]), 20)
+        self.assertEqual(sum(bucket["count"] for bucket in histogram["buckets"]), 3)
+        self.assertEqual(
+            [histogram["buckets"][number]["count"] for number in (0, 1)], [1, 1]
+        )
+
+
+class ResponseCacheTests(CatalogTestCase):
+    """Ответ каталога берётся из кеша, пока не изменились его товары"""
+
+    def get(self, **params):
+        request = self.factory.get("/", {"per_page": 50, **params})
+        return views.category_products_api(request, pk=self.CATEGORY_PK)
+
+    def test_category_response_cache(self):
+        self.create_products(2)
+        self.get(sort="name")
+
+        # Посторонние параметры не влияют на ключ
+        with self.assertNumQueries(0):
+            response = self.get(sort="name", utm_source="mail")
+        self.assertEqual(len(response.data["oldData"]["products"]), 2)
+
+        product = Product.objects.first()
+        product.is_visible_on_marketplace = False
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        response = self.get(sort="name")
+        self.assertEqual(len(response.data["oldData"]["products"]), 1)
+
+    def test_conditional_get(self):
+        self.create_products(1)
+        response = self.get()
+        etag = response["ETag"]
+
+        request = self.factory.get("/", {"per_page": 50}, HTTP_IF_NONE_MATCH=etag)
+        with self.assertNumQueries(0):
+            response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        self.assertEqual(response.status_code, 304)
+
+        self.create_products(1)
+        response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        categories = views.marketplace_categories_api(self.factory.get("/"))
+        request = self.factory.get("/", HTTP_IF_NONE_MATCH=categories["ETag"])
+        self.assertEqual(views.marketplace_categories_api(request).status_code, 304)
+        self.assertFalse(categories.has_header("Last-Modified"))
+
+    def test_errors_not_validated(self):
+        response = views.child_category_api(self.factory.get("/"), pk=999)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header("ETag"))
+        response = views.product_detail_api(self.factory.get("/"), pk=999)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header("ETag"))
+
+    def test_local_cache_warned(self):
+        local = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        shared = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache"}}
+        with override_settings(DEBUG=False, CACHES=local):
+            self.assertEqual(
+                [warning.id for warning in check_shared_cache(None)], ["marketplace.W001"]
+            )
+        with override_settings(DEBUG=True, CACHES=local):
+            self.assertEqual(check_shared_cache(None), [])
+        with override_settings(DEBUG=False, CACHES=shared):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class SimilarProductTests(CatalogTestCase):
+    """Похожие товары читаются из рассчитанной таблицы"""
+
+    def test_similar_products_prefer_shared_attributes(self):
+        self.create_products(3)
+        first, second, third = Product.objects.order_by("pk")
+        # У первого и третьего остаётся только красный вариант
+        red, blue = self.colors
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductVariant.objects.filter(
+                product__in=[first, third], attributes__predefined_value=blue
+            ).delete()
+
+        self.assertEqual(build_similar_products(), 3)
+        self.assertEqual(
+            [product.pk for product in ProductSet.get_same_products(first)],
+            [third.pk, second.pk],
+        )
+        with self.assertNumQueries(1):
+            ProductSet.get_same_products(second)
+
+
+class CoPurchaseTests(CatalogTestCase):
+    """Счётчики «покупают вместе» учитывают только новые чеки"""
+
+    def sell(self, *variants):
+        receipt = Receipt.objects.create(
+            number=f"R-{Receipt.objects.count()}",
+            total_amount=0,
+            payment_method=self.payment_method,
+        )
+        for variant in variants:
+            ProductSale.objects.create(
+                receipt=receipt,
+                variant=variant,
+                location=self.warehouse,
+                quantity=1,
+                price_per_unit=variant.price,
+                total_price=variant.price,
+            )
+
+    def run_builder(self):
+        return update_co_purchases(now=timezone.now() + timezone.timedelta(hours=1))
+
+    def test_incremental_counts(self):
+        self.payment_method = PaymentMethod.objects.create(code="cash", name="Наличные")
+        self.create_products(3)
+        first, second, third = (
+            product.variants.order_by("pk").first()
+            for product in Product.objects.order_by("pk")
+        )
+        self.sell(first, second)
+        self.sell(first, second, third)
+        self.assertEqual(self.run_builder(), 2)
+        self.assertEqual(self.run_builder(), 0)
+
+        self.sell(first, third)
+        self.assertEqual(self.run_builder(), 1)
+        counts = dict(
+            ProductCoPurchase.objects.filter(product=first.product).values_list(
+                "companion_id", "receipts"
+            )
+        )
+        self.assertEqual(counts, {second.product_id: 2, third.product_id: 2})
+        self.assertEqual(
+            [product.pk for product in bought_together(second.product)],
+            [first.product_id, third.product_id],
+        )
+        suggestions = upsell_variants([third.pk], self.business)
+        self.assertEqual(
+            [(row["variant_id"], row["receipts_together"]) for row in suggestions],
+            [(first.pk, 2), (second.pk, 1)],
+        )
+
+    def test_product_detail_tracks_companions(self):
+        self.payment_method = PaymentMethod.objects.create(code="cash", name="Наличные")
+        self.create_products(2)
+        first, second = Product.objects.order_by("pk")
+        # Спутник из другой категории: версия категории первого товара не меняется
+        second.category = Category.objects.create(name="Кепки")
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sell(first.variants.first(), second.variants.first())
+        self.run_builder()
+
+        response = views.product_detail_api(self.factory.get("/"), pk=first.pk)
+        self.assertEqual(response.data["bought_together"][0]["name"], second.name)
+
+        second.name = "Кепка"
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        response = views.product_detail_api(self.factory.get("/"), pk=first.pk)
+        self.assertEqual(response.data["bought_together"][0]["name"], "Кепка")
+
+    def test_hidden_products_not_suggested(self):
+        self.payment_method = PaymentMethod.objects.create(code="cash", name="Наличные")
+        self.create_products(3)
+        first, second, third = Product.objects.order_by("pk")
+        self.sell(first.variants.first(), second.variants.first(), third.variants.first())
+        self.run_builder()
+        Product.objects.filter(pk=second.pk).update(is_visible_on_marketplace=False)
+        Product.objects.filter(pk=third.pk).update(is_active=False)
+
+        response = views.bought_together_api(self.factory.get("/"), pk=first.pk)
+        self.assertEqual([row["id"] for row in response.data["products"]], [])
+        for hidden in (second, third):
+            response = views.bought_together_api(self.factory.get("/"), pk=hidden.pk)
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(bought_together(Product.objects.get(pk=hidden.pk)), [])
+
+        Product.objects.filter(pk=second.pk).update(is_visible_on_marketplace=True)
+        response = views.bought_together_api(self.factory.get("/"), pk=first.pk)
+        self.assertEqual([row["id"] for row in response.data["products"]], [second.pk])
+
+    def upsell(self, query):
+        request = self.factory.get("/", query)
+        force_authenticate(request, user=self.business.owner)
+        return sale_product_API.upsell_api(request, business_slug=self.business.slug)
+
+    def test_upsell_api(self):
+        self.payment_method = PaymentMethod.objects.create(code="cash", name="Наличные")
+        self.create_products(3)
+        first, second, third = (
+            product.variants.order_by("pk").first()
+            for product in Product.objects.order_by("pk")
+        )
+        self.sell(first, second, third)
+        self.sell(first, third)
+        self.run_builder()
+
+        response = self.upsell({"variants": f"{first.pk}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [
+                (row["variant_id"], row["receipts_together"], row["available"])
+                for row in response.data["suggestions"]
+            ],
+            [(third.pk, 2, 3), (second.pk, 1, 4)],
+        )
+        response = self.upsell({"variants": f"{first.pk},{third.pk}", "limit": 1})
+        self.assertEqual(
+            [row["variant_id"] for row in response.data["suggestions"]], [second.pk]
+        )
+        self.assertEqual(self.upsell({}).data, {"suggestions": []})
+        self.assertEqual(self.upsell({"variants": "x"}).status_code, 400)
+
+
+class AvailabilityTests(CatalogTestCase):
+    """Остатки вариантов считаются сгруппированными запросами по складам"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_products(2)
+        self.product = Product.objects.order_by("pk").first()
+        self.first, self.second = self.product.variants.order_by("pk")
+        ProductStock.objects.filter(variant=self.first).update(
+            reserved_quantity=1, defect_quantity=1, sold_quantity=1
+        )
+        # Остаток в магазине не учитывается в складском наличии
+        self.shop = BusinessLocation.objects.create(
+            business=self.business,
+            name="Магазин",
+            location_type=BusinessLocationType.objects.create(
+                code="shop", name="Магазин", is_warehouse=False
+            ),
+            address="-",
+            contact_phone="-",
+        )
+        ProductStock.objects.create(variant=self.first, location=self.shop, quantity=4)
+
+    def test_resolve_availability(self):
+        with self.assertNumQueries(1):
+            availability = resolve_availability([self.first.pk, self.second.pk, 0])
+        entry = availability[self.first.pk]
+        self.assertEqual(
+            [entry[key] for key in ("quantity", "available", "reserved", "defect", "sold")],
+            [5, 2, 1, 1, 1],
+        )
+        self.assertEqual(list(entry["locations"]), [self.warehouse.pk])
+        self.assertEqual(availability.available(self.second.pk), 5)
+        # Вариант без остатков — нули, а не KeyError
+        self.assertEqual(availability.available(0), 0)
+        self.assertEqual(availability[0]["locations"], {})
+
+        everywhere = resolve_availability([self.first.pk], warehouse_only=False)
+        self.assertEqual(everywhere.available(self.first.pk), 6)
+        shop = everywhere[self.first.pk]["locations"][self.shop.pk]
+        self.assertEqual(shop["available"], 4)
+
+    def test_resolve_product_availability(self):
+        ProductVariant.objects.filter(pk=self.second.pk).update(show_this=False)
+        with self.assertNumQueries(1):
+            availability = resolve_product_availability([self.product])
+        self.assertEqual(set(availability), {self.first.pk, self.second.pk})
+
+        availability = resolve_product_availability([self.product], visible_only=True)
+        self.assertEqual(set(availability), {self.first.pk})
+
+    def test_queryset_availability(self):
+        other = Product.objects.exclude(pk=self.product.pk).get()
+        variants = ProductVariant.objects.filter(product=self.product).with_availability()
+        self.assertEqual(
+            dict(variants.values_list("pk", "warehouse_available")),
+            {self.first.pk: 2, self.second.pk: 5},
+        )
+
+        # Скрытый вариант не входит в наличие товара
+        ProductVariant.objects.filter(pk=self.second.pk).update(show_this=False)
+        products = Product.objects.with_availability().order_by("warehouse_available")
+        self.assertEqual(
+            list(products.values_list("pk", "warehouse_available")),
+            [(self.product.pk, 2), (other.pk, 10)],
+        )
+
+        # Остаток только в магазине — не в наличии
+        ProductStock.objects.filter(variant=self.first, location=self.warehouse).update(
+            quantity=3
+        )
+        self.assertEqual(
+            list(ProductVariant.objects.in_stock().filter(product=self.product)),
+            [self.second],
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Product.objects.in_stock()), [other])
+
+
+class StockCounterTests(CatalogTestCase):
+    """Счётчики брака и продаж, журнал движений и резервы"""
+
+    def setUp(self):
+        super().setUp()
+        self.payment_method = PaymentMethod.objects.create(code="cash", name="Наличные")
+        self.create_products(1)
+        self.stock = ProductStock.objects.order_by("pk").first()
+
+    def counters(self):
+        self.stock.refresh_from_db()
+        return (
+            self.stock.reserved_quantity,
+            self.stock.defect_quantity,
+            self.stock.sold_quantity,
+        )
+
+    def sell(self, quantity):
+        receipt = Receipt.objects.create(
+            number=f"R-{Receipt.objects.count()}",
+            total_amount=0,
+            payment_method=self.payment_method,
+        )
+        sale = ProductSale.objects.create(
+            receipt=receipt,
+            variant=self.stock.variant,
+            location=self.warehouse,
+            quantity=quantity,
+            price_per_unit=100,
+            total_price=100 * quantity,
+        )
+        return receipt, sale
+
+    def test_sale_and_defect_counters(self):
+        _, sale = self.sell(2)
+        defect = ProductDefect.objects.create(stock=self.stock, quantity=1)
+        self.assertEqual(self.counters(), (0, 1, 2))
+
+        sale.delete()
+        defect.delete()
+        self.assertEqual(self.counters(), (0, 0, 0))
+
+    def test_receipt_delete_restores_sold(self):
+        receipt, _ = self.sell(3)
+        self.assertEqual(self.counters(), (0, 0, 3))
+        receipt.delete()
+        self.assertEqual(self.counters(), (0, 0, 0))
+        # Повторное удаление чека не трогает счётчики
+        receipt.delete()
+        self.assertEqual(self.counters(), (0, 0, 0))
+
+    def test_decrement_below_zero_is_clamped(self):
+        self.sell(1)
+        add_sold_quantity([(self.stock.variant_id, self.warehouse.pk, -3)])
+        self.assertEqual(self.counters(), (0, 0, 0))
+        # В журнал записано применённое списание: журнал сходится с колонками
+        self.assertEqual(
+            StockMovement.objects.filter(stock=self.stock, kind=StockMovement.SALE)
+            .order_by("pk")
+            .last()
+            .quantity,
+            -1,
+        )
+        state = stock_state(self.stock)
+        self.stock.refresh_from_db()
+        for field in ("quantity", "reserved_quantity", "defect_quantity", "sold_quantity"):
+            self.assertEqual(state[field], getattr(self.stock, field))
+
+    def test_recount_posts_correcting_movements(self):
+        self.sell(2)
+        ProductStock.objects.filter(pk=self.stock.pk).update(sold_quantity=5, defect_quantity=1)
+
+        self.assertEqual(recount_stock_counters(), 1)
+        self.assertEqual(self.counters(), (0, 0, 2))
+        self.assertEqual(
+            sorted(
+                StockMovement.objects.filter(comment="Пересчёт").values_list(
+                    "kind", "quantity"
+                )
+            ),
+            [(StockMovement.DEFECT, -1), (StockMovement.SALE, -3)],
+        )
+        self.assertEqual(recount_stock_counters(), 0)
+
+    def test_reservation_cannot_oversell(self):
+        self.sell(1)
+        reservation = reserve_quantity(self.stock.pk, 4)
+        with self.assertRaises(ValidationError):
+            reserve_quantity(self.stock.pk, 1)
+        self.assertEqual(self.counters(), (4, 0, 1))
+
+        self.assertTrue(release_reservation(reservation))
+        self.assertFalse(release_reservation(reservation))
+        self.assertEqual(self.counters(), (0, 0, 1))
+
+    def test_expired_reservations_released(self):
+        reserve_quantity(self.stock.pk, 2, ttl_minutes=5)
+        reserve_quantity(self.stock.pk, 1, ttl_minutes=0)
+
+        self.assertEqual(release_expired_reservations(), 0)
+        later = timezone.now() + timezone.timedelta(minutes=10)
+        self.assertEqual(release_expired_reservations(now=later), 1)
+        self.assertEqual(self.counters(), (1, 0, 0))
+
+
+@override_settings(CATALOG_RESPONSE_CACHE_TIMEOUT=0)
+@mock.patch.object(sale_product_API, "generate_receipt_pdf")
+class CreateReceiptTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_products(1)
+        self.first, self.second = ProductVariant.objects.order_by("pk")
+        PaymentMethod.objects.create(code="cash", name="Наличные")
+
+    def post(self, *items):
+        request = self.factory.post(
+            "/",
+            {
+                "payment_method": "cash",
+                "items": [
+                    {"variant": variant.pk, "location": self.warehouse.pk, "quantity": quantity}
+                    for variant, quantity in items
+                ],
+            },
+            format="json",
+        )
+        force_authenticate(request, user=self.business.owner)
+        with self.captureOnCommitCallbacks(execute=True):
+            return sale_product_API.create_receipt(request, business_slug=self.business.slug)
+
+    def sold(self, variant):
+        return ProductStock.objects.get(variant=variant).sold_quantity
+
+    def assertNothingSold(self, generate_pdf):
+        self.assertFalse(Receipt.objects.exists())
+        self.assertFalse(ProductSale.objects.exists())
+        self.assertFalse(StockMovement.objects.filter(kind=StockMovement.SALE).exists())
+        self.assertEqual((self.sold(self.first), self.sold(self.second)), (0, 0))
+        generate_pdf.assert_not_called()
+
+    def test_receipt_created(self, generate_pdf):
+        response = self.post((self.first, 2), (self.second, 1))
+
+        self.assertEqual(response.status_code, 201)
+        receipt = Receipt.objects.get()
+        self.assertEqual(receipt.sales.count(), 2)
+        self.assertEqual((self.sold(self.first), self.sold(self.second)), (2, 1))
+        self.assertEqual(
+            sorted(
+                StockMovement.objects.filter(receipt=receipt).values_list(
+                    "stock__variant_id", "kind", "quantity"
+                )
+            ),
+            [
+                (self.first.pk, StockMovement.SALE, 2),
+                (self.second.pk, StockMovement.SALE, 1),
+            ],
+        )
+        generate_pdf.assert_called_once_with(receipt.id, save=True)
+
+    def test_duplicate_lines_summed(self, generate_pdf):
+        response = self.post((self.first, 2), (self.first, 2))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ProductSale.objects.count(), 2)
+        self.assertEqual(self.sold(self.first), 4)
+        self.assertEqual(
+            list(
+                StockMovement.objects.filter(kind=StockMovement.SALE).values_list(
+                    "quantity", flat=True
+                )
+            ),
+            [4],
+        )
+
+    def test_insufficient_stock_rolled_back(self, generate_pdf):
+        # Каждая строка по отдельности помещается в остаток 5, а вместе — нет
+        with self.assertRaises(ValidationError):
+            self.post((self.second, 1), (self.first, 3), (self.first, 3))
+
+        self.assertNothingSold(generate_pdf)
+
+    def test_failure_inside_transaction_skips_pdf(self, generate_pdf):
+        with mock.patch.object(
+            sale_product_API, "record_movements", side_effect=RuntimeError
+        ), self.assertRaises(RuntimeError):
+            self.post((self.first, 1))
+
+        self.assertNothingSold(generate_pdf)
+
+
+class SearchTests(CatalogTestCase):
+    """Полнотекстовый поиск находит товары по префиксу и сортирует по релевантности"""
+
+    def test_ranked_search(self):
+        self.create_products(3)
+        first, second, third = Product.objects.order_by("pk")
+        with self.captureOnCommitCallbacks(execute=True):
+            first.description = "Плотный хлопок"
+            first.save()
+            third.name = "Футболка хлопковая"
+            third.save()
+        drain_outbox()
+
+        self.assertEqual(search_products("хлоп"), [third.pk, first.pk])
+        self.assertEqual(len(search_products("футболка красный")), 3)
+        self.assertEqual(search_products("AND OR"), [])
+        # Поиск — условие того же запроса, что и остальные фильтры выдачи
+        scoped = Product.objects.filter(pk__in=[first.pk, second.pk])
+        self.assertEqual(search_products("хлоп", scoped), [first.pk])
+
+        request = self.factory.get("/", {"search": "хлоп"})
+        response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        self.assertEqual(response.data["oldData"]["applied_filters"]["sort"], "relevance")
+        self.assertEqual(
+            [row["id"] for row in response.data["oldData"]["products"]],
+            [third.pk, first.pk],
+        )
+
+    def test_word_forms_and_typos(self):
+        self.create_products(2)
+        first, second = Product.objects.order_by("pk")
+        with self.captureOnCommitCallbacks(execute=True):
+            second.name = "Рубашка хлопковая"
+            second.save()
+        drain_outbox()
+
+        # Другая форма слова находится по основе; «Футболки» — ещё и категория
+        # обоих товаров, но совпадение в названии выше
+        self.assertEqual(search_products("футболкой"), [first.pk, second.pk])
+        self.assertEqual(search_products("рубашкой"), [second.pk])
+        # Опечатка исправляется по словарю триграмм
+        self.assertEqual(search_products("рубашкп хлопокавая"), [second.pk])
+        self.assertEqual(search_products("абвгд"), [])
+
+        # Исправление проверяется один раз на запрос: фильтр и релевантность —
+        # по одному и тому же исправленному запросу
+        request = self.factory.get("/", {"search": "рубашкп хлопокавая"})
+        with mock.patch(
+            "marketplace.ProductsSet.corrected_query", wraps=corrected_query
+        ) as corrected:
+            response = views.category_products_api(request, pk=self.CATEGORY_PK)
+        self.assertEqual(corrected.call_count, 1)
+        applied = response.data["oldData"]["applied_filters"]
+        self.assertEqual(applied["corrected_query"], "рубашка хлопковая")
+        self.assertEqual(
+            [row["id"] for row in response.data["oldData"]["products"]], [second.pk]
+        )
+
+    def test_backend_interface(self):
+        with self.assertRaises(TypeError):
+            SearchBackend()
+
+    def test_scoped_typos_and_pruned_terms(self):
+        self.create_products(3)
+        first, second, third = Product.objects.order_by("pk")
+        with self.captureOnCommitCallbacks(execute=True):
+            second.name = "Рубашка хлопковая"
+            second.save()
+            third.name = "Рубашкпзхщъ"
+            third.save()
+
+        # Запрос находит товар вне выдачи, но в выдаче исправляется
+        self.assertEqual(search_products("рубашкп"), [third.pk])
+        scoped = Product.objects.filter(pk__in=[first.pk, second.pk])
+        self.assertEqual(search_products("рубашкп", scoped), [second.pk])
+
+        # Слова переименованных товаров уходят из словаря при полном reindex
+        with self.captureOnCommitCallbacks(execute=True):
+            second.name = "Майка"
+            second.save()
+        self.assertTrue(SearchTerm.objects.filter(term="рубашка").exists())
+        self.assertEqual(reindex(), 3)
+        self.assertFalse(SearchTerm.objects.filter(term="рубашка").exists())
+        self.assertTrue(SearchTerm.objects.filter(term="майка").exists())
+
+    @override_settings(MARKETPLACE_SEARCH_INDEX_ON_COMMIT=False)
+    def test_outbox_and_reindex(self):
+        self.create_products(2)
+        # Документы появляются только после разбора очереди
+        self.assertEqual(search_products("футболки"), [])
+        pending = SearchOutbox.objects.count()
+        self.assertEqual(drain_outbox(batch_size=3), pending)
+        self.assertEqual(SearchOutbox.objects.count(), 0)
+        self.assertEqual(len(search_products("футболки")), 2)
+
+        # Переименование категории переиндексирует её товары одной записью
+        self.assertEqual(search_products("майки"), [])
+        self.category.name = "Майки"
+        self.category.save()
+        self.assertEqual(SearchOutbox.objects.count(), 1)
+        drain_outbox()
+        self.assertEqual(len(search_products("майки")), 2)
+
+        ProductSearchDocument.objects.all().delete()
+        self.assertEqual(reindex(chunk_size=1), 2)
+        self.assertEqual(len(search_products("майки")), 2)
+
+    def test_index_on_commit(self):
+        # Товары транзакции индексируются после её коммита без drain_search_outbox
+        self.create_products(1)
+        product = Product.objects.get()
+        self.assertFalse(SearchOutbox.objects.filter(product_id__isnull=False).exists())
+        self.assertEqual(search_products("футболка"), [product.pk])
+
+        # Переименование значения атрибута затрагивает много товаров —
+        # остаётся в очереди для команды
+        with self.captureOnCommitCallbacks(execute=True):
+            self.colors[0].value = "Бордовый"
+            self.colors[0].save()
+        self.assertTrue(
+            SearchOutbox.objects.filter(attribute_value_id=self.colors[0].pk).exists()
+        )
+        self.assertEqual(search_products("бордовый"), [])
+        drain_outbox()
+        self.assertEqual(search_products("бордовый"), [product.pk])
+
+    def test_large_transaction_left_to_drain(self):
+        with mock.patch("marketplace.search.ON_COMMIT_LIMIT", 1):
+            self.create_products(2)
+        self.assertEqual(search_products("футболка"), [])
+        pending = SearchOutbox.objects.count()
+        self.assertTrue(pending)
+        self.assertEqual(drain_outbox(), pending)
+        self.assertEqual(len(search_products("футболка")), 2)
+
+
+class ScanTests(CatalogTestCase):
+    """Скан на кассе — один запрос, вариант кешируется до его изменения"""
+
+    def test_scan(self):
+        self.create_products(1)
+        variant = ProductVariant.objects.order_by("pk").first()
+
+        with self.assertNumQueries(1):
+            result = scan(self.business.slug, variant.barcode)
+        self.assertEqual(result["variant_id"], variant.pk)
+        self.assertEqual(result["available"], 5)
+        self.assertEqual(
+            [location["location_id"] for location in result["locations"]],
+            [self.warehouse.pk],
+        )
+        self.assertIsNone(scan("other", variant.barcode))
+
+        ProductStock.objects.filter(variant=variant).update(quantity=2)
+        # Повторный скан читает только остатки
+        with self.assertNumQueries(1):
+            result = scan(self.business.slug, variant.barcode)
+        self.assertEqual(result["available"], 2)
+
+        ProductVariant.objects.filter(pk=variant.pk).update(price=50)
+        self.assertEqual(scan(self.business.slug, variant.sku)["current_price"], 50)
+
+    def test_entries_expire(self):
+        self.create_products(1)
+        variant = ProductVariant.objects.order_by("pk").first()
+        scan(self.business.slug, variant.barcode)
+        # Изменение в обход сигналов не сбрасывает поколение
+        ProductVariant.objects.filter(pk=variant.pk).update(price=50)
+        self.assertNotEqual(scan(self.business.slug, variant.barcode)["current_price"], 50)
+
+        with mock.patch("marketplace.scan.time.monotonic", return_value=time.monotonic() + 61):
+            with self.assertNumQueries(1):
+                result = scan(self.business.slug, variant.barcode)
+        self.assertEqual(result["current_price"], 50)
+
+    def test_scan_api(self):
+        self.create_products(1)
+        variant = ProductVariant.objects.order_by("pk").first()
+        client = APIClient()
+        url = reverse("core:sales-scan", kwargs={"business_slug": self.business.slug})
+        self.assertIn(client.get(url, {"code": variant.barcode}).status_code, (401, 403))
+
+        client.force_authenticate(user=self.business.owner)
+        response = client.get(url, {"code": variant.barcode})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["variant_id"], variant.pk)
+        self.assertEqual(response.json()["available"], 5)
+        response = client.get(url, {"code": variant.sku})
+        self.assertEqual(response.json()["variant_id"], variant.pk)
+
+        # Только точное совпадение и только варианты своего бизнеса
+        self.assertEqual(client.get(url, {"code": variant.barcode[:-1]}).status_code, 404)
+        self.assertEqual(client.get(url).status_code, 404)
+        other = Business.objects.create(
+            owner=User.objects.create(username="other"),
+            business_type=self.business.business_type,
+            name="Другой",
+            slug="other",
+        )
+        client.force_authenticate(user=other.owner)
+        other_url = reverse("core:sales-scan", kwargs={"business_slug": other.slug})
+        self.assertEqual(client.get(other_url, {"code": variant.barcode}).status_code, 404)
+
+
+class SuggestTests(CatalogTestCase):
+    """Подсказки берутся из индекса в памяти и догоняют изменения товаров"""
+
+    def test_suggest(self):
+        self.create_products(2)
+        first, second = Product.objects.order_by("pk")
+        child = Category.objects.create(name="Поло", parent=self.category)
+
+        result = suggest("фут")
+        self.assertEqual(
+            [item["id"] for item in result["products"]], [first.pk, second.pk]
+        )
+        self.assertEqual(result["categories"][0]["id"], self.CATEGORY_PK)
+        self.assertEqual(suggest("пол")["categories"][0]["path"], "Футболки / Поло")
+        self.assertEqual(suggest("кра")["values"][0]["id"], self.colors[0].pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.name = "Майка хлопковая"
+            second.save()
+        # Перечитывается только изменённый товар, остальное — из памяти
+        with self.assertNumQueries(2):
+            result = suggest("хлоп")
+        self.assertEqual([item["name"] for item in result["products"]], [second.name])
+        with self.assertNumQueries(0):
+            self.assertEqual(len(suggest("фут")["products"]), 1)
+
+    def test_index_replaced_not_mutated(self):
+        self.create_products(2)
+        first = Product.objects.order_by("pk").first()
+        index = get_suggest_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            first.name = "Майка"
+            first.save()
+
+        # Изменение собирается в новую копию, прежний индекс не меняется
+        updated = get_suggest_index()
+        self.assertIsNot(updated, index)
+        self.assertIs(get_suggest_index(), updated)
+        self.assertEqual(len(index.suggest("фут")["products"]), 2)
+        self.assertEqual(len(updated.suggest("фут")["products"]), 1)
+        self.assertEqual(updated.suggest("май")["products"][0]["id"], first.pk)
+
+        # Изменение в обход сигналов видно после истечения возраста индекса
+        Product.objects.filter(pk=first.pk).update(name="Рубашка")
+        self.assertEqual(suggest("руб")["products"], [])
+        updated.built_at -= 601
+        self.assertEqual(suggest("руб")["products"][0]["id"], first.pk)
+
+    def test_stale_index_served_during_build(self):
+        self.create_products(1)
+        index = get_suggest_index()
+        index.built_at -= 601
+        # Пока другой поток собирает индекс, ответ идёт по прежнему
+        with suggest_module._build_lock:
+            with self.assertNumQueries(0):
+                self.assertIs(get_suggest_index(), index)
+        self.assertIsNot(get_suggest_index(), index)
+
+        # Сброс индекса во время сборки не ломает подмену
+        original_build = SuggestIndex.build
+
+        def build(generation=None):
+            reset_suggest_index()
+            return original_build(generation)
+
+        with mock.patch.object(SuggestIndex, "build", side_effect=build):
+            get_suggest_index().built_at -= 601
+            rebuilt = get_suggest_index()
+        self.assertIs(get_suggest_index(), rebuilt)
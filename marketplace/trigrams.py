@@ -0,0 +1,149 @@
+"""
+Исправление опечаток в поиске по триграммному индексу слов.
+
+Словарь SearchTerm — слова из названий и описаний товаров и вариантов,
+у каждого слова — триграммы с отступами (как в pg_trgm: «  ф», « фу»,
+«фут», …) в таблице SearchTrigram с индексом по триграмме. Слова,
+похожие на слово запроса, находятся одним сгруппированным запросом
+по его триграммам (без просмотра словаря целиком) и ранжируются
+по сходству Жаккара множеств триграмм.
+
+Словарь пополняется при индексации товаров (marketplace.search): новые
+слова и их триграммы вставляются пачкой, у известных обновляется время
+seen_at. Полный reindex после прохода удаляет слова, не встреченные
+с его начала (prune_terms), — иначе опечатка исправлялась бы на слово
+удалённого или переименованного товара, которое ничего не находит.
+"""
+
+import re
+
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import Product, ProductVariant, SearchTerm, SearchTrigram
+
+# Длина слов словаря
+MIN_LENGTH = 3
+MAX_LENGTH = 40
+# Минимальное сходство замены и число рассматриваемых кандидатов
+SIMILARITY_THRESHOLD = 0.3
+CANDIDATES = 20
+# Размер списка IN в запросах к словарю
+CHUNK_SIZE = 500
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_word(word):
+    return word.casefold().replace("ё", "е")
+
+
+def words(text):
+    """Слова текста подходящей длины в нормализованном виде."""
+    return {
+        normalize_word(word)
+        for word in _WORD.findall(text or "")
+        if MIN_LENGTH <= len(word) <= MAX_LENGTH
+    }
+
+
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start : start + CHUNK_SIZE]
+
+
+def add_terms(product_ids):
+    """Добавляет в словарь новые слова товаров и их вариантов."""
+    found = set()
+    for name, description in Product.objects.filter(pk__in=product_ids).values_list(
+        "name", "description"
+    ):
+        found |= words(name) | words(description)
+    for custom_name, custom_description in ProductVariant.objects.filter(
+        product_id__in=product_ids
+    ).values_list("custom_name", "custom_description"):
+        found |= words(custom_name) | words(custom_description)
+
+    now = timezone.now()
+    new = set(found)
+    for chunk in _chunks(found):
+        known = SearchTerm.objects.filter(term__in=chunk)
+        new.difference_update(known.values_list("term", flat=True))
+        known.update(seen_at=now)
+    if not new:
+        return 0
+
+    # Параллельная индексация могла добавить те же слова — конфликты пропускаются
+    SearchTerm.objects.bulk_create(
+        [
+            SearchTerm(term=word, trigram_count=len(trigrams(word)), seen_at=now)
+            for word in new
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    rows = []
+    for chunk in _chunks(new):
+        for pk, word in SearchTerm.objects.filter(term__in=chunk).values_list("pk", "term"):
+            rows.extend(SearchTrigram(term_id=pk, trigram=gram) for gram in trigrams(word))
+    SearchTrigram.objects.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
+    return len(new)
+
+
+def clear_terms():
+    SearchTerm.objects.all().delete()
+
+
+def prune_terms(started):
+    """Удаляет слова, не встреченные при индексации с момента started."""
+    deleted, _ = SearchTerm.objects.filter(
+        Q(seen_at__lt=started) | Q(seen_at__isnull=True)
+    ).delete()
+    return deleted
+
+
+def similar_terms(word, limit=CANDIDATES):
+    """
+    Слова словаря, похожие на word: [(сходство, слово)] по убыванию сходства.
+    Кандидаты — слова с общими триграммами и близким числом триграмм.
+    """
+    grams = trigrams(word)
+    rows = (
+        SearchTrigram.objects.filter(
+            trigram__in=grams,
+            term__trigram_count__range=(len(grams) // 2, len(grams) * 2),
+        )
+        .values("term__term", "term__trigram_count")
+        .annotate(shared=Count("pk"))
+        .order_by("-shared", "term__term")[:limit]
+    )
+    scored = []
+    for row in rows:
+        union = len(grams) + row["term__trigram_count"] - row["shared"]
+        scored.append((row["shared"] / union, row["term__term"]))
+    return sorted(
+        (item for item in scored if item[0] >= SIMILARITY_THRESHOLD),
+        key=lambda item: (-item[0], item[1]),
+    )
+
+
+def correct_query(terms):
+    """
+    Слова запроса, где слова не из словаря заменены самыми похожими.
+    Слово без похожих остаётся как есть.
+    """
+    known = set(SearchTerm.objects.filter(term__in=terms).values_list("term", flat=True))
+    corrected = []
+    for term in terms:
+        if term in known or len(term) < MIN_LENGTH:
+            corrected.append(term)
+            continue
+        candidates = similar_terms(term)
+        corrected.append(candidates[0][1] if candidates else term)
+    return corrected
@@ -28,6 +28,8 @@ urlpatterns.extend([
     path('api/categories/<int:pk>/', views.child_category_api, name='child_category_api'),
     path('api/categories/<int:pk>/products/', views.category_products_api, name='category_products_api'),
     path('api/products/<int:pk>/', views.product_detail_api, name='product_detail_api'),
+    path('api/products/<int:pk>/bought-together/', views.bought_together_api, name='bought_together_api'),
+    path('api/suggest', views.suggest_api, name='suggest_api'),
     # path('api/categories/<int:pk>/filters/', views.get_category_filters),
     path("api/test", views.test_api)
     # path('api/categories/<int:pk>/products_test/', views.get_category_filters_test1),
@@ -8,9 +8,10 @@ from rest_framework import status
 from django.shortcuts import get_object_or_404
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from .models import Category, Product
+from .models import Category, Product, ProductCoPurchase, SimilarProduct
 from .serializers import (
     ProductListSerializer,
+    ProductListingSerializer,
     CategorySerializer,
     ProductDetailSerializer,
 )
@@ -21,6 +22,22 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from .ProductsSet import ProductSet
+from .catalog_cache import (
+    CATALOG,
+    cache_timeout,
+    cached_data,
+    catalog_condition,
+    catalog_etag,
+    category_scope,
+    get_versions,
+    product_scope,
+    response_key,
+)
+from .copurchase import bought_together
+from .facet_index import filter_with_facets
+from .facets import price_histogram
+from .stock import resolve_product_availability
+from .suggest import DEFAULT_LIMIT, MAX_LIMIT, suggest
 
 
 @api_view(["GET"])
@@ -36,8 +53,16 @@ def test_api(request):
     filters = ProductSet.get_filters_by_products(filtered_products)
     category_serialized = CategorySerializer(category)
 
+    page_products = ProductSet.prefetch_for_list(page_obj)
     products_page = ProductListSerializer(
-        page_obj, many=True, context={"request": request}
+        page_products,
+        many=True,
+        context={
+            "request": request,
+            "availability": resolve_product_availability(
+                page_products, visible_only=True
+            ),
+        },
     )
 
     # Возвращаем сериализованные данные в ответе
@@ -57,6 +82,11 @@ def test_api(request):
     )
 
 
+def categories_etag(request, pk=None):
+    return catalog_etag(request, "categories", pk, *get_versions([CATALOG]))
+
+
+@catalog_condition(categories_etag)
 @api_view(["GET"])
 def marketplace_categories_api(request):
     """API для категорий маркетплейса"""
@@ -65,6 +95,7 @@ def marketplace_categories_api(request):
     return Response(serializer.data)
 
 
+@catalog_condition(categories_etag)
 @api_view(["GET"])
 def child_category_api(request, pk):
     category = get_object_or_404(Category, pk=pk)
@@ -85,81 +116,226 @@ def child_category_api(request, pk):
         )
 
 
+def category_products_etag(request, pk):
+    return catalog_etag(
+        request, response_key("category_products", request, [category_scope(pk)])
+    )
+
+
+@catalog_condition(category_products_etag)
 @api_view(["GET"])
 def category_products_api(request, pk):
     """API для получения товаров в указанной категории."""
+    return Response(
+        cached_data(
+            "category_products",
+            request,
+            [category_scope(pk)],
+            lambda: category_products_data(request, pk),
+        )
+    )
+
+
+def category_products_data(request, pk):
+    """Данные ответа category_products_api."""
     products = ProductSet.get_products_by_category(pk, "marketplace")
     category = get_object_or_404(Category, pk=pk, is_active=True)
     breadcrumbs = ProductSet.get_breadcrumbs_by_category(category)
-    filtered_products, applied_filters = ProductSet.filter_products(
+    # Фасеты считаются по товарам до фильтра по атрибутам
+    selections = ProductSet.parse_attribute_filters(request)
+    # Цена применяется отдельно: гистограмма цен считается без неё
+    unpriced_products, applied_filters = ProductSet.filter_products(
         products,
         request,
-        price=True,
         search=True,
         barcode=True,
-        attributes=True,
         in_stock=True,
         main=True,
-        sort=True,
     )
-    page_obj, pagination = ProductSet.pagination_for_products(
-        filtered_products, request
+    base_products = unpriced_products.price_between(
+        ProductSet._parse_price(applied_filters["price_min"]),
+        ProductSet._parse_price(applied_filters["price_max"]),
+    )
+    # Фильтр по атрибутам и счётчики фасетов — по битовому индексу категории;
+    # без поиска, цены и наличия набор товаров берётся из индекса без запроса
+    filtered_products, filters = filter_with_facets(
+        category,
+        base_products,
+        selections,
+        narrowed=any(
+            applied_filters[key]
+            for key in ("search_query", "price_min", "price_max", "in_stock_only")
+        ),
+    )
+    # Страница читается из строк каталога, сортировка — по их колонкам
+    listings = ProductSet.get_listings(
+        filtered_products, applied_filters["sort"], applied_filters["corrected_query"]
+    )
+    page_obj, pagination = ProductSet.pagination_for_products(listings, request)
+    histogram = price_histogram(
+        ProductSet.filter_by_attributes(unpriced_products, selections)
     )
-    filters = ProductSet.get_filters_by_products(filtered_products)
 
     category_serialized = CategorySerializer(category)
 
-    products_page = ProductListSerializer(
+    products_page = ProductListingSerializer(
         page_obj, many=True, context={"request": request}
     )
 
-    # Возвращаем сериализованные данные в ответе
-    return Response(
-        {
-            "oldData": {
-                "category": category_serialized.data,
-                "breadcrumbs": breadcrumbs,
-                "subcategories": CategorySerializer(
-                    category.children.filter(is_active=True).order_by(
-                        "ordering", "name"
-                    ),
-                    many=True,
-                ).data,
-                "products": products_page.data,
-                "pagination": pagination,
-                "applied_filters": applied_filters,
-            },
-            "filters": filters,
-        }
-    )
+    return {
+        "oldData": {
+            "category": category_serialized.data,
+            "breadcrumbs": breadcrumbs,
+            "subcategories": CategorySerializer(
+                category.children.filter(is_active=True).order_by("ordering", "name"),
+                many=True,
+            ).data,
+            "products": products_page.data,
+            "pagination": pagination,
+            "applied_filters": applied_filters,
+        },
+        "filters": filters,
+        "price_histogram": histogram,
+    }
 
 
-@api_view(["GET"])
-def product_detail_api(request, pk):
-    try:
-        # Получаем продукт с предзагрузкой всех связанных данных
-        product = ProductSet.get_product_detail(pk)
+# Сколько товаров в блоках «похожие» и «покупают вместе» карточки
+DETAIL_BLOCK_LIMIT = 8
 
-        # Формируем breadcrumbs
-        breadcrumbs = ProductSet.get_breadcrumbs_by_category(product.category)
 
-        # Получаем похожие товары (из той же категории)
-        same_products = ProductSet.get_same_products(product)
+def _block_scopes(candidates, limit=DETAIL_BLOCK_LIMIT):
+    """
+    Области товаров блока: кандидаты (id, is_active) по порядку блока
+    до limit-го активного включительно. Неактивный кандидат выше него может
+    стать активным и попасть в блок, ниже — уже не попадёт.
+    """
+    scopes = []
+    shown = 0
+    start = 0
+    while True:
+        rows = list(candidates[start : start + 2 * limit])
+        for pk, is_active in rows:
+            scopes.append(product_scope(pk))
+            shown += is_active
+            if shown == limit:
+                return scopes
+        if len(rows) < 2 * limit:
+            return scopes
+        start += 2 * limit
 
-        serializer = ProductDetailSerializer(product, context={"request": request})
-        same_products_serializer = ProductListSerializer(
-            same_products, many=True, context={"request": request}
-        )
 
+def product_detail_scopes(request, pk):
+    """
+    Области версий карточки товара: сам товар, его категория (похожие товары
+    без расчёта) и товары блоков «похожие» и «покупают вместе» — их цены
+    и наличие входят в ответ. Запоминаются на запросе для ETag и кеша ответа.
+    """
+    if not hasattr(request, "catalog_scopes"):
+        category_id = Product.objects.values_list("category_id", flat=True).get(pk=pk)
+        similar = SimilarProduct.objects.filter(product_id=pk).order_by("rank")
+        companions = ProductCoPurchase.objects.filter(product_id=pk).order_by("-receipts")
+        request.catalog_scopes = [
+            product_scope(pk),
+            category_scope(category_id),
+            *_block_scopes(similar.values_list("similar_id", "similar__is_active")),
+            *_block_scopes(companions.values_list("companion_id", "companion__is_active")),
+        ]
+    return request.catalog_scopes
+
+
+def product_detail_etag(request, pk):
+    try:
+        scopes = product_detail_scopes(request, pk)
+    except Product.DoesNotExist:
+        return None
+    return catalog_etag(request, response_key("product_detail", request, scopes))
+
+
+@catalog_condition(product_detail_etag)
+@api_view(["GET"])
+def product_detail_api(request, pk):
+    try:
+        scopes = product_detail_scopes(request, pk) if cache_timeout() else []
         return Response(
-            {
-                "breadcrumbs": breadcrumbs,
-                "product": serializer.data,
-                "same_products": same_products_serializer.data,
-            }
+            cached_data(
+                "product_detail", request, scopes, lambda: product_detail_data(request, pk)
+            )
         )
 
     except Product.DoesNotExist:
         return Response(
             {"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND
         )
+
+
+def product_detail_data(request, pk):
+    """Данные ответа product_detail_api."""
+    # Получаем продукт с предзагрузкой всех связанных данных
+    product = ProductSet.get_product_detail(pk)
+
+    # Формируем breadcrumbs
+    breadcrumbs = ProductSet.get_breadcrumbs_by_category(product.category)
+
+    # Получаем похожие товары (из той же категории)
+    same_products = ProductSet.get_same_products(product, limit=DETAIL_BLOCK_LIMIT)
+
+    # Товары, которые покупают вместе с этим (по чекам)
+    companions = bought_together(product, limit=DETAIL_BLOCK_LIMIT)
+
+    serializer = ProductDetailSerializer(product, context={"request": request})
+    # Карточки обоих блоков загружаются вместе
+    cards = ProductSet.prefetch_for_list([*same_products, *companions])
+    context = {
+        "request": request,
+        "availability": resolve_product_availability(cards, visible_only=True),
+    }
+
+    return {
+        "breadcrumbs": breadcrumbs,
+        "product": serializer.data,
+        "same_products": ProductListSerializer(
+            cards[: len(same_products)], many=True, context=context
+        ).data,
+        "bought_together": ProductListSerializer(
+            cards[len(same_products) :], many=True, context=context
+        ).data,
+    }
+
+
+@api_view(["GET"])
+def bought_together_api(request, pk):
+    """Товары, которые чаще всего покупают вместе с товаром (?limit=, до 50)."""
+    product = get_object_or_404(
+        Product, pk=pk, is_active=True, is_visible_on_marketplace=True
+    )
+    try:
+        limit = min(max(int(request.GET.get("limit", 8)), 1), 50)
+    except ValueError:
+        limit = 8
+
+    companions = ProductSet.prefetch_for_list(bought_together(product, limit=limit))
+    serializer = ProductListSerializer(
+        companions,
+        many=True,
+        context={
+            "request": request,
+            "availability": resolve_product_availability(
+                companions, visible_only=True
+            ),
+        },
+    )
+    return Response({"products": serializer.data})
+
+
+@api_view(["GET"])
+def suggest_api(request):
+    """
+    Подсказки поиска по префиксу (?q=&limit=): товары, пути категорий
+    и значения атрибутов из индекса в памяти, без запросов к каталогу.
+    """
+    try:
+        limit = min(max(int(request.GET.get("limit", DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    query = request.GET.get("q", "")
+    return Response({"query": query, **suggest(query, limit=limit)})